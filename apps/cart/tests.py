@@ -1,3 +1,77 @@
-from django.test import TestCase
+import threading
+import redis
+from django.test import SimpleTestCase
 
 # Create your tests here.
+from apps.goods.stock import SKU_STOCK_KEY
+from apps.cart.utils import *
+
+
+def get_local_redis():
+    """连接本地redis的15号库，连接不上时返回None"""
+    conn = redis.StrictRedis(host='127.0.0.1', port=6379, db=15)
+    try:
+        conn.ping()
+    except redis.ConnectionError:
+        return None
+    return conn
+
+
+class CartScriptConcurrencyTest(SimpleTestCase):
+    """购物车lua脚本并发测试，需要本地redis"""
+
+    user_id = 1
+    sku_id = 1
+
+    def setUp(self):
+        self.conn = get_local_redis()
+        if self.conn is None:
+            self.skipTest('本地redis不可用')
+        self.conn.delete(get_cart_key(self.user_id), SKU_STOCK_KEY)
+
+    def tearDown(self):
+        self.conn.delete(get_cart_key(self.user_id), SKU_STOCK_KEY)
+
+    def run_parallel(self, func, num):
+        """num个线程同时执行func，每个线程使用自己的连接，返回所有结果"""
+        results = []
+        barrier = threading.Barrier(num)
+
+        def worker():
+            conn = redis.StrictRedis(host='127.0.0.1', port=6379, db=15)
+            barrier.wait()
+            results.append(func(conn))
+
+        threads = [threading.Thread(target=worker) for i in range(num)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_parallel_add_does_not_lose_increments(self):
+        """并发添加同一商品，数量不会丢失"""
+        self.conn.hset(SKU_STOCK_KEY, self.sku_id, 1000)
+        results = self.run_parallel(lambda conn: cart_add(conn, self.user_id, self.sku_id, 2), 50)
+
+        self.assertEqual(results, [1] * 50)
+        self.assertEqual(get_cart_counts(self.conn, self.user_id), {self.sku_id: 100})
+
+    def test_parallel_add_respects_stock(self):
+        """并发添加同一商品，总数量不会超过库存"""
+        self.conn.hset(SKU_STOCK_KEY, self.sku_id, 10)
+        results = self.run_parallel(lambda conn: cart_add(conn, self.user_id, self.sku_id, 1), 50)
+
+        self.assertEqual(results.count(1), 10)
+        self.assertEqual(results.count(CART_STOCK_NOT_ENOUGH), 40)
+        self.assertEqual(get_cart_counts(self.conn, self.user_id), {self.sku_id: 10})
+
+    def test_update_and_delete(self):
+        """更新和删除返回购物车中商品的条目数"""
+        self.conn.hset(SKU_STOCK_KEY, self.sku_id, 10)
+        self.conn.hset(SKU_STOCK_KEY, 2, 10)
+        self.assertEqual(cart_add(self.conn, self.user_id, self.sku_id, 1), 1)
+        self.assertEqual(cart_update(self.conn, self.user_id, 2, 5), 2)
+        self.assertEqual(cart_update(self.conn, self.user_id, 2, 11), CART_STOCK_NOT_ENOUGH)
+        self.assertEqual(cart_delete(self.conn, self.user_id, self.sku_id), 1)
+        self.assertEqual(get_cart_counts(self.conn, self.user_id), {2: 5})
@@ -0,0 +1,114 @@
+from apps.goods.stock import SKU_STOCK_KEY, load_stock
+
+# 购物车lua脚本的返回值，大于等于0时是购物车中商品的条目数
+CART_STOCK_MISSING = -1  # 库存镜像中没有该商品，需要从数据库加载
+CART_STOCK_NOT_ENOUGH = -2  # 商品库存不足
+CART_SKU_NOT_EXIST = -3  # 商品不存在
+
+# 添加商品：在原有数量上累加，累加后的数量不能超过库存
+# KEYS[1] 购物车key KEYS[2] 库存镜像key，ARGV[1] sku_id ARGV[2] 添加的数量
+CART_ADD_SCRIPT = """
+local stock = redis.call('HGET', KEYS[2], ARGV[1])
+if not stock then
+    return -1
+end
+local count = tonumber(ARGV[2]) + tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or 0)
+if count > tonumber(stock) then
+    return -2
+end
+redis.call('HSET', KEYS[1], ARGV[1], count)
+return redis.call('HLEN', KEYS[1])
+"""
+
+# 更新商品：直接设置数量，数量不能超过库存
+# KEYS[1] 购物车key KEYS[2] 库存镜像key，ARGV[1] sku_id ARGV[2] 更新后的数量
+CART_UPDATE_SCRIPT = """
+local stock = redis.call('HGET', KEYS[2], ARGV[1])
+if not stock then
+    return -1
+end
+if tonumber(ARGV[2]) > tonumber(stock) then
+    return -2
+end
+redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+return redis.call('HLEN', KEYS[1])
+"""
+
+# 删除商品
+# KEYS[1] 购物车key，ARGV[1] sku_id
+CART_DELETE_SCRIPT = """
+redis.call('HDEL', KEYS[1], ARGV[1])
+return redis.call('HLEN', KEYS[1])
+"""
+
+# 注册后的脚本对象，第一次使用时注册，之后使用EVALSHA执行
+_scripts = {}
+
+
+def _get_script(conn, source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = conn.register_script(source)
+    return script
+
+
+def get_cart_key(user_id):
+    """用户购物车在redis中的key"""
+    return 'cart_%d' % user_id
+
+
+def get_cart_counts(conn, user_id, sku_ids=None):
+    """
+    获取用户购物车中商品的数量，返回{sku_id: count}
+        不传sku_ids时使用HGETALL获取整个购物车，否则使用HMGET获取指定商品，都只需要一次redis请求
+        不在购物车中的商品不会出现在结果中
+    """
+    cart_key = get_cart_key(user_id)
+    if sku_ids is None:
+        cart_dict = conn.hgetall(cart_key)
+    else:
+        sku_ids = list(sku_ids)
+        if not sku_ids:
+            return {}
+        cart_dict = dict(zip(sku_ids, conn.hmget(cart_key, sku_ids)))
+
+    counts = {}
+    for sku_id, count in cart_dict.items():
+        if count is None:
+            continue
+        counts[int(sku_id)] = int(count)
+    return counts
+
+
+def _run_stock_script(conn, source, user_id, sku_id, count):
+    """执行需要判断库存的脚本，库存镜像中没有该商品时从数据库加载后重新执行"""
+    script = _get_script(conn, source)
+    keys = [get_cart_key(user_id), SKU_STOCK_KEY]
+    res = script(keys=keys, args=[sku_id, count], client=conn)
+    if res == CART_STOCK_MISSING:
+        if not load_stock(conn, [sku_id]):
+            return CART_SKU_NOT_EXIST
+        res = script(keys=keys, args=[sku_id, count], client=conn)
+    return res
+
+
+def cart_add(conn, user_id, sku_id, count):
+    """
+    向购物车中添加商品，一次redis请求完成库存判断、修改数量和统计条目数
+        成功返回购物车中商品的条目数，失败返回CART_STOCK_NOT_ENOUGH或CART_SKU_NOT_EXIST
+    """
+    return _run_stock_script(conn, CART_ADD_SCRIPT, user_id, sku_id, count)
+
+
+def cart_update(conn, user_id, sku_id, count):
+    """
+    更新购物车中商品的数量
+        成功返回购物车中商品的条目数，失败返回CART_STOCK_NOT_ENOUGH或CART_SKU_NOT_EXIST
+    """
+    return _run_stock_script(conn, CART_UPDATE_SCRIPT, user_id, sku_id, count)
+
+
+def cart_delete(conn, user_id, sku_id):
+    """删除购物车中的商品，返回购物车中商品的条目数"""
+    script = _get_script(conn, CART_DELETE_SCRIPT)
+    return script(keys=[get_cart_key(user_id)], args=[sku_id], client=conn)
@@ -6,6 +6,8 @@ from apps.goods.models import *
 from django_redis import get_redis_connection
 from db.base_model import BaseModel
 from utils.Mixin import LoginRequiredMixin
+from apps.goods.sku_cache import get_sku_snapshots
+from apps.cart.utils import get_cart_counts, cart_add, cart_update, cart_delete, CART_STOCK_NOT_ENOUGH, CART_SKU_NOT_EXIST
 
 
 class CartAddView(View):
@@ -31,29 +33,24 @@ class CartAddView(View):
         except Exception as e:
             return JsonResponse({'errno': 2, 'error_msg': '商品数量合法'})
 
-        # 检验商品是否存在
+        # 检验商品id是否合法
         try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist:
+            sku_id = int(sku_id)
+        except Exception as e:
             return JsonResponse({'errno': 3, 'error_msg': '商品不存在'})
 
-        # 购物车添加商品
+        # 购物车添加商品，lua脚本中判断库存、累加数量并返回购物车中商品的条目数，只需要一次redis请求
         conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        cart_count = conn.hget(cart_key, sku_id)
-        # 在redis中查询到该sku_id键存在，则添加该键的商品数量
-        if cart_count:
-            count += int(cart_count)
+        total_count = cart_add(conn, user.id, sku_id, count)
+
+        if total_count == CART_SKU_NOT_EXIST:
+            return JsonResponse({'errno': 3, 'error_msg': '商品不存在'})
 
         # 判断该商品库存是否大于用户添加商品的数量
-        if count > sku.stock:
+        if total_count == CART_STOCK_NOT_ENOUGH:
             return JsonResponse({'errno': 4, 'error_msg': '商品库存不足'})
 
-        # 添加商品数目，没有查到则设置新的sku_id以及商品数量，hset方法有数据则更新，无则新增
-        conn.hset(cart_key, sku_id, count)
-
-        # 计算用户购物车商品的总数目，最后返回添加成功响应
-        total_count = conn.hlen(cart_key)
+        # 返回添加成功响应
         return JsonResponse({'errno': 'ok', 'total_count': total_count, 'error_msg': '添加成功'})
 
 
@@ -63,32 +60,27 @@ class CartInfoView(LoginRequiredMixin, View):
         # 获取登录的用户
         user = request.user
 
-        # 获取用户购物车商品信息
+        # 获取用户购物车商品信息，一次HGETALL取出所有商品的数量
         conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-        cart_dict = conn.hgetall(cart_key)
+        cart_counts = get_cart_counts(conn, user.id)
 
-        skus = []  # 存放查出来的商品信息对象
+        # 从商品快照缓存中批量获取购物车中所有的商品，已经删除的商品会被跳过
+        skus = get_sku_snapshots(cart_counts.keys())
         # 用于保存我的购物车中商品总件数以及总价格
         total_count = 0
         total_price = 0
 
-        # 获取商品id和商品数量
-        for sku_id, count in cart_dict.items():
-            # 根据sku_id获取商品信息
-            sku = GoodsSKU.objects.get(id=sku_id)
+        for sku in skus:
+            count = cart_counts[sku.id]
             # 计算小计
-            amount = sku.price*int(count)
+            amount = sku.price*count
             # 动态给sku对象添加属性，保存遍历获取的小计以及商品数量
             sku.amount = amount
-            sku.count = int(count)
-            # 将查询出来的商品信息对象保存到列表中
-            skus.append(sku)
+            sku.count = count
             # 累加计算商品总件数和总价格
-            total_count += int(count)
+            total_count += count
             total_price += amount
 
-
         context = {
             'skus': skus,
             'total_count': total_count,
@@ -119,23 +111,22 @@ class CartUpdateView(View):
             return JsonResponse({'res': 2, 'errmsg': '商品数目格式错误'})
 
         try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist as e:
+            sku_id = int(sku_id)
+        except Exception as e:
             return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
-        # 更新购物车数量
+        # 更新购物车数量，lua脚本中验证商品的库存，sku_id存在即更新，不存在则新建
         conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
+        total_count = cart_update(conn, user.id, sku_id, count)
 
-        # 验证商品的库存
-        if count > sku.stock:
-            return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
+        if total_count == CART_SKU_NOT_EXIST:
+            return JsonResponse({'res': 3, 'errmsg': '商品不存在'})
 
-        # sku_id存在即更新，不存在则新建
-        conn.hset(cart_key, sku_id, count)
+        if total_count == CART_STOCK_NOT_ENOUGH:
+            return JsonResponse({'res': 4, 'errmsg': '商品库存不足'})
 
         # 返回应答
-        return JsonResponse({'res': 5, 'errmsg': '更新成功'})
+        return JsonResponse({'res': 5, 'total_count': total_count, 'errmsg': '更新成功'})
 
 
 class CartDeleteView(View):
@@ -152,17 +143,9 @@ class CartDeleteView(View):
         if not sku_id:
             return JsonResponse({'res': 1, 'errmsg': '无效的商品id'})
 
-        try:
-            sku = GoodsSKU.objects.get(id=sku_id)
-        except GoodsSKU.DoesNotExist as e:
-            return JsonResponse({'res': 2, 'errmsg': '商品不存在'})
-
-        # 更新购物车数量
+        # 删除购物车中的记录，已经下架删除的商品也可以从购物车中删除
         conn = get_redis_connection('default')
-        cart_key = 'cart_%d' % user.id
-
-        # sku_id存在即更新，不存在则新建
-        conn.hdel(cart_key, sku_id)
+        total_count = cart_delete(conn, user.id, sku_id)
 
         # 返回应答
-        return JsonResponse({'res': 3, 'message': '删除成功'})
\ No newline at end of file
+        return JsonResponse({'res': 3, 'total_count': total_count, 'message': '删除成功'})
\ No newline at end of file
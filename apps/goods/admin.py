@@ -11,15 +11,22 @@ class BaseModelAdmin(admin.ModelAdmin):
         # 调用父类中的save_model方法让数据完成更新
         super(BaseModelAdmin, self).save_model(request, obj, form, change)
         # 向worker发出任务，重新生成更新数据后的页面
-        from celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()
+        from celery_tasks.tasks import schedule_static_index_html
+        schedule_static_index_html()
 
     def delete_model(self, request, obj):
         """对数据进行删除时会调用"""
         super(BaseModelAdmin, self).delete_model(request, obj)
         # 向worker发出任务，重新生成更新数据后的页面
-        from celery_tasks.tasks import generate_static_index_html
-        generate_static_index_html.delay()
+        from celery_tasks.tasks import schedule_static_index_html
+        schedule_static_index_html()
+
+    def delete_queryset(self, request, queryset):
+        """批量删除时会调用"""
+        super(BaseModelAdmin, self).delete_queryset(request, queryset)
+        # 向worker发出任务，重新生成更新数据后的页面
+        from celery_tasks.tasks import schedule_static_index_html
+        schedule_static_index_html()
 
 
 class GoodsTypeAdmin(BaseModelAdmin):
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class GoodsConfig(AppConfig):
     name = 'apps.goods'
+
+    def ready(self):
+        # 注册信号处理函数
+        import apps.goods.signals
@@ -0,0 +1,137 @@
+import time
+from django.core.cache import cache
+from apps.goods.models import GoodsType
+
+# 首页缓存的版本号，首页相关的模型类数据发生变化时版本号加1，旧版本的缓存自然失效
+INDEX_PAGE_VERSION_KEY = 'index_page_version'
+# 首页缓存数据，key中带有版本号
+INDEX_PAGE_DATA_KEY = 'index_page_data_%s'
+# 最近一次生成的首页缓存数据，重新生成期间其他进程读取这份旧数据
+INDEX_PAGE_STALE_KEY = 'index_page_data_stale'
+# 重新生成首页缓存数据时的锁，保证同一时间只有一个进程去查询数据库
+INDEX_PAGE_LOCK_KEY = 'index_page_lock_%s'
+
+# 版本号本身就能让缓存失效，过期时间只是兜底
+INDEX_PAGE_TIMEOUT = 60 * 60 * 24
+INDEX_PAGE_LOCK_TIMEOUT = 30
+# 没有旧数据可用时，等待其他进程生成缓存的最长时间
+INDEX_PAGE_WAIT_TIMEOUT = 3
+
+# 列表页每个种类商品的大概数目，只用于显示页码按钮
+LIST_COUNT_KEY = 'list_count_%d'
+# 列表页每个种类的缓存版本号，种类下的商品发生变化时加1，只让这个种类的列表页片段缓存失效
+LIST_VERSION_KEY = 'list_version_%d'
+# 列表页片段缓存的过期时间，版本号本身就能让缓存失效，过期时间只是兜底
+LIST_FRAGMENT_TIMEOUT = 60 * 60
+# 全部商品种类，key中带有首页缓存的版本号，商品种类发生变化时失效
+GOODS_TYPES_KEY = 'goods_types_%s'
+# 未登录用户访问的商品详情页整页缓存
+DETAIL_PAGE_KEY = 'detail_page_%d'
+DETAIL_PAGE_TIMEOUT = 60 * 60
+# 缓存的详情页中csrf_token的占位符
+DETAIL_PAGE_CSRF_PLACEHOLDER = '__detail_page_csrf_token__'
+
+
+def get_index_page_version():
+    """获取首页缓存当前的版本号"""
+    version = cache.get(INDEX_PAGE_VERSION_KEY)
+    if version is None:
+        # add只在key不存在时设置，多个进程同时初始化时不会互相覆盖
+        cache.add(INDEX_PAGE_VERSION_KEY, 1, None)
+        version = cache.get(INDEX_PAGE_VERSION_KEY, 1)
+    return version
+
+
+def bump_index_page_version():
+    """首页相关数据发生变化时调用，让当前版本的首页缓存失效"""
+    try:
+        cache.incr(INDEX_PAGE_VERSION_KEY)
+    except ValueError:
+        # 版本号不存在(缓存被清空)，重新初始化
+        cache.add(INDEX_PAGE_VERSION_KEY, 1, None)
+        cache.incr(INDEX_PAGE_VERSION_KEY)
+
+
+def get_index_page_data(build):
+    """
+    获取首页缓存数据，build为缓存不存在时生成数据的函数
+        缓存失效时只有拿到锁的进程调用build重新生成数据，其他进程继续使用上一个版本的数据
+        没有上一个版本的数据时(比如缓存被清空)，等待拿到锁的进程生成完毕，超时则自己生成
+    """
+    version = get_index_page_version()
+    data_key = INDEX_PAGE_DATA_KEY % version
+    context = cache.get(data_key)
+    if context is not None:
+        return context
+
+    lock_key = INDEX_PAGE_LOCK_KEY % version
+    if cache.add(lock_key, 1, INDEX_PAGE_LOCK_TIMEOUT):
+        try:
+            context = build()
+            cache.set(data_key, context, INDEX_PAGE_TIMEOUT)
+            cache.set(INDEX_PAGE_STALE_KEY, context, INDEX_PAGE_TIMEOUT)
+        finally:
+            cache.delete(lock_key)
+        return context
+
+    # 其他进程正在生成，先返回旧版本的数据
+    context = cache.get(INDEX_PAGE_STALE_KEY)
+    if context is not None:
+        return context
+
+    deadline = time.time() + INDEX_PAGE_WAIT_TIMEOUT
+    while time.time() < deadline:
+        time.sleep(0.05)
+        context = cache.get(data_key)
+        if context is not None:
+            return context
+
+    return build()
+
+
+def get_goods_types():
+    """获取全部商品种类，和首页缓存使用同一个版本号"""
+    key = GOODS_TYPES_KEY % get_index_page_version()
+    types = cache.get(key)
+    if types is None:
+        types = list(GoodsType.objects.all())
+        cache.set(key, types, INDEX_PAGE_TIMEOUT)
+    return types
+
+
+def get_list_version(type_id):
+    """获取种类列表页缓存当前的版本号"""
+    key = LIST_VERSION_KEY % type_id
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, 1, None)
+        version = cache.get(key, 1)
+    return version
+
+
+def bump_list_versions(type_ids):
+    """种类下的商品发生变化时调用，让这些种类的列表页缓存失效"""
+    for type_id in set(type_ids):
+        key = LIST_VERSION_KEY % type_id
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, 1, None)
+            cache.incr(key)
+
+
+def get_detail_page(sku_id):
+    """获取缓存的商品详情页，{version, content, etag, last_modified}"""
+    return cache.get(DETAIL_PAGE_KEY % sku_id)
+
+
+def set_detail_page(sku_id, page):
+    cache.set(DETAIL_PAGE_KEY % sku_id, page, DETAIL_PAGE_TIMEOUT)
+
+
+def invalidate_detail_pages(sku_ids):
+    """商品、商品SPU、商品图片或者评论发生变化，清除商品详情页缓存"""
+    keys = [DETAIL_PAGE_KEY % int(sku_id) for sku_id in sku_ids]
+    if keys:
+        cache.delete_many(keys)
+
@@ -0,0 +1,67 @@
+import math
+from django.core.cache import cache
+from apps.order.models import OrderGoods
+
+'''
+商品评论分页
+    评论按照订单商品的创建时间倒序分页，使用OrderGoods上的(sku, create_time)索引
+    第一页和评论总数按商品缓存，用户提交评论时清除
+'''
+
+# 每页显示的评论条数
+COMMENT_PAGE_SIZE = 10
+COMMENT_FIRST_PAGE_KEY = 'sku_comments_%d'
+COMMENT_COUNT_KEY = 'sku_comment_count_%d'
+COMMENT_CACHE_TIMEOUT = 60 * 60
+
+
+def query_comments(sku_id):
+    """商品的所有评论，最新的在前"""
+    return OrderGoods.objects.filter(sku_id=sku_id).exclude(comment='').order_by('-create_time', '-id')
+
+
+def load_comments(sku_id, page):
+    """从数据库查询第page页的评论，返回字典列表，不需要创建模型对象"""
+    offset = (page - 1) * COMMENT_PAGE_SIZE
+    comments = query_comments(sku_id).values('comment', 'update_time', 'order__user__username')
+    return [{
+        'comment': comment['comment'],
+        'update_time': comment['update_time'],
+        'username': comment['order__user__username'],
+    } for comment in comments[offset:offset + COMMENT_PAGE_SIZE]]
+
+
+def get_comment_count(sku_id):
+    """商品的评论总数，按商品缓存"""
+    key = COMMENT_COUNT_KEY % sku_id
+    count = cache.get(key)
+    if count is None:
+        count = query_comments(sku_id).count()
+        cache.set(key, count, COMMENT_CACHE_TIMEOUT)
+    return count
+
+
+def get_comments(sku_id, page=1):
+    """
+    获取第page页的评论，返回(评论列表, 总页数)
+        第一页按商品缓存，其他页直接查询数据库
+    """
+    num_pages = max(math.ceil(get_comment_count(sku_id) / COMMENT_PAGE_SIZE), 1)
+    if page != 1:
+        return load_comments(sku_id, page), num_pages
+
+    key = COMMENT_FIRST_PAGE_KEY % sku_id
+    comments = cache.get(key)
+    if comments is None:
+        comments = load_comments(sku_id, 1)
+        cache.set(key, comments, COMMENT_CACHE_TIMEOUT)
+    return comments, num_pages
+
+
+def invalidate_comments(sku_ids):
+    """商品有了新的评论，清除评论第一页和总数的缓存"""
+    keys = []
+    for sku_id in sku_ids:
+        keys.extend([COMMENT_FIRST_PAGE_KEY % int(sku_id), COMMENT_COUNT_KEY % int(sku_id)])
+    if keys:
+        cache.delete_many(keys)
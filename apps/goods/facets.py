@@ -0,0 +1,83 @@
+from django.core.cache import cache
+from django.db.models import Count
+from apps.goods.models import GoodsSKU
+from apps.goods.search import SearchResultList, PRICE_RANGES, SEARCH_MAX_HITS, price_q
+
+'''
+搜索结果的分面统计
+    haystack的whoosh后端不支持分面，在数据库中对全部搜索结果(最多SEARCH_MAX_HITS个)按照种类分组计数，
+    按照价格区间条件计数，两条查询
+    种类的计数带上价格区间的筛选条件，价格区间的计数带上种类的筛选条件，点击后的结果数目和显示的一致
+    空搜索词统计全部商品，筛选结果最多SEARCH_MAX_HITS个，计数也不超过SEARCH_MAX_HITS
+    分面统计按照(搜索词, 筛选条件)缓存，不带版本号，索引频繁更新时计数可以稍微滞后
+    空搜索词和最常用的搜索词由celery定时任务precompute_search_facets提前计算好
+'''
+
+# 分面统计，(搜索词摘要, 种类, 价格区间)
+SEARCH_FACETS_KEY = 'search_facets_%s_%s_%s'
+SEARCH_FACETS_TIMEOUT = 60
+# 提前计算的分面统计的过期时间，大于定时任务的间隔
+SEARCH_FACETS_PRECOMPUTED_TIMEOUT = 60 * 10
+# 搜索词的次数，redis有序集合{搜索词: 次数}
+SEARCH_QUERIES_KEY = 'search_queries'
+# 提前计算的常用搜索词的数目
+SEARCH_FACETS_PRECOMPUTE = 20
+# 有序集合中最多保留的搜索词数目
+SEARCH_QUERIES_MAX = 1000
+
+
+def count_facets(results):
+    """
+    统计搜索结果的分面，返回{types: {种类id: 数目}, prices: [每个价格区间的数目]}
+    """
+    hit_ids = results.hit_ids()
+    skus = GoodsSKU.objects.all()
+    if hit_ids is not None:
+        skus = skus.filter(id__in=hit_ids)
+
+    type_skus = skus
+    if results.price is not None:
+        type_skus = type_skus.filter(price_q(results.price))
+    types = dict(type_skus.values_list('type_id').annotate(Count('id')).order_by())
+
+    price_skus = skus
+    if results.type_id is not None:
+        price_skus = price_skus.filter(type_id=results.type_id)
+    counts = price_skus.aggregate(**{
+        'price_%d' % price: Count('id', filter=price_q(price)) for price in range(len(PRICE_RANGES))
+    })
+    prices = [counts['price_%d' % price] for price in range(len(PRICE_RANGES))]
+
+    if hit_ids is None:
+        # 和SearchResultList.filtered_ids一样只取前SEARCH_MAX_HITS个
+        types = {type_id: min(count, SEARCH_MAX_HITS) for type_id, count in types.items()}
+        prices = [min(count, SEARCH_MAX_HITS) for count in prices]
+    return {'types': types, 'prices': prices}
+
+
+def get_facets(results):
+    """获取搜索结果的分面统计，先查询缓存"""
+    key = SEARCH_FACETS_KEY % (results.digest, results.type_id, results.price)
+    facets = cache.get(key)
+    if facets is None:
+        facets = count_facets(results)
+        cache.set(key, facets, SEARCH_FACETS_TIMEOUT)
+    return facets
+
+
+def record_query(conn, query):
+    """搜索词的次数加1，用于挑选提前计算分面统计的常用搜索词"""
+    if query:
+        conn.zincrby(SEARCH_QUERIES_KEY, 1, query)
+
+
+def precompute_facets(conn):
+    """计算空搜索词和最常用的搜索词在没有筛选条件时的分面统计，返回计算的搜索词数目"""
+    queries = [query.decode() for query in conn.zrevrange(SEARCH_QUERIES_KEY, 0, SEARCH_FACETS_PRECOMPUTE - 1)]
+    for query in [''] + queries:
+        results = SearchResultList(query)
+        cache.set(SEARCH_FACETS_KEY % (results.digest, None, None), count_facets(results),
+                  SEARCH_FACETS_PRECOMPUTED_TIMEOUT)
+    # 只保留次数最多的搜索词，有序集合不会无限增长
+    conn.zremrangebyrank(SEARCH_QUERIES_KEY, 0, -SEARCH_QUERIES_MAX - 1)
+    return len(queries) + 1
@@ -0,0 +1,38 @@
+from apps.goods.models import GoodsType, IndexGoodsBanner, IndexPromotionBanner, IndexTypeGoodsBanner
+
+
+def load_index_page_data():
+    """
+    查询首页展示的数据，首页视图和celery生成静态首页共用
+        分类商品展示信息一次查询出来(同时查询出sku)，再在内存中按照种类和展示类型分组
+        不管有多少商品种类，查询数据库的次数都是固定的
+    """
+    # 获取商品的种类信息
+    types = list(GoodsType.objects.all())
+
+    # 获取轮播图信息
+    banners = list(IndexGoodsBanner.objects.all().order_by('index'))
+
+    # 获取促销信息
+    promotion_banners = list(IndexPromotionBanner.objects.all().order_by('index'))
+
+    # 获取首页分类商品展示信息，按照种类id分组
+    image_banners = {}
+    title_banners = {}
+    type_banners = IndexTypeGoodsBanner.objects.select_related('sku').order_by('index')
+    for banner in type_banners:
+        if banner.display_type == 1:
+            image_banners.setdefault(banner.type_id, []).append(banner)
+        else:
+            title_banners.setdefault(banner.type_id, []).append(banner)
+
+    for type in types:
+        type.image_banners = image_banners.get(type.id, [])
+        type.title_banners = title_banners.get(type.id, [])
+
+    return {
+        'types': types,
+        'goods_banners': banners,
+        'promotion_banners': promotion_banners,
+    }
+
@@ -0,0 +1,99 @@
+import os
+import time
+import random
+import shutil
+import tempfile
+import tracemalloc
+from django.core.management.base import BaseCommand
+from haystack.backends.whoosh_backend import WhooshSearchBackend
+from apps.goods.models import Goods, GoodsSKU
+from apps.goods.search_indexes import GoodsSKUIndex
+from apps.goods.management.commands.bench_suggest import ORIGINS, ITEMS, SPECS
+from utils.ngram_backend import NgramSearchBackend
+
+try:
+    from jieba.analyse import ChineseAnalyzer
+except ImportError:
+    ChineseAnalyzer = None
+
+DETAILS = ['新鲜采摘，产地直发', '冷链配送，坏果包赔', '当季水果，香甜多汁', '肉质紧实，适合家庭烹饪']
+
+
+class ChineseWhooshBackend(WhooshSearchBackend):
+    """和线上一样使用jieba分词的whoosh后端"""
+
+    def build_schema(self, fields):
+        content_field_name, schema = super(ChineseWhooshBackend, self).build_schema(fields)
+        if ChineseAnalyzer is not None:
+            schema[content_field_name].analyzer = ChineseAnalyzer()
+        return content_field_name, schema
+
+
+class Command(BaseCommand):
+    help = '二元分词索引和whoosh的基准测试：在相同的生成数据上比较建立索引的耗时、查询延迟、索引大小和内存'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skus', type=int, default=20000, help='商品sku数目')
+        parser.add_argument('--queries', type=int, default=1000, help='查询次数')
+        parser.add_argument('--batch-size', type=int, default=1000, help='每批写入索引的商品数目')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        skus = self.make_skus(rnd, options['skus'])
+        queries = [rnd.choice([rnd.choice(ITEMS), rnd.choice(ORIGINS) + rnd.choice(ITEMS),
+                               rnd.choice(ITEMS) + ' ' + rnd.choice(SPECS), rnd.choice(DETAILS)[:4]])
+                   for i in range(options['queries'])]
+
+        self.stdout.write('%-8s %10s %10s %10s %10s %10s %10s %10s' % (
+            'backend', 'build(s)', 'docs/s', 'disk(MB)', 'heap(MB)', 'avg(ms)', 'p50(ms)', 'p99(ms)'))
+        for name, backend_class in (('whoosh', ChineseWhooshBackend), ('ngram', NgramSearchBackend)):
+            path = tempfile.mkdtemp(prefix='bench_%s_' % name)
+            try:
+                self.bench(name, backend_class, path, skus, queries, options['batch_size'])
+            finally:
+                shutil.rmtree(path, ignore_errors=True)
+
+    def make_skus(self, rnd, num):
+        """生成不保存到数据库的商品，索引模板只用到名称、简介和商品SPU的详情"""
+        goods = [Goods(id=i + 1, name='商品%d' % i, detail='<p>%s</p>' % rnd.choice(DETAILS)) for i in range(100)]
+        skus = []
+        for i in range(num):
+            name = '%s%s %s' % (rnd.choice(ORIGINS), rnd.choice(ITEMS), rnd.choice(SPECS))
+            sku = GoodsSKU(id=i + 1, name=name, desc='%s，%s' % (rnd.choice(ITEMS), rnd.choice(DETAILS)))
+            sku.goods = rnd.choice(goods)
+            skus.append(sku)
+        return skus
+
+    def bench(self, name, backend_class, path, skus, queries, batch_size):
+        index = GoodsSKUIndex()
+        backend = backend_class('default', PATH=path)
+
+        start = time.perf_counter()
+        for i in range(0, len(skus), batch_size):
+            backend.update(index, skus[i:i + batch_size])
+        build_cost = time.perf_counter() - start
+
+        disk = sum(os.path.getsize(os.path.join(root, file))
+                   for root, dirs, files in os.walk(path) for file in files)
+
+        # 新的后端对象，模拟web进程打开索引，统计打开和第一次查询分配的python内存
+        tracemalloc.start()
+        backend = backend_class('default', PATH=path)
+        if isinstance(backend, NgramSearchBackend):
+            NgramSearchBackend._readers.clear()
+            NgramSearchBackend._writers.clear()
+        backend.search(queries[0], end_offset=20)
+        heap = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        costs = []
+        for query in queries:
+            start = time.perf_counter()
+            backend.search(query, end_offset=20)
+            costs.append(time.perf_counter() - start)
+        costs.sort()
+
+        self.stdout.write('%-8s %10.2f %10.0f %10.1f %10.1f %10.2f %10.2f %10.2f' % (
+            name, build_cost, len(skus) / build_cost, disk / 1024 / 1024, heap / 1024 / 1024,
+            sum(costs) / len(costs) * 1000, costs[len(costs) // 2] * 1000, costs[int(len(costs) * 0.99)] * 1000))
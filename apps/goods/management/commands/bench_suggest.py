@@ -0,0 +1,66 @@
+import time
+import random
+import tracemalloc
+from django.core.management.base import BaseCommand
+from apps.goods.suggest import SuggestIndex, SKU, SPU, pinyin_initials, normalize
+
+ORIGINS = ['进口', '国产', '新疆', '山东', '云南', '海南', '东北', '智利', '新西兰', '泰国']
+ITEMS = ['草莓', '苹果', '香蕉', '葡萄', '橙子', '猕猴桃', '车厘子', '芒果', '大虾', '扇贝',
+         '带鱼', '牛排', '羊肉', '猪肉', '鸡蛋', '鸭蛋', '白菜', '西红柿', '土豆', '蘑菇']
+SPECS = ['500g', '1kg', '2.5kg', '礼盒装', '6个装', '家庭装', '精选', '特级']
+
+
+class Command(BaseCommand):
+    help = '输入提示前缀索引的基准测试：建立索引的耗时和内存、前缀查询和增量更新的耗时，使用生成的商品名称'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--skus', type=int, default=100000, help='商品sku数目')
+        parser.add_argument('--spus', type=int, default=5000, help='商品spu数目')
+        parser.add_argument('--lookups', type=int, default=10000, help='前缀查询次数')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        spus = ['%s%s%d号' % (rnd.choice(ORIGINS), rnd.choice(ITEMS), i) for i in range(options['spus'])]
+        items = [(SPU, i, name, 0) for i, name in enumerate(spus)]
+        items += [(SKU, i, '%s %s' % (rnd.choice(spus), rnd.choice(SPECS)), rnd.randint(0, 10000))
+                  for i in range(options['skus'])]
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        index = SuggestIndex().build(items)
+        build_cost = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        self.stdout.write('条目: %d, key: %d, 建立索引: %.2f秒, 内存: %.1fMB' % (
+            len(index), len(index.keys), build_cost, memory / 1024 / 1024))
+
+        # 前缀取自真实的名称和拼音首字母，长度1到6
+        prefixes = []
+        for i in range(options['lookups']):
+            name = normalize(rnd.choice(items)[2])
+            initials = normalize(pinyin_initials(name))
+            key = initials if initials and rnd.random() < 0.3 else name
+            prefixes.append(key[:rnd.randint(1, 6)])
+
+        self.stdout.write('%-12s %10s %10s %10s' % ('lookup', 'avg(us)', 'p50(us)', 'p99(us)'))
+        self.bench('cold', index, prefixes)
+        self.bench('warm', index, prefixes)
+
+        num = 1000
+        start = time.perf_counter()
+        for i in range(num):
+            kind, item_id, name, sales = items[len(spus) + rnd.randrange(options['skus'])]
+            index.update(kind, item_id, name, sales + 1)
+        self.stdout.write('增量更新: %.1fus/次' % ((time.perf_counter() - start) / num * 10 ** 6))
+
+    def bench(self, name, index, prefixes):
+        costs = []
+        for prefix in prefixes:
+            start = time.perf_counter()
+            index.suggest(prefix)
+            costs.append(time.perf_counter() - start)
+        costs.sort()
+        self.stdout.write('%-12s %10.1f %10.1f %10.1f' % (
+            name, sum(costs) / len(costs) * 10 ** 6, costs[len(costs) // 2] * 10 ** 6,
+            costs[int(len(costs) * 0.99)] * 10 ** 6))
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from apps.goods.models import GoodsType
+from apps.goods.sales import rebuild_sales
+
+
+class Command(BaseCommand):
+    help = '从数据库重新生成每个种类在redis中的商品销量排行'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--type', type=int, nargs='+', dest='type_ids', help='只重新生成这些种类，默认全部种类')
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+        type_ids = options['type_ids'] or GoodsType.objects.values_list('id', flat=True)
+        for type_id in type_ids:
+            num = rebuild_sales(conn, type_id)
+            if num is None:
+                self.stdout.write('种类%d: 其他进程正在重新生成' % type_id)
+            else:
+                self.stdout.write('种类%d: %d个商品' % (type_id, num))
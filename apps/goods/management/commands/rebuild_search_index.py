@@ -0,0 +1,32 @@
+import time
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from apps.goods.search_rebuild import update_since, rebuild_all, SEARCH_REBUILD_BATCH
+
+
+class Command(BaseCommand):
+    help = '重建商品的全文索引，默认只更新上次重建之后修改过的商品，没有重建过时全量重建'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='全量重建，多个进程并行写入后合并')
+        parser.add_argument('--workers', type=int, help='全量重建的进程数，默认为CPU核数')
+        parser.add_argument('--batch-size', type=int, default=SEARCH_REBUILD_BATCH, help='每批写入索引的商品数目')
+        parser.add_argument('--using', default='default', help='haystack的连接名')
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+        using = options['using']
+        batch_size = options['batch_size']
+
+        started = time.time()
+        count = None
+        mode = '增量'
+        if not options['full']:
+            count = update_since(conn, using, batch_size)
+        if count is None:
+            mode = '全量'
+            count = rebuild_all(conn, using, options['workers'], batch_size)
+        elapsed = time.time() - started
+
+        self.stdout.write('%s重建: %d个商品，用时%.2f秒，%.0f个/秒' % (
+            mode, count, elapsed, count / elapsed if elapsed else 0))
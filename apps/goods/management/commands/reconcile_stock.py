@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand, CommandError
+from django_redis import get_redis_connection
+from apps.goods.models import GoodsSKU
+from apps.goods.stock import *
+
+
+class Command(BaseCommand):
+    help = '检查redis库存镜像和数据库库存是否一致，--repair时按照数据库修复镜像'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repair', action='store_true', help='修复不一致的镜像库存')
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+
+        # 先把待写回的数量写回数据库，再拿锁防止对账期间写回
+        flush_pending_stock(conn)
+        owner = acquire_flush_lock(conn)
+        if owner is None:
+            raise CommandError('库存正在写回数据库，请稍后重试')
+
+        try:
+            drifts = 0
+            for sku_id, stock in GoodsSKU.objects.values_list('id', 'stock').order_by('id').iterator():
+                # 同一个事务中读取，预扣脚本不会在中间执行
+                pipe = conn.pipeline(transaction=True)
+                pipe.hget(SKU_STOCK_KEY, sku_id)
+                pipe.hget(SKU_STOCK_PENDING_KEY, sku_id)
+                pipe.hget(SKU_STOCK_FLUSHING_KEY, sku_id)
+                mirror, pending, flushing = pipe.execute()
+                if mirror is None:
+                    # 没有用到过的商品，用到时会从数据库加载
+                    continue
+
+                expected = stock - int(pending or 0) - int(flushing or 0)
+                if int(mirror) == expected:
+                    continue
+
+                drifts += 1
+                self.stdout.write('商品%d: 数据库库存%d 待写回%d 正在写回%d 镜像库存%s 应为%d' % (
+                    sku_id, stock, int(pending or 0), int(flushing or 0), int(mirror), expected))
+                if options['repair']:
+                    set_stock(conn, sku_id, stock)
+
+            # 镜像中有、数据库中已经删除的商品
+            sku_ids = set(GoodsSKU.objects.values_list('id', flat=True))
+            for sku_id in conn.hkeys(SKU_STOCK_KEY):
+                if int(sku_id) not in sku_ids:
+                    drifts += 1
+                    self.stdout.write('商品%d: 数据库中已经删除' % int(sku_id))
+                    if options['repair']:
+                        delete_stock(conn, int(sku_id))
+        finally:
+            release_flush_lock(conn, owner)
+
+        if options['repair']:
+            self.stdout.write('修复了%d个商品' % drifts)
+        else:
+            self.stdout.write('发现%d个商品不一致' % drifts)
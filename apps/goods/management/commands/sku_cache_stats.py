@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django_redis import get_redis_connection
+from apps.goods.sku_cache import SKU_CACHE_STATS_KEY, SKU_CACHE_L1_SIZE
+
+
+class Command(BaseCommand):
+    help = '显示所有进程的商品快照缓存命中统计，用于调整一级缓存的大小'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='显示后清空统计')
+
+    def handle(self, *args, **options):
+        conn = get_redis_connection('default')
+        stats = {name.decode(): int(num) for name, num in conn.hgetall(SKU_CACHE_STATS_KEY).items()}
+        l1_hits = stats.get('l1_hits', 0)
+        l2_hits = stats.get('l2_hits', 0)
+        misses = stats.get('misses', 0)
+        total = l1_hits + l2_hits + misses
+
+        self.stdout.write('一级缓存大小: %d' % SKU_CACHE_L1_SIZE)
+        self.stdout.write('查询次数: %d' % total)
+        if total:
+            self.stdout.write('一级缓存命中: %d (%.1f%%)' % (l1_hits, 100.0 * l1_hits / total))
+            self.stdout.write('二级缓存命中: %d (%.1f%%)' % (l2_hits, 100.0 * l2_hits / total))
+            self.stdout.write('未命中: %d (%.1f%%)' % (misses, 100.0 * misses / total))
+
+        if options['reset']:
+            conn.delete(SKU_CACHE_STATS_KEY)
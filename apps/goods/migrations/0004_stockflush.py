@@ -0,0 +1,28 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:49
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('goods', '0003_remove_indexgoodsbanner_sku'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockFlush',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('create_time', models.DateTimeField(auto_now_add=True, verbose_name='创建时间')),
+                ('update_time', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+                ('is_time', models.BooleanField(default=False, verbose_name='删除标记')),
+                ('batch_id', models.CharField(max_length=32, unique=True, verbose_name='批次id')),
+            ],
+            options={
+                'verbose_name': '库存写回批次',
+                'verbose_name_plural': '库存写回批次',
+                'db_table': 'df_goods_stock_flush',
+            },
+        ),
+    ]
@@ -42,6 +42,16 @@ class GoodsSKU(BaseModel):
         verbose_name_plural = verbose_name
 
 
+class StockFlush(BaseModel):
+    '''redis预扣库存写回数据库的批次，和库存的修改在同一个事务中写入，同一批次不会重复写回'''
+    batch_id = models.CharField(max_length=32, unique=True, verbose_name='批次id')
+
+    class Meta:
+        db_table = 'df_goods_stock_flush'
+        verbose_name = '库存写回批次'
+        verbose_name_plural = verbose_name
+
+
 class Goods(BaseModel):
     '''商品SPU模型类'''
     name = models.CharField(max_length=20, verbose_name='商品SPU名称')
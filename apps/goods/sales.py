@@ -0,0 +1,216 @@
+import uuid
+from apps.goods.models import GoodsSKU
+from apps.goods.sku_cache import get_sku_snapshots
+from apps.goods.stock import SKU_STOCK_PENDING_KEY, SKU_STOCK_FLUSHING_KEY
+
+'''
+商品销量排行，每个种类一个redis有序集合{sku_id: 销量}
+    订单提交成功后用ZINCRBY累加销量，列表页按照人气排序时用ZREVRANGE分页，不需要在数据库中按照sales排序
+    生成标记不存在时(比如redis数据被清空、被淘汰)从数据库重新生成，也可以用rebuild_sales命令重新生成
+    有序集合不存在时累加销量、加入商品都跳过，不会生成只有几个商品的排行，种类下没有商品时例外
+    重新生成期间的累加记录在增量集合中，生成完毕后和新的排行合并，不会丢失
+    同一个种类同时只有一个进程重新生成，其他请求使用原来的排行，没有排行时在数据库中按照销量排序
+'''
+
+SKU_SALES_KEY = 'sku_sales_%d'
+# 重新生成时先写入临时的key，生成完毕后和增量合并替换
+SKU_SALES_TMP_KEY = 'sku_sales_tmp_%d'
+# 重新生成期间累加的销量
+SKU_SALES_DELTA_KEY = 'sku_sales_delta_%d'
+# 正在重新生成的锁，值是持有者的随机id，进程崩溃时自动过期
+SKU_SALES_REBUILDING_KEY = 'sku_sales_rebuilding_%d'
+SKU_SALES_REBUILDING_TIMEOUT = 60 * 5
+# 从数据库生成过的标记，不存在时需要重新生成，值为0表示生成时种类下没有商品
+SKU_SALES_BUILT_KEY = 'sku_sales_built_%d'
+# 每次ZADD的商品数目
+SKU_SALES_BATCH = 1000
+# 有序集合的成员是补齐位数的sku_id，销量相同时按照字符串倒序就是按照id倒序
+SKU_SALES_MEMBER = '%010d'
+
+# 累加商品销量，排行不存在时跳过，正在重新生成时同时记录到增量中
+# KEYS[1] 排行 KEYS[2] 正在重新生成 KEYS[3] 增量，ARGV[1] 商品 ARGV[2] 销量
+SALES_INCR_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('ZINCRBY', KEYS[1], ARGV[2], ARGV[1])
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('ZINCRBY', KEYS[3], ARGV[2], ARGV[1])
+end
+return 0
+"""
+
+# 加入商品，已经在排行中的不覆盖销量，排行不存在时跳过(空的种类除外)，正在重新生成时在增量中加入销量为0的成员
+# KEYS[1] 排行 KEYS[2] 正在重新生成 KEYS[3] 增量 KEYS[4] 生成过的标记，ARGV[1] 商品 ARGV[2] 销量
+SALES_ADD_SCRIPT = """
+local empty = redis.call('GET', KEYS[4]) == '0'
+if empty or redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('ZADD', KEYS[1], 'NX', ARGV[2], ARGV[1])
+end
+if empty then
+    redis.call('SET', KEYS[4], 1)
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('ZINCRBY', KEYS[3], 0, ARGV[1])
+end
+return 0
+"""
+
+# 获取重新生成的锁，清除上一次没有完成的临时排行和增量，返回是否获取到
+# KEYS[1] 正在重新生成 KEYS[2] 临时的排行 KEYS[3] 增量，ARGV[1] 持有者 ARGV[2] 过期秒数
+SALES_LOCK_SCRIPT = """
+if not redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return 0
+end
+redis.call('DEL', KEYS[2], KEYS[3])
+return 1
+"""
+
+# 重新生成完毕，临时的排行和增量合并后替换原来的排行，锁已经过期被其他进程获取时放弃，返回-1
+# KEYS[1] 排行 KEYS[2] 临时的排行 KEYS[3] 增量 KEYS[4] 正在重新生成 KEYS[5] 生成过的标记，ARGV[1] 持有者
+SALES_REPLACE_SCRIPT = """
+if redis.call('GET', KEYS[4]) ~= ARGV[1] then
+    return -1
+end
+redis.call('ZUNIONSTORE', KEYS[1], 2, KEYS[2], KEYS[3])
+redis.call('DEL', KEYS[2], KEYS[3], KEYS[4])
+local count = redis.call('ZCARD', KEYS[1])
+redis.call('SET', KEYS[5], math.min(count, 1))
+return count
+"""
+
+# 重新生成失败，释放自己持有的锁
+# KEYS[1] 正在重新生成，ARGV[1] 持有者
+SALES_UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_scripts = {}
+
+
+def _get_script(conn, source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = conn.register_script(source)
+    return script
+
+
+def _type_keys(type_id):
+    return [SKU_SALES_KEY % type_id, SKU_SALES_REBUILDING_KEY % type_id, SKU_SALES_DELTA_KEY % type_id]
+
+
+def add_sales(conn, sales):
+    """订单提交成功，累加商品销量，sales为[(type_id, sku_id, count)]"""
+    script = _get_script(conn, SALES_INCR_SCRIPT)
+    pipe = conn.pipeline(transaction=False)
+    for type_id, sku_id, count in sales:
+        script(keys=_type_keys(type_id), args=[SKU_SALES_MEMBER % sku_id, count], client=pipe)
+    pipe.execute()
+
+
+def add_sku(conn, type_id, sku_id, sales, old_type_id=None):
+    """商品保存，加入所在种类的排行，已经在排行中的不覆盖销量；商品换了种类时从原来的种类中移除"""
+    if old_type_id is not None and old_type_id != type_id:
+        remove_sku(conn, old_type_id, sku_id)
+    script = _get_script(conn, SALES_ADD_SCRIPT)
+    script(keys=_type_keys(type_id) + [SKU_SALES_BUILT_KEY % type_id], args=[SKU_SALES_MEMBER % sku_id, sales], client=conn)
+
+
+def remove_sku(conn, type_id, sku_id):
+    """商品删除，从所在种类的排行中移除，正在重新生成时也从临时的排行和增量中移除"""
+    member = SKU_SALES_MEMBER % sku_id
+    pipe = conn.pipeline(transaction=False)
+    for key in (SKU_SALES_KEY, SKU_SALES_TMP_KEY, SKU_SALES_DELTA_KEY):
+        pipe.zrem(key % type_id, member)
+    pipe.execute()
+
+
+def rebuild_sales(conn, type_id):
+    """
+    从数据库重新生成种类的销量排行，返回商品数目
+        redis库存模式下还没有写回数据库的销量也要算上
+        其他进程正在重新生成时不重复生成，返回None
+    """
+    tmp_key = SKU_SALES_TMP_KEY % type_id
+    delta_key = SKU_SALES_DELTA_KEY % type_id
+    rebuilding_key = SKU_SALES_REBUILDING_KEY % type_id
+    owner = uuid.uuid4().hex
+    # 先获取锁，之后累加的销量记录到增量中
+    script = _get_script(conn, SALES_LOCK_SCRIPT)
+    if not script(keys=[rebuilding_key, tmp_key, delta_key], args=[owner, SKU_SALES_REBUILDING_TIMEOUT], client=conn):
+        return None
+
+    try:
+        unflushed = {}
+        for key in (SKU_STOCK_PENDING_KEY, SKU_STOCK_FLUSHING_KEY):
+            for sku_id, count in conn.hgetall(key).items():
+                unflushed[int(sku_id)] = unflushed.get(int(sku_id), 0) + int(count)
+
+        sales = GoodsSKU.objects.filter(type_id=type_id).values_list('id', 'sales').order_by('id')
+        num = 0
+        pipe = conn.pipeline(transaction=False)
+        for sku_id, count in sales.iterator():
+            pipe.zadd(tmp_key, {SKU_SALES_MEMBER % sku_id: count + unflushed.get(sku_id, 0)})
+            num += 1
+            if num % SKU_SALES_BATCH == 0:
+                pipe.execute()
+        pipe.execute()
+    except Exception:
+        _get_script(conn, SALES_UNLOCK_SCRIPT)(keys=[rebuilding_key], args=[owner], client=conn)
+        raise
+
+    script = _get_script(conn, SALES_REPLACE_SCRIPT)
+    keys = [SKU_SALES_KEY % type_id, tmp_key, delta_key, rebuilding_key, SKU_SALES_BUILT_KEY % type_id]
+    count = script(keys=keys, args=[owner], client=conn)
+    return None if count < 0 else count
+
+
+class HotSKUList(object):
+    """
+    种类下按照销量从高到低排列的商品，可以交给Paginator分页
+        count使用ZCARD，切片使用ZREVRANGE，商品数据从商品快照缓存中获取
+        其他进程正在重新生成并且还没有排行时，在数据库中按照销量排序
+    """
+
+    def __init__(self, conn, type_id):
+        self.conn = conn
+        self.type_id = type_id
+        self.key = SKU_SALES_KEY % type_id
+        self.queryset = None
+
+    def count(self):
+        pipe = self.conn.pipeline(transaction=False)
+        pipe.zcard(self.key)
+        pipe.get(SKU_SALES_BUILT_KEY % self.type_id)
+        count, built = pipe.execute()
+        # 生成过的种类排行为空时，只有生成时种类下没有商品才不需要重新生成，否则是排行被淘汰了
+        if built is None or (not count and built != b'0'):
+            rebuilt = rebuild_sales(self.conn, self.type_id)
+            if rebuilt is not None:
+                count = rebuilt
+            elif not count:
+                # 和有序集合的顺序一致，销量相同时按照id倒序
+                self.queryset = GoodsSKU.objects.filter(type_id=self.type_id).order_by('-sales', '-id')
+                count = self.queryset.count()
+        return count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        if index.stop is None:
+            stop = -1
+        else:
+            stop = index.stop - 1
+            if stop < start:
+                return []
+        if self.queryset is not None:
+            sku_ids = self.queryset.values_list('id', flat=True)[start:index.stop]
+        else:
+            sku_ids = self.conn.zrevrange(self.key, start, stop)
+        return get_sku_snapshots(sku_ids)
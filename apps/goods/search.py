@@ -0,0 +1,180 @@
+import hashlib
+from django.core.cache import cache
+from django.db.models import Q
+from haystack.query import SearchQuerySet
+from apps.goods.models import GoodsSKU
+from apps.goods.sku_cache import get_sku_snapshots
+
+'''
+商品搜索结果的缓存
+    按照规范化后的搜索词缓存结果总数和每一页的sku_id列表，过期时间很短
+    商品数据从商品快照缓存中批量获取，不再逐个加载搜索结果的object
+    索引更新后(search_queue批量更新、search_rebuild重建)版本号加1，旧版本的缓存自然失效
+    按照种类、价格区间筛选时，在数据库中筛选全文检索的结果，筛选后的sku_id列表整个缓存
+    搜索词为空时筛选的是全部商品，按照id倒序
+'''
+
+# 搜索结果缓存的版本号
+SEARCH_VERSION_KEY = 'search_version'
+# 搜索结果总数，(版本号, 搜索词摘要)
+SEARCH_COUNT_KEY = 'search_count_%s_%s'
+# 一页的sku_id列表，(版本号, 搜索词摘要, 起始位置, 结束位置)
+SEARCH_IDS_KEY = 'search_ids_%s_%s_%d_%d'
+SEARCH_CACHE_TIMEOUT = 60
+# 搜索结果每页的商品数目
+SEARCH_PAGE_SIZE = 20
+# 搜索词的最大长度，过长的部分直接截断
+SEARCH_QUERY_MAX_LENGTH = 50
+# 全部的搜索结果，筛选和分面统计时使用，(版本号, 搜索词摘要)
+SEARCH_HITS_KEY = 'search_hits_%s_%s'
+# 筛选后的sku_id列表，(版本号, 搜索词摘要, 种类, 价格区间)
+SEARCH_FILTERED_KEY = 'search_filtered_%s_%s_%s_%s'
+# 筛选和分面统计最多使用的搜索结果数目，相关度更低的结果不参与
+SEARCH_MAX_HITS = 1000
+# 价格区间，[下限, 上限)，None表示没有上限
+PRICE_RANGES = ((0, 20), (20, 50), (50, 100), (100, None))
+
+
+def normalize_query(query):
+    """去掉首尾和重复的空白，英文转成小写，同一个搜索词只缓存一份"""
+    return ' '.join(query.split()).lower()[:SEARCH_QUERY_MAX_LENGTH]
+
+
+def get_search_version():
+    """获取搜索结果缓存当前的版本号"""
+    version = cache.get(SEARCH_VERSION_KEY)
+    if version is None:
+        cache.add(SEARCH_VERSION_KEY, 1, None)
+        version = cache.get(SEARCH_VERSION_KEY, 1)
+    return version
+
+
+def bump_search_version():
+    """索引更新后调用，让搜索结果缓存失效"""
+    try:
+        cache.incr(SEARCH_VERSION_KEY)
+    except ValueError:
+        cache.add(SEARCH_VERSION_KEY, 1, None)
+        cache.incr(SEARCH_VERSION_KEY)
+
+
+def search_queryset(query):
+    return SearchQuerySet().models(GoodsSKU).auto_query(query)
+
+
+def price_q(price):
+    """第price个价格区间的查询条件"""
+    low, high = PRICE_RANGES[price]
+    if high is None:
+        return Q(price__gte=low)
+    return Q(price__gte=low, price__lt=high)
+
+
+def parse_filters(type_id, price):
+    """请求参数中的种类id和价格区间下标，不合法的参数忽略"""
+    try:
+        type_id = int(type_id)
+    except (TypeError, ValueError):
+        type_id = None
+    try:
+        price = int(price)
+    except (TypeError, ValueError):
+        price = None
+    if price is not None and not 0 <= price < len(PRICE_RANGES):
+        price = None
+    return type_id, price
+
+
+class SearchResultList(object):
+    """
+    搜索词对应的商品，可以交给Paginator分页
+        count和切片先查询缓存，不命中时才执行全文检索，切片返回商品快照
+        type_id和price为筛选条件，有筛选条件或者搜索词为空时使用缓存的筛选结果
+    """
+
+    def __init__(self, query, type_id=None, price=None):
+        self.query = normalize_query(query)
+        self.digest = hashlib.md5(self.query.encode()).hexdigest()
+        self.version = get_search_version()
+        self.type_id = type_id
+        self.price = price
+        self.filtered = not self.query or type_id is not None or price is not None
+        self._queryset = None
+        self._hit_ids = None
+        self._filtered_ids = None
+
+    @property
+    def queryset(self):
+        if self._queryset is None:
+            self._queryset = search_queryset(self.query)
+        return self._queryset
+
+    def hit_ids(self):
+        """全部搜索结果的sku_id，按照相关度排序，搜索词为空时返回None"""
+        if not self.query:
+            return None
+        if self._hit_ids is None:
+            key = SEARCH_HITS_KEY % (self.version, self.digest)
+            self._hit_ids = cache.get(key)
+            if self._hit_ids is None:
+                self._hit_ids = [int(result.pk) for result in self.queryset[:SEARCH_MAX_HITS]]
+                cache.set(key, self._hit_ids, SEARCH_CACHE_TIMEOUT)
+        return self._hit_ids
+
+    def filter_skus(self, skus):
+        """在商品查询集上加上筛选条件"""
+        if self.type_id is not None:
+            skus = skus.filter(type_id=self.type_id)
+        if self.price is not None:
+            skus = skus.filter(price_q(self.price))
+        return skus
+
+    def filtered_ids(self):
+        """筛选后的sku_id，保持搜索结果的顺序"""
+        if self._filtered_ids is None:
+            key = SEARCH_FILTERED_KEY % (self.version, self.digest, self.type_id, self.price)
+            self._filtered_ids = cache.get(key)
+            if self._filtered_ids is None:
+                hit_ids = self.hit_ids()
+                if hit_ids is None:
+                    skus = self.filter_skus(GoodsSKU.objects.all()).order_by('-id')[:SEARCH_MAX_HITS]
+                    self._filtered_ids = list(skus.values_list('id', flat=True))
+                else:
+                    skus = self.filter_skus(GoodsSKU.objects.filter(id__in=hit_ids))
+                    found = set(skus.values_list('id', flat=True))
+                    self._filtered_ids = [sku_id for sku_id in hit_ids if sku_id in found]
+                cache.set(key, self._filtered_ids, SEARCH_CACHE_TIMEOUT)
+        return self._filtered_ids
+
+    def count(self):
+        if self.filtered:
+            return len(self.filtered_ids())
+        key = SEARCH_COUNT_KEY % (self.version, self.digest)
+        count = cache.get(key)
+        if count is None:
+            count = self.queryset.count()
+            cache.set(key, count, SEARCH_CACHE_TIMEOUT)
+        return count
+
+    def __len__(self):
+        return self.count()
+
+    def sku_ids(self, start, stop):
+        """第start到stop个结果的sku_id"""
+        if stop <= start:
+            return []
+        if self.filtered:
+            return self.filtered_ids()[start:stop]
+        key = SEARCH_IDS_KEY % (self.version, self.digest, start, stop)
+        sku_ids = cache.get(key)
+        if sku_ids is None:
+            sku_ids = [int(result.pk) for result in self.queryset[start:stop]]
+            cache.set(key, sku_ids, SEARCH_CACHE_TIMEOUT)
+        return sku_ids
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        start = index.start or 0
+        stop = self.count() if index.stop is None else index.stop
+        return get_sku_snapshots(self.sku_ids(start, stop))
@@ -10,7 +10,11 @@ class GoodsSKUIndex(indexes.SearchIndex, indexes.Indexable):
         # 返回模型类
         return GoodsSKU
 
+    # 增量重建时按照修改时间筛选，见apps.goods.search_rebuild
+    def get_updated_field(self):
+        return 'update_time'
+
     # 建立索引数据
     def index_queryset(self, using=None):
-        # 返回该模型的所有数据
-        return self.get_model().objects.all()
\ No newline at end of file
+        # 返回该模型的所有数据，索引模板中用到了商品SPU的详情
+        return self.get_model().objects.select_related('goods')
\ No newline at end of file
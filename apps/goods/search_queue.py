@@ -0,0 +1,110 @@
+from django.db import transaction
+from django.db.models import signals
+from django_redis import get_redis_connection
+from haystack.signals import BaseSignalProcessor
+from apps.goods.models import GoodsSKU, Goods
+from apps.goods.search import bump_search_version
+
+'''
+全文索引的异步批量更新
+    商品保存、删除时只把sku_id放入redis集合，由celery定时任务update_search_index批量写入whoosh索引，
+    请求中不再获取whoosh的写锁
+    只修改了库存、销量等不在索引中的字段时不放入队列
+    全量重建期间队列暂停，重建完成后再更新，见search_rebuild.rebuild_all
+'''
+
+# 等待更新索引的sku_id集合
+SEARCH_QUEUE_KEY = 'search_index_queue'
+# 全量重建时设置，存在时不取出队列，重建的进程崩溃时自动过期
+SEARCH_PAUSED_KEY = 'search_index_paused'
+SEARCH_PAUSED_TIMEOUT = 60 * 60
+# 每批更新的商品数目，一批只打开一次whoosh的writer
+SEARCH_BATCH_SIZE = 500
+# 索引文档中使用的商品字段，见templates/search/indexes/goods/goodssku_text.txt
+SEARCH_INDEX_FIELDS = ('name', 'desc', 'goods_id')
+
+
+def enqueue_skus(conn, sku_ids):
+    """商品需要重建索引"""
+    sku_ids = list(sku_ids)
+    if sku_ids:
+        conn.sadd(SEARCH_QUEUE_KEY, *sku_ids)
+
+
+def remove_documents(backend, doc_ids):
+    """从索引中删除文档，后端支持批量删除(如utils.ngram_backend)时只写入一次"""
+    if hasattr(backend, 'remove_many'):
+        backend.remove_many(doc_ids)
+        return
+    for doc_id in doc_ids:
+        backend.remove(doc_id)
+
+
+def apply_search_queue(conn, using='default', batch_size=SEARCH_BATCH_SIZE):
+    """
+    取出队列中的商品批量更新索引，返回处理的商品数目
+        数据库中已经删除的商品从索引中删除
+        更新失败时商品放回队列，下一次重试
+        每批更新后搜索结果的缓存失效
+        全量重建期间不处理，商品留在队列中
+    """
+    from haystack import connections
+
+    backend = connections[using].get_backend()
+    index = connections[using].get_unified_index().get_index(GoodsSKU)
+    total = 0
+    while True:
+        if conn.exists(SEARCH_PAUSED_KEY):
+            return total
+        sku_ids = [int(sku_id) for sku_id in conn.spop(SEARCH_QUEUE_KEY, batch_size)]
+        if not sku_ids:
+            return total
+        try:
+            skus = list(index.index_queryset(using=using).filter(id__in=sku_ids))
+            if skus:
+                backend.update(index, skus)
+            found = {sku.id for sku in skus}
+            remove_documents(backend, ['goods.goodssku.%d' % sku_id for sku_id in sku_ids if sku_id not in found])
+        except Exception:
+            enqueue_skus(conn, sku_ids)
+            raise
+        total += len(sku_ids)
+        # 搜索结果的缓存失效
+        bump_search_version()
+
+
+class QueuedSignalProcessor(BaseSignalProcessor):
+    """
+    haystack的信号处理器，settings.HAYSTACK_SIGNAL_PROCESSOR
+        商品和商品SPU保存、删除后，在事务提交时把受影响的sku_id放入队列
+    """
+
+    def setup(self):
+        signals.post_save.connect(self.handle_save, sender=GoodsSKU)
+        signals.post_delete.connect(self.handle_delete, sender=GoodsSKU)
+        signals.post_save.connect(self.handle_save, sender=Goods)
+
+    def teardown(self):
+        signals.post_save.disconnect(self.handle_save, sender=GoodsSKU)
+        signals.post_delete.disconnect(self.handle_delete, sender=GoodsSKU)
+        signals.post_save.disconnect(self.handle_save, sender=Goods)
+
+    def handle_save(self, sender, instance, **kwargs):
+        if sender is Goods:
+            # 商品详情在索引中，SPU下所有的商品都要更新
+            sku_ids = list(GoodsSKU.objects.filter(goods_id=instance.id).values_list('id', flat=True))
+        else:
+            # 保存前的字段由apps.goods.signals.sku_saving记录
+            old_fields = getattr(instance, '_old_fields', None)
+            if old_fields is not None and all(old_fields[name] == getattr(instance, name)
+                                              for name in SEARCH_INDEX_FIELDS):
+                return
+            sku_ids = [instance.id]
+        self.enqueue(sku_ids)
+
+    def handle_delete(self, sender, instance, **kwargs):
+        self.enqueue([instance.id])
+
+    def enqueue(self, sku_ids):
+        if sku_ids:
+            transaction.on_commit(lambda: enqueue_skus(get_redis_connection('default'), sku_ids))
@@ -0,0 +1,179 @@
+import os
+import time
+import shutil
+import multiprocessing
+from datetime import datetime, timedelta
+from django import db
+from django.db.models import Q, Min, Max
+from django.utils import timezone
+from haystack import connections
+from whoosh.filedb.filestore import FileStorage
+from whoosh.writing import CLEAR
+from apps.goods.models import GoodsSKU
+from apps.goods.search import bump_search_version
+from apps.goods.search_queue import apply_search_queue, SEARCH_PAUSED_KEY, SEARCH_PAUSED_TIMEOUT
+
+'''
+全文索引的重建
+    增量：按照BaseModel.update_time只更新上次重建之后修改过的商品和商品SPU，上次重建的时间保存在redis中
+    全量：按照id范围把商品分给多个进程，每个进程写入自己的whoosh目录，最后合并到原来的索引并去掉原来的所有段，
+        重建过程中搜索使用的还是原来的索引，队列中的商品等合并之后再更新
+        不是whoosh的后端不能合并，清空后在一个进程中写入
+    删除的商品不会出现在增量的查询结果中，由search_queue的队列从索引中删除
+'''
+
+# 上次重建开始的时间戳
+SEARCH_WATERMARK_KEY = 'search_index_watermark'
+# 增量重建时向前多取的时间，重建开始前修改、开始后才提交的事务也能被更新
+SEARCH_WATERMARK_OVERLAP = timedelta(seconds=60)
+# 每批写入索引的商品数目
+SEARCH_REBUILD_BATCH = 1000
+# 合并时等待其他进程释放whoosh写锁的秒数
+SEARCH_MERGE_LOCK_TIMEOUT = 60
+
+
+def get_sku_index(using='default'):
+    return connections[using].get_unified_index().get_index(GoodsSKU)
+
+
+def get_watermark(conn):
+    """上次重建开始的时间，没有重建过返回None"""
+    watermark = conn.get(SEARCH_WATERMARK_KEY)
+    if watermark is None:
+        return None
+    return datetime.fromtimestamp(float(watermark), timezone.utc)
+
+
+def set_watermark(conn, started):
+    conn.set(SEARCH_WATERMARK_KEY, started)
+
+
+def changed_since(queryset, since):
+    """商品或者商品SPU在since之后修改过的商品"""
+    return queryset.filter(Q(update_time__gte=since) | Q(goods__update_time__gte=since))
+
+
+def split_id_ranges(min_id, max_id, parts):
+    """把[min_id, max_id]分成parts个左闭右开的区间"""
+    step = max((max_id - min_id + parts) // parts, 1)
+    ranges = []
+    for start in range(min_id, max_id + 1, step):
+        ranges.append((start, min(start + step, max_id + 1)))
+    return ranges
+
+
+def update_batches(backend, index, queryset, batch_size=SEARCH_REBUILD_BATCH):
+    """按照id顺序分批写入索引，返回商品数目"""
+    count = 0
+    last_id = 0
+    while True:
+        skus = list(queryset.filter(id__gt=last_id).order_by('id')[:batch_size])
+        if not skus:
+            return count
+        backend.update(index, skus)
+        count += len(skus)
+        last_id = skus[-1].id
+
+
+def update_since(conn, using='default', batch_size=SEARCH_REBUILD_BATCH):
+    """
+    增量重建，返回更新的商品数目
+        没有重建过时返回None，需要全量重建
+    """
+    since = get_watermark(conn)
+    if since is None:
+        return None
+    started = time.time()
+    index = get_sku_index(using)
+    queryset = changed_since(index.index_queryset(using=using), since - SEARCH_WATERMARK_OVERLAP)
+    count = update_batches(connections[using].get_backend(), index, queryset, batch_size)
+    set_watermark(conn, started)
+    if count:
+        bump_search_version()
+    return count
+
+
+def build_part(args):
+    """在子进程中把id区间[start, end)的商品写入单独的whoosh目录"""
+    using, path, start, end, batch_size = args
+    # fork出来的进程不能使用父进程的数据库连接
+    db.connections.close_all()
+    engine = connections[using]
+    backend = engine.backend(using, **dict(engine.options, PATH=path))
+    index = get_sku_index(using)
+    queryset = index.index_queryset(using=using).filter(id__gte=start, id__lt=end)
+    return update_batches(backend, index, queryset, batch_size)
+
+
+def merge_parts(index, paths):
+    """
+    把各个进程的whoosh目录合并到正在使用的索引
+        提交时去掉原来的所有段，新的一代一次写入，其他进程refresh时打开的要么是原来的索引，要么是合并后的索引
+    """
+    writer = index.writer(timeout=SEARCH_MERGE_LOCK_TIMEOUT)
+    try:
+        for part_path in paths:
+            with FileStorage(part_path).open_index(schema=index.schema).reader() as reader:
+                # 逐个段合并，多个段的reader返回的列数据已经转换过，不能直接写入
+                for segment_reader, _ in reader.leaf_readers():
+                    writer.add_reader(segment_reader)
+    except Exception:
+        writer.cancel()
+        raise
+    writer.commit(mergetype=CLEAR)
+
+
+def rebuild_parts(backend, index, using, workers, batch_size):
+    """whoosh的后端按照id区间多进程写入再合并，返回商品数目"""
+    backend.setup()
+    bounds = index.index_queryset(using=using).aggregate(min_id=Min('id'), max_id=Max('id'))
+    ranges = []
+    if bounds['min_id'] is not None:
+        ranges = split_id_ranges(bounds['min_id'], bounds['max_id'], workers)
+    paths = ['%s.part%d' % (backend.path, i) for i in range(len(ranges))]
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+    tasks = [(using, path, start, end, batch_size) for path, (start, end) in zip(paths, ranges)]
+    try:
+        if len(tasks) > 1:
+            db.connections.close_all()
+            with multiprocessing.get_context('fork').Pool(len(tasks)) as pool:
+                counts = pool.map(build_part, tasks)
+        else:
+            counts = [build_part(task) for task in tasks]
+        merge_parts(backend.index, paths)
+    finally:
+        for path in paths:
+            shutil.rmtree(path, ignore_errors=True)
+    return sum(counts)
+
+
+def rebuild_all(conn, using='default', workers=None, batch_size=SEARCH_REBUILD_BATCH):
+    """
+    全量重建，返回商品数目
+        whoosh的后端(包括whoosh_cn_backend)多进程写入后合并，其他后端(如utils.ngram_backend)清空后在当前进程中依次写入
+        重建期间暂停search_queue的队列，写完之后再处理队列中的商品，
+        并且增量更新重建开始之后修改的商品，重建过程中的修改不会丢失
+    """
+    started = time.time()
+    conn.set(SEARCH_PAUSED_KEY, 1, ex=SEARCH_PAUSED_TIMEOUT)
+    try:
+        backend = connections[using].get_backend()
+        index = get_sku_index(using)
+        # 只有whoosh的后端使用FileStorage，可以合并多个进程的目录
+        if getattr(backend, 'use_file_storage', False):
+            count = rebuild_parts(backend, index, using, workers or os.cpu_count() or 1, batch_size)
+        else:
+            backend.clear()
+            count = update_batches(backend, index, index.index_queryset(using=using), batch_size)
+    finally:
+        conn.delete(SEARCH_PAUSED_KEY)
+
+    apply_search_queue(conn, using)
+    queryset = changed_since(index.index_queryset(using=using),
+                             datetime.fromtimestamp(started, timezone.utc) - SEARCH_WATERMARK_OVERLAP)
+    update_batches(backend, index, queryset, batch_size)
+    set_watermark(conn, started)
+    bump_search_version()
+    return count
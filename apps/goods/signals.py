@@ -0,0 +1,121 @@
+from django.db import transaction
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+from django_redis import get_redis_connection
+from apps.goods.models import GoodsType, GoodsSKU, Goods, GoodsImage, IndexGoodsBanner, IndexPromotionBanner, \
+    IndexTypeGoodsBanner
+from apps.goods.cache import bump_index_page_version, bump_list_versions, invalidate_detail_pages
+from apps.goods.sku_cache import invalidate_skus
+from apps.goods.stock import set_stock, delete_stock
+from apps.goods.sales import add_sku, remove_sku
+from apps.goods.search_queue import SEARCH_INDEX_FIELDS
+from apps.goods import suggest
+
+# 商品保存前需要记录的字段
+SKU_SAVING_FIELDS = ('type_id',) + SEARCH_INDEX_FIELDS
+
+
+@receiver(post_save, sender=GoodsType)
+@receiver(post_delete, sender=GoodsType)
+@receiver(post_save, sender=IndexGoodsBanner)
+@receiver(post_delete, sender=IndexGoodsBanner)
+@receiver(post_save, sender=IndexPromotionBanner)
+@receiver(post_delete, sender=IndexPromotionBanner)
+@receiver(post_save, sender=IndexTypeGoodsBanner)
+@receiver(post_delete, sender=IndexTypeGoodsBanner)
+def index_page_changed(sender, **kwargs):
+    """首页展示的数据发生变化，事务提交后更新首页缓存的版本号，不会把提交前的数据缓存到新版本中"""
+    transaction.on_commit(bump_index_page_version)
+
+
+@receiver(post_save, sender=GoodsSKU)
+@receiver(post_delete, sender=GoodsSKU)
+def sku_changed(sender, instance, **kwargs):
+    """商品数据发生变化，事务提交后清除商品快照缓存"""
+    transaction.on_commit(lambda: invalidate_skus([instance.id]))
+
+
+@receiver(pre_save, sender=GoodsSKU)
+def sku_saving(sender, instance, **kwargs):
+    """
+    记录商品保存前的种类和索引字段，新建的商品为None
+        商品换了种类时原来种类的列表页也需要失效，索引字段没有变化时不需要重建全文索引
+    """
+    if instance.pk is None:
+        instance._old_fields = None
+    else:
+        instance._old_fields = GoodsSKU.objects.filter(pk=instance.pk).values(*SKU_SAVING_FIELDS).first()
+
+
+@receiver(post_save, sender=GoodsSKU)
+@receiver(post_delete, sender=GoodsSKU)
+def sku_list_changed(sender, instance, **kwargs):
+    """商品数据发生变化，事务提交后让所在种类的列表页缓存失效"""
+    type_ids = [instance.type_id]
+    old_fields = getattr(instance, '_old_fields', None)
+    if old_fields is not None:
+        type_ids.append(old_fields['type_id'])
+    transaction.on_commit(lambda: bump_list_versions(type_ids))
+
+
+@receiver(post_save, sender=GoodsSKU)
+def sku_stock_changed(sender, instance, **kwargs):
+    """商品保存后，事务提交时更新redis中的库存镜像"""
+    transaction.on_commit(lambda: set_stock(get_redis_connection('default'), instance.id, instance.stock))
+
+
+@receiver(post_delete, sender=GoodsSKU)
+def sku_stock_deleted(sender, instance, **kwargs):
+    """商品删除后，事务提交时删除redis中的库存镜像"""
+    transaction.on_commit(lambda: delete_stock(get_redis_connection('default'), instance.id))
+
+
+@receiver(post_save, sender=GoodsSKU)
+def sku_sales_saved(sender, instance, **kwargs):
+    """商品保存后，事务提交时加入所在种类的销量排行"""
+    old_fields = getattr(instance, '_old_fields', None)
+    old_type_id = old_fields['type_id'] if old_fields else None
+    transaction.on_commit(lambda: add_sku(get_redis_connection('default'), instance.type_id, instance.id,
+                                          instance.sales, old_type_id))
+
+
+@receiver(post_delete, sender=GoodsSKU)
+def sku_sales_deleted(sender, instance, **kwargs):
+    """商品删除后，事务提交时从销量排行中移除"""
+    transaction.on_commit(lambda: remove_sku(get_redis_connection('default'), instance.type_id, instance.id))
+
+
+@receiver(post_save, sender=GoodsSKU)
+@receiver(post_delete, sender=GoodsSKU)
+@receiver(post_save, sender=Goods)
+@receiver(post_delete, sender=Goods)
+def spu_detail_changed(sender, instance, **kwargs):
+    """商品SPU或者其中的商品发生变化，事务提交后清除同一SPU下所有商品的详情页缓存"""
+    goods_id = instance.id if sender is Goods else instance.goods_id
+    sku_ids = list(GoodsSKU.objects.filter(goods_id=goods_id).values_list('id', flat=True))
+    if sender is GoodsSKU:
+        sku_ids.append(instance.id)
+    transaction.on_commit(lambda: invalidate_detail_pages(sku_ids))
+
+
+@receiver(post_save, sender=GoodsImage)
+@receiver(post_delete, sender=GoodsImage)
+def image_detail_changed(sender, instance, **kwargs):
+    """商品图片发生变化，事务提交后清除商品详情页缓存"""
+    transaction.on_commit(lambda: invalidate_detail_pages([instance.sku_id]))
+
+
+@receiver(post_save, sender=GoodsSKU)
+@receiver(post_delete, sender=GoodsSKU)
+@receiver(post_save, sender=Goods)
+@receiver(post_delete, sender=Goods)
+def suggest_changed(sender, instance, **kwargs):
+    """商品或者商品SPU发生变化，事务提交后更新所有进程的输入提示索引，SPU的销量随着商品变化"""
+    if sender is Goods:
+        items = [(suggest.SPU, instance.id)]
+    else:
+        items = [(suggest.SKU, instance.id), (suggest.SPU, instance.goods_id)]
+        old_fields = getattr(instance, '_old_fields', None)
+        if old_fields and old_fields['goods_id'] != instance.goods_id:
+            items.append((suggest.SPU, old_fields['goods_id']))
+    transaction.on_commit(lambda: suggest.notify(items))
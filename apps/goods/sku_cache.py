@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from apps.goods.models import GoodsSKU
+
+'''
+商品sku快照的两级缓存
+    一级缓存(L1)是进程内的LRU缓存，二级缓存(L2)是redis
+    商品保存或删除时清除二级缓存，并通过redis的发布订阅通知所有进程清除一级缓存
+    快照只用于展示，需要修改商品数据时仍然要查询数据库
+'''
+
+# 快照中保存的商品字段
+SKU_SNAPSHOT_FIELDS = ('id', 'name', 'price', 'unite', 'image_url', 'stock', 'sales', 'status', 'type_id')
+
+SKU_CACHE_KEY = 'sku_snapshot_%d'
+# 通知其他进程清除一级缓存的频道
+SKU_CACHE_CHANNEL = 'sku_snapshot_invalidate'
+# 所有进程的命中统计，{l1_hits, l2_hits, misses}
+SKU_CACHE_STATS_KEY = 'sku_snapshot_stats'
+
+# 一级缓存最多保存的商品数目
+SKU_CACHE_L1_SIZE = getattr(settings, 'SKU_CACHE_L1_SIZE', 1000)
+# 一级缓存的过期时间，订阅断开期间错过的通知最多影响这么长时间
+SKU_CACHE_L1_TIMEOUT = getattr(settings, 'SKU_CACHE_L1_TIMEOUT', 60)
+SKU_CACHE_L2_TIMEOUT = getattr(settings, 'SKU_CACHE_L2_TIMEOUT', 60 * 60)
+# 每查询多少次把本进程的命中统计累加到redis中
+SKU_CACHE_STATS_FLUSH = 1000
+
+
+class SKUImage(object):
+    """和ImageField一样可以在模板中使用image.url"""
+
+    def __init__(self, url):
+        self.url = url
+
+
+class SKUSnapshot(object):
+    """商品sku快照，每次获取都会创建新的对象，视图中可以动态添加属性"""
+
+    def __init__(self, data):
+        for field in SKU_SNAPSHOT_FIELDS:
+            setattr(self, field, data[field])
+        self.image = SKUImage(self.image_url)
+
+    @staticmethod
+    def from_sku(sku):
+        """从GoodsSKU对象生成快照数据"""
+        return {
+            'id': sku.id,
+            'name': sku.name,
+            'price': sku.price,
+            'unite': sku.unite,
+            'image_url': sku.image.url if sku.image else '',
+            'stock': sku.stock,
+            'sales': sku.sales,
+            'status': sku.status,
+            'type_id': sku.type_id,
+        }
+
+
+class LRUCache(object):
+    """进程内的LRU缓存，线程安全"""
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                del self.data[key]
+                return None
+            self.data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.data[key] = (value, time.time() + self.timeout)
+            self.data.move_to_end(key)
+            while len(self.data) > self.size:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+    def __len__(self):
+        return len(self.data)
+
+
+_l1 = LRUCache(SKU_CACHE_L1_SIZE, SKU_CACHE_L1_TIMEOUT)
+_stats = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0}
+_unflushed = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+# 启动订阅线程的进程id，fork出的子进程需要重新启动
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _listen():
+    """订阅清除缓存的通知，断开后清空一级缓存并重新订阅"""
+    while True:
+        try:
+            conn = get_redis_connection('default')
+        except NotImplementedError:
+            # 不是redis缓存(比如测试环境)，只有本进程，不需要订阅
+            return
+        try:
+            pubsub = conn.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SKU_CACHE_CHANNEL)
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    _l1.delete(int(message['data']))
+        except Exception:
+            # 断开期间可能错过了通知
+            _l1.clear()
+            time.sleep(1)
+
+
+def _ensure_listener():
+    global _listener_pid
+    pid = os.getpid()
+    if _listener_pid == pid:
+        return
+    with _listener_lock:
+        if _listener_pid == pid:
+            return
+        # fork出的进程继承了父进程的一级缓存，但没有继承订阅线程
+        _l1.clear()
+        thread = threading.Thread(target=_listen, name='sku-cache-listener', daemon=True)
+        thread.start()
+        _listener_pid = pid
+
+
+def _record(l1_hits, l2_hits, misses):
+    """累加命中统计，定期写入redis，方便按照所有进程的命中率调整缓存大小"""
+    with _stats_lock:
+        for name, num in (('l1_hits', l1_hits), ('l2_hits', l2_hits), ('misses', misses)):
+            _stats[name] += num
+            _unflushed[name] += num
+        if sum(_unflushed.values()) < SKU_CACHE_STATS_FLUSH:
+            return
+        unflushed = dict(_unflushed)
+        for name in _unflushed:
+            _unflushed[name] = 0
+
+    try:
+        conn = get_redis_connection('default')
+        pipe = conn.pipeline(transaction=False)
+        for name, num in unflushed.items():
+            pipe.hincrby(SKU_CACHE_STATS_KEY, name, num)
+        pipe.execute()
+    except Exception:
+        pass
+
+
+def get_stats():
+    """本进程的命中统计"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats['l1_size'] = len(_l1)
+    return stats
+
+
+def get_sku_snapshots(sku_ids):
+    """
+    根据sku_id列表批量获取商品快照
+        依次查询一级缓存、二级缓存(一次get_many)和数据库(一次in_bulk)
+        返回的顺序和sku_ids的顺序一致，已经删除的商品直接跳过
+    """
+    _ensure_listener()
+
+    ids = []
+    for sku_id in sku_ids:
+        try:
+            ids.append(int(sku_id))
+        except (TypeError, ValueError):
+            continue
+
+    found = {}
+    for sku_id in ids:
+        data = _l1.get(sku_id)
+        if data is not None:
+            found[sku_id] = data
+    l1_hits = len(found)
+
+    missing = [sku_id for sku_id in ids if sku_id not in found]
+    l2_hits = 0
+    if missing:
+        cached = cache.get_many([SKU_CACHE_KEY % sku_id for sku_id in missing])
+        for sku_id in missing:
+            data = cached.get(SKU_CACHE_KEY % sku_id)
+            if data is not None:
+                found[sku_id] = data
+                _l1.set(sku_id, data)
+                l2_hits += 1
+
+    missing = [sku_id for sku_id in missing if sku_id not in found]
+    if missing:
+        to_cache = {}
+        for sku_id, sku in GoodsSKU.objects.in_bulk(missing).items():
+            data = SKUSnapshot.from_sku(sku)
+            found[sku_id] = data
+            to_cache[SKU_CACHE_KEY % sku_id] = data
+            _l1.set(sku_id, data)
+        if to_cache:
+            cache.set_many(to_cache, SKU_CACHE_L2_TIMEOUT)
+
+    _record(l1_hits, l2_hits, len(missing))
+    return [SKUSnapshot(found[sku_id]) for sku_id in ids if sku_id in found]
+
+
+def get_sku_snapshot(sku_id):
+    """获取单个商品快照，商品不存在返回None"""
+    snapshots = get_sku_snapshots([sku_id])
+    return snapshots[0] if snapshots else None
+
+
+def invalidate_skus(sku_ids):
+    """商品数据发生变化，清除两级缓存并通知其他进程"""
+    sku_ids = [int(sku_id) for sku_id in sku_ids]
+    if not sku_ids:
+        return
+    for sku_id in sku_ids:
+        _l1.delete(sku_id)
+    cache.delete_many([SKU_CACHE_KEY % sku_id for sku_id in sku_ids])
+    try:
+        conn = get_redis_connection('default')
+        pipe = conn.pipeline(transaction=False)
+        for sku_id in sku_ids:
+            pipe.publish(SKU_CACHE_CHANNEL, sku_id)
+        pipe.execute()
+    except NotImplementedError:
+        # 不是redis缓存(比如测试环境)，只有本进程
+        pass
@@ -0,0 +1,226 @@
+import uuid
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from apps.goods.models import GoodsSKU, StockFlush
+from apps.goods.sku_cache import invalidate_skus
+
+'''
+商品库存在redis中的镜像，hash结构{sku_id: 可用库存}
+    购物车添加、更新时使用镜像中的库存判断，不需要查询数据库
+    redis库存模式下订单提交在镜像中预扣库存，预扣的数量记录在SKU_STOCK_PENDING_KEY中，
+    由celery定时任务批量写回数据库的GoodsSKU.stock和sales
+    任何时候对每个商品都有: 数据库库存 = 镜像库存 + 待写回数量 + 正在写回数量
+'''
+
+SKU_STOCK_KEY = 'sku_stock'
+# 已经预扣、还没有写回数据库的数量 {sku_id: count}
+SKU_STOCK_PENDING_KEY = 'sku_stock_pending'
+# 正在写回数据库的数量，写回成功后删除
+SKU_STOCK_FLUSHING_KEY = 'sku_stock_flushing'
+# 正在写回的批次id，数据库中有这个批次时说明已经写回过，只是没来得及删除SKU_STOCK_FLUSHING_KEY
+SKU_STOCK_FLUSH_BATCH_KEY = 'sku_stock_flush_batch'
+# 写回数据库和对账时使用的锁，避免同时进行，值是持有者的随机id
+SKU_STOCK_FLUSH_LOCK = 'sku_stock_flush_lock'
+SKU_STOCK_FLUSH_LOCK_TIMEOUT = 60
+# 数据库中写回批次保留的时间，写回每隔几秒执行一次，更早的批次不会再被重复写回
+STOCK_FLUSH_KEEP = timedelta(days=7)
+
+# 预扣库存返回的状态
+STOCK_RESERVED = 0
+STOCK_MISSING = -1  # 镜像中没有该商品，需要从数据库加载
+STOCK_NOT_ENOUGH = -2  # 库存不足
+
+# 根据数据库库存设置镜像库存，减去还没有写回数据库的数量
+# KEYS[1] 镜像 KEYS[2] 待写回 KEYS[3] 正在写回，ARGV[1] sku_id ARGV[2] 数据库库存 ARGV[3] 为1时只在镜像中没有该商品时设置
+STOCK_SET_SCRIPT = """
+if ARGV[3] == '1' and redis.call('HEXISTS', KEYS[1], ARGV[1]) == 1 then
+    return 0
+end
+local pending = tonumber(redis.call('HGET', KEYS[2], ARGV[1]) or 0)
+local flushing = tonumber(redis.call('HGET', KEYS[3], ARGV[1]) or 0)
+redis.call('HSET', KEYS[1], ARGV[1], tonumber(ARGV[2]) - pending - flushing)
+return 1
+"""
+
+# 预扣订单中所有商品的库存，全部足够才扣减，否则一个都不扣
+# KEYS[1] 镜像 KEYS[2] 待写回，ARGV sku_id1 count1 sku_id2 count2 ...
+# 返回{状态, 出错的sku_id}
+STOCK_RESERVE_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    local stock = redis.call('HGET', KEYS[1], ARGV[i])
+    if not stock then
+        return {-1, ARGV[i]}
+    end
+    if tonumber(stock) < tonumber(ARGV[i + 1]) then
+        return {-2, ARGV[i]}
+    end
+end
+for i = 1, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], -tonumber(ARGV[i + 1]))
+    redis.call('HINCRBY', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+return {0, 0}
+"""
+
+# 归还预扣的库存，订单创建失败时使用
+# KEYS[1] 镜像 KEYS[2] 待写回，ARGV sku_id1 count1 sku_id2 count2 ...
+STOCK_RELEASE_SCRIPT = """
+for i = 1, #ARGV, 2 do
+    redis.call('HINCRBY', KEYS[1], ARGV[i], ARGV[i + 1])
+    redis.call('HINCRBY', KEYS[2], ARGV[i], -tonumber(ARGV[i + 1]))
+end
+return 0
+"""
+
+# 取出所有待写回的数量，移动到正在写回中，并分配批次id，上一次写回没有完成时继续使用原来的批次
+# KEYS[1] 待写回 KEYS[2] 正在写回 KEYS[3] 批次id，ARGV[1] 新的批次id
+# 返回{批次id, {sku_id1, count1, ...}}，没有需要写回的数量时批次id为空字符串
+STOCK_TAKE_PENDING_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 and redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[2])
+    redis.call('SET', KEYS[3], ARGV[1])
+end
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    redis.call('SETNX', KEYS[3], ARGV[1])
+end
+return {redis.call('GET', KEYS[3]) or '', redis.call('HGETALL', KEYS[2])}
+"""
+
+# 释放自己持有的锁，锁已经过期被其他进程获取时不删除
+# KEYS[1] 锁，ARGV[1] 持有者
+STOCK_UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_scripts = {}
+
+
+def _get_script(conn, source):
+    script = _scripts.get(source)
+    if script is None:
+        script = _scripts[source] = conn.register_script(source)
+    return script
+
+
+def _set_stock(conn, sku_id, stock, only_missing):
+    keys = [SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY, SKU_STOCK_FLUSHING_KEY]
+    script = _get_script(conn, STOCK_SET_SCRIPT)
+    return script(keys=keys, args=[sku_id, stock, 1 if only_missing else 0], client=conn)
+
+
+def load_stock(conn, sku_ids):
+    """
+    从数据库加载商品库存到镜像中，返回{sku_id: 数据库库存}
+        只设置镜像中还没有的商品，不会覆盖其他进程已经写入的库存
+        不存在的商品不会出现在结果中
+    """
+    stocks = dict(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'))
+    for sku_id, stock in stocks.items():
+        _set_stock(conn, sku_id, stock, True)
+    return stocks
+
+
+def set_stock(conn, sku_id, stock):
+    """商品在数据库中的库存发生变化，更新镜像"""
+    _set_stock(conn, sku_id, stock, False)
+
+
+def delete_stock(conn, sku_id):
+    """商品被删除，删除镜像中的库存"""
+    conn.hdel(SKU_STOCK_KEY, sku_id)
+
+
+def reserve_stock(conn, counts):
+    """
+    在镜像中预扣订单商品的库存，counts为{sku_id: count}
+        所有商品的库存都足够时才扣减，返回(STOCK_RESERVED, None)
+        否则不扣减，返回(STOCK_NOT_ENOUGH, sku_id)
+        镜像中没有的商品会从数据库加载，数据库中也没有时返回(STOCK_MISSING, sku_id)
+    """
+    args = []
+    for sku_id, count in counts.items():
+        args.extend([sku_id, count])
+
+    script = _get_script(conn, STOCK_RESERVE_SCRIPT)
+    keys = [SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY]
+    status, sku_id = script(keys=keys, args=args, client=conn)
+    if status == STOCK_MISSING:
+        load_stock(conn, list(counts.keys()))
+        status, sku_id = script(keys=keys, args=args, client=conn)
+
+    if status == STOCK_RESERVED:
+        return STOCK_RESERVED, None
+    return status, int(sku_id)
+
+
+def release_stock(conn, counts):
+    """归还预扣的库存，counts为{sku_id: count}"""
+    args = []
+    for sku_id, count in counts.items():
+        args.extend([sku_id, count])
+    script = _get_script(conn, STOCK_RELEASE_SCRIPT)
+    script(keys=[SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY], args=args, client=conn)
+
+
+def acquire_flush_lock(conn):
+    """获取写回和对账的锁，返回持有者的随机id，其他进程持有时返回None"""
+    owner = uuid.uuid4().hex
+    if conn.set(SKU_STOCK_FLUSH_LOCK, owner, nx=True, ex=SKU_STOCK_FLUSH_LOCK_TIMEOUT):
+        return owner
+    return None
+
+
+def release_flush_lock(conn, owner):
+    script = _get_script(conn, STOCK_UNLOCK_SCRIPT)
+    script(keys=[SKU_STOCK_FLUSH_LOCK], args=[owner], client=conn)
+
+
+def flush_pending_stock(conn):
+    """
+    把预扣的库存写回数据库，返回写回的商品数目
+        待写回的数量先移动到SKU_STOCK_FLUSHING_KEY中，写回成功后删除
+        写回失败时留在其中，下一次会重新写回
+        批次id和库存的修改在同一个事务中写入数据库，事务提交后、删除SKU_STOCK_FLUSHING_KEY前崩溃时，
+        下一次发现这个批次已经写回过，只删除SKU_STOCK_FLUSHING_KEY，不会重复扣减
+        写回后删除超过STOCK_FLUSH_KEEP的批次
+    """
+    owner = acquire_flush_lock(conn)
+    if owner is None:
+        # 其他进程正在写回或对账
+        return 0
+
+    try:
+        script = _get_script(conn, STOCK_TAKE_PENDING_SCRIPT)
+        keys = [SKU_STOCK_PENDING_KEY, SKU_STOCK_FLUSHING_KEY, SKU_STOCK_FLUSH_BATCH_KEY]
+        batch_id, items = script(keys=keys, args=[uuid.uuid4().hex], client=conn)
+        counts = {}
+        for i in range(0, len(items), 2):
+            count = int(items[i + 1])
+            if count:
+                counts[int(items[i])] = count
+        if not batch_id:
+            return 0
+
+        with transaction.atomic():
+            _, created = StockFlush.objects.get_or_create(batch_id=batch_id.decode())
+            if not created:
+                # 这一批已经写回过
+                counts = {}
+            # 按照id顺序更新，和其他按id顺序加锁的事务不会死锁
+            for sku_id in sorted(counts):
+                count = counts[sku_id]
+                GoodsSKU.objects.filter(id=sku_id).update(stock=F('stock') - count, sales=F('sales') + count)
+        conn.delete(SKU_STOCK_FLUSHING_KEY, SKU_STOCK_FLUSH_BATCH_KEY)
+        StockFlush.objects.filter(create_time__lt=timezone.now() - STOCK_FLUSH_KEEP).delete()
+    finally:
+        release_flush_lock(conn, owner)
+
+    if counts:
+        # update不会发出post_save信号，手动清除商品快照缓存
+        invalidate_skus(counts.keys())
+    return len(counts)
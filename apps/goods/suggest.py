@@ -0,0 +1,313 @@
+import os
+import time
+import heapq
+import threading
+from bisect import bisect_left
+from django import db
+from django.db.models import Sum
+from django_redis import get_redis_connection
+from apps.goods.models import GoodsSKU, Goods
+
+try:
+    from pypinyin import lazy_pinyin, Style
+except ImportError:
+    # 没有安装pypinyin时只能按照商品名称的前缀提示
+    lazy_pinyin = None
+
+'''
+搜索框的输入提示
+    每个进程在内存中保存商品sku和商品spu名称的前缀索引，输入提示不查询whoosh和数据库
+    索引是排好序的key数组，前缀对应数组中连续的一段，二分查找找到这一段后按照销量取前几个
+    key是规范化后的名称和名称的拼音首字母(需要pypinyin)，比如"草莓"可以用"草"、"cm"找到
+    短前缀对应的段很长，结果按照前缀缓存，前缀对应的商品变化时清除
+    商品保存、删除时本进程直接更新这一个商品，再通过redis发布订阅通知其他进程更新，
+    订单通过update修改销量不会发出信号，所以每隔一段时间在后台线程中全量重建一次
+'''
+
+# 通知其他进程更新索引的频道，消息为"sku:id:pid"或者"spu:id:pid"，pid为发出通知的进程
+SUGGEST_CHANNEL = 'goods_suggest_changed'
+# 返回的提示数目
+SUGGEST_LIMIT = 10
+# 长度不超过这个值的前缀缓存结果
+SUGGEST_CACHE_PREFIX_LENGTH = 3
+# 前缀的最大长度，过长的输入直接截断
+SUGGEST_PREFIX_MAX_LENGTH = 30
+# 全量重建的间隔，销量排序最多延迟这么长时间
+SUGGEST_REBUILD_INTERVAL = 10 * 60
+
+SKU = 'sku'
+SPU = 'spu'
+
+
+def normalize(text):
+    """去掉空白，英文转成小写"""
+    return ''.join(text.split()).lower()
+
+
+def pinyin_initials(text):
+    """拼音首字母，非汉字原样保留，没有安装pypinyin时返回空字符串"""
+    if lazy_pinyin is None:
+        return ''
+    return ''.join(lazy_pinyin(text, style=Style.FIRST_LETTER, errors='default'))
+
+
+class SuggestIndex(object):
+    """
+    商品名称的前缀索引
+        条目保存在几个平行的数组中，keys和key_entries是按照key排序的平行数组
+        修改和生成前缀缓存在锁内完成，其他查询不加锁，最多读到修改了一半的数组，只影响这一次的提示
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # 条目：名称、类型、商品id、销量，删除的条目名称为None
+        self.names = []
+        self.kinds = []
+        self.ids = []
+        self.sales = []
+        # (类型, 商品id) -> 条目下标
+        self.entries = {}
+        # 排好序的key和对应的条目下标
+        self.keys = []
+        self.key_entries = []
+        # 前缀 -> 条目下标列表
+        self.cache = {}
+        self.built = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def make_keys(name):
+        keys = {normalize(name)}
+        initials = normalize(pinyin_initials(name))
+        if initials:
+            keys.add(initials)
+        keys.discard('')
+        return keys
+
+    def build(self, items):
+        """一次性建立索引，items为[(类型, 商品id, 名称, 销量)]"""
+        pairs = []
+        for kind, item_id, name, sales in items:
+            entry = len(self.names)
+            self.names.append(name)
+            self.kinds.append(kind)
+            self.ids.append(item_id)
+            self.sales.append(sales)
+            self.entries[(kind, item_id)] = entry
+            pairs.extend((key, entry) for key in self.make_keys(name))
+        pairs.sort()
+        self.keys = [key for key, entry in pairs]
+        self.key_entries = [entry for key, entry in pairs]
+        self.built = time.time()
+        return self
+
+    def _forget(self, prefixes, keys):
+        for key in keys:
+            for length in range(1, min(len(key), SUGGEST_CACHE_PREFIX_LENGTH) + 1):
+                prefixes.add(key[:length])
+
+    def update(self, kind, item_id, name, sales):
+        """添加或者更新一个条目，name为None时删除"""
+        with self.lock:
+            prefixes = set()
+            entry = self.entries.pop((kind, item_id), None)
+            if entry is not None:
+                old_keys = self.make_keys(self.names[entry])
+                self._forget(prefixes, old_keys)
+                for key in old_keys:
+                    pos = bisect_left(self.keys, key)
+                    while self.key_entries[pos] != entry:
+                        pos += 1
+                    del self.keys[pos]
+                    del self.key_entries[pos]
+                self.names[entry] = None
+
+            if name is not None:
+                entry = len(self.names)
+                self.names.append(name)
+                self.kinds.append(kind)
+                self.ids.append(item_id)
+                self.sales.append(sales)
+                self.entries[(kind, item_id)] = entry
+                new_keys = self.make_keys(name)
+                self._forget(prefixes, new_keys)
+                for key in new_keys:
+                    pos = bisect_left(self.keys, key)
+                    self.keys.insert(pos, key)
+                    self.key_entries.insert(pos, entry)
+
+            for prefix in prefixes:
+                self.cache.pop(prefix, None)
+
+    def top(self, prefix):
+        """前缀对应的条目中销量最高的几个，同名的只保留一个"""
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + '\uffff', lo)
+        entries = set(self.key_entries[lo:hi])
+        result = []
+        names = set()
+        for entry in heapq.nlargest(SUGGEST_LIMIT * 2, entries, key=self.sales.__getitem__):
+            name = self.names[entry]
+            if name is None or name in names:
+                continue
+            names.add(name)
+            result.append(entry)
+            if len(result) == SUGGEST_LIMIT:
+                break
+        return result
+
+    def suggest(self, prefix):
+        """返回[{name, type, id}]"""
+        prefix = normalize(prefix)[:SUGGEST_PREFIX_MAX_LENGTH]
+        if not prefix:
+            return []
+        if len(prefix) <= SUGGEST_CACHE_PREFIX_LENGTH:
+            entries = self.cache.get(prefix)
+            if entries is None:
+                # 在锁内生成缓存，不会把修改前的结果放进缓存
+                with self.lock:
+                    entries = self.cache[prefix] = self.top(prefix)
+        else:
+            entries = self.top(prefix)
+        return [{'name': self.names[entry], 'type': self.kinds[entry], 'id': self.ids[entry]}
+                for entry in entries if self.names[entry] is not None]
+
+
+def load_sku(sku_id):
+    """从数据库读取商品sku的条目，已经删除的返回None"""
+    sku = GoodsSKU.objects.filter(id=sku_id).values('name', 'sales').first()
+    return (sku['name'], sku['sales']) if sku else (None, 0)
+
+
+def load_spu(goods_id):
+    """从数据库读取商品spu的条目，销量是所有sku销量的和"""
+    goods = Goods.objects.filter(id=goods_id).values('name').first()
+    if goods is None:
+        return None, 0
+    sales = GoodsSKU.objects.filter(goods_id=goods_id).aggregate(sales=Sum('sales'))['sales']
+    return goods['name'], sales or 0
+
+
+def load_items():
+    """全量重建时的所有条目"""
+    spu_sales = dict(GoodsSKU.objects.values_list('goods_id').annotate(Sum('sales')).order_by())
+    for sku_id, name, sales in GoodsSKU.objects.values_list('id', 'name', 'sales').iterator():
+        yield SKU, sku_id, name, sales
+    for goods_id, name in Goods.objects.values_list('id', 'name').iterator():
+        yield SPU, goods_id, name, spu_sales.get(goods_id) or 0
+
+
+_index = None
+_index_lock = threading.Lock()
+_rebuilding = False
+# 启动订阅线程的进程id，fork出的子进程需要重新启动
+_listener_pid = None
+
+
+def refresh(kind, item_id):
+    """从数据库重新读取一个条目"""
+    index = _index
+    if index is None:
+        return
+    load = load_sku if kind == SKU else load_spu
+    index.update(kind, item_id, *load(item_id))
+
+
+def _mark_stale():
+    """索引可能错过了更新，下一次使用时在后台重建，重建期间继续使用旧的索引"""
+    index = _index
+    if index is not None:
+        index.built = 0
+
+
+def _listen():
+    """订阅索引更新的通知，断开后重新订阅成功时在后台全量重建"""
+    missed = False
+    while True:
+        try:
+            conn = get_redis_connection('default')
+        except NotImplementedError:
+            # 不是redis缓存(比如测试环境)，只有本进程，由notify直接更新
+            return
+        try:
+            pubsub = conn.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(SUGGEST_CHANNEL)
+            if missed:
+                # 断开期间可能错过了通知
+                _mark_stale()
+                missed = False
+            for message in pubsub.listen():
+                if message['type'] == 'message':
+                    kind, item_id, pid = message['data'].decode().split(':')
+                    if int(pid) == os.getpid():
+                        # 本进程发出的通知，notify中已经更新过
+                        continue
+                    # 订阅线程长期持有数据库连接，使用前检查连接是否超时
+                    db.close_old_connections()
+                    refresh(kind, int(item_id))
+        except Exception:
+            missed = True
+            time.sleep(1)
+
+
+def _rebuild():
+    global _index, _rebuilding
+    try:
+        _index = SuggestIndex().build(load_items())
+    finally:
+        _rebuilding = False
+        db.connection.close()
+
+
+def get_suggest_index():
+    """
+    本进程的前缀索引
+        第一次使用时同步建立，过期后在后台线程中重建，重建期间继续使用旧的索引
+    """
+    global _index, _rebuilding, _listener_pid
+    pid = os.getpid()
+    if _listener_pid != pid:
+        with _index_lock:
+            if _listener_pid != pid:
+                # fork出的进程没有继承订阅线程，错过的通知需要全量重建
+                _index = None
+                threading.Thread(target=_listen, name='goods-suggest-listener', daemon=True).start()
+                _listener_pid = pid
+
+    index = _index
+    if index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SuggestIndex().build(load_items())
+            index = _index
+    elif time.time() - index.built > SUGGEST_REBUILD_INTERVAL and not _rebuilding:
+        with _index_lock:
+            if not _rebuilding:
+                _rebuilding = True
+                threading.Thread(target=_rebuild, name='goods-suggest-rebuild', daemon=True).start()
+    return index
+
+
+def suggest(prefix):
+    return get_suggest_index().suggest(prefix)
+
+
+def notify(items):
+    """
+    商品sku或者商品spu发生变化，更新本进程的索引并通知其他进程，items为[(类型, 商品id)]
+        商品spu的销量是它的sku销量的和，sku变化时也要通知它的spu
+    """
+    for kind, item_id in items:
+        refresh(kind, item_id)
+    try:
+        conn = get_redis_connection('default')
+    except NotImplementedError:
+        # 不是redis缓存(比如测试环境)，只有本进程
+        return
+    pipe = conn.pipeline(transaction=False)
+    pid = os.getpid()
+    for kind, item_id in items:
+        pipe.publish(SUGGEST_CHANNEL, '%s:%d:%d' % (kind, item_id, pid))
+    pipe.execute()
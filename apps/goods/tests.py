@@ -1,3 +1,987 @@
-from django.test import TestCase
+import os
+import shutil
+import tempfile
+import redis
+import threading
+from unittest import mock
+from io import StringIO
+from datetime import timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.core.management import call_command
+from django.core.paginator import Paginator
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from django.utils.http import parse_http_date
 
 # Create your tests here.
+from apps.goods.models import *
+from apps.goods.loaders import load_index_page_data
+from apps.goods.cache import bump_list_versions, get_list_version, get_index_page_version
+from haystack import connections as haystack_connections, connection_router as haystack_router
+from haystack.models import SearchResult
+from haystack.query import SQ
+from haystack.utils.loading import ConnectionHandler
+from apps.goods import signals, search_queue, search, suggest, facets, search_rebuild
+from apps.goods.facets import count_facets, precompute_facets
+from apps.goods.search import SearchResultList
+from apps.goods.suggest import SuggestIndex
+from apps.goods.search import bump_search_version
+from apps.goods.search_queue import QueuedSignalProcessor
+from apps.goods.search_rebuild import split_id_ranges, changed_since, rebuild_all
+from apps.goods import sales
+from apps.goods.sales import HotSKUList, add_sales, add_sku, rebuild_sales, SKU_SALES_KEY, SKU_SALES_MEMBER, SKU_SALES_TMP_KEY, \
+    SKU_SALES_DELTA_KEY, SKU_SALES_REBUILDING_KEY, SKU_SALES_BUILT_KEY
+from apps.goods.stock import SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY, SKU_STOCK_FLUSHING_KEY, SKU_STOCK_FLUSH_BATCH_KEY, \
+    SKU_STOCK_FLUSH_LOCK, STOCK_FLUSH_KEEP, STOCK_RESERVED, STOCK_NOT_ENOUGH, reserve_stock, release_stock, \
+    flush_pending_stock
+from apps.cart.tests import get_local_redis
+from apps.goods.comments import get_comments, COMMENT_PAGE_SIZE
+from apps.goods.sku_cache import invalidate_skus
+from apps.goods.cache import DETAIL_PAGE_CSRF_PLACEHOLDER
+from apps.order.models import OrderInfo, OrderGoods
+from apps.user.models import User, Address
+from utils.pagination import CursorPaginator, get_page_range
+from django_redis import get_redis_connection
+from utils.redis_counter import CountingConnectionMixin
+from utils.ngram_backend import NgramSearchBackend, NgramSearchQuery, tokenize, query_terms
+
+LOCMEM_CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
+
+class IndexPageDataTest(TestCase):
+    """首页数据查询次数测试"""
+
+    def create_types(self, num):
+        """创建num个商品种类，每个种类下有两个图片展示商品和一个标题展示商品"""
+        goods = Goods.objects.create(name='草莓')
+        for i in range(num):
+            type = GoodsType.objects.create(name='种类%d' % i, logo='fruit', image='type.jpg')
+            for display_type, index in [(1, 0), (1, 1), (0, 2)]:
+                sku = GoodsSKU.objects.create(type=type, goods=goods, name='商品%d' % index, desc='简介',
+                                              price=10, unite='500g', image='sku.jpg')
+                IndexTypeGoodsBanner.objects.create(type=type, sku=sku, display_type=display_type, index=index)
+
+    def test_query_count_is_constant(self):
+        """查询次数和商品种类的数目无关"""
+        self.create_types(1)
+        with self.assertNumQueries(4):
+            context = load_index_page_data()
+            # 访问sku不会再查询数据库
+            [banner.sku.name for type in context['types'] for banner in type.image_banners]
+
+        self.create_types(10)
+        with self.assertNumQueries(4):
+            context = load_index_page_data()
+            [banner.sku.name for type in context['types'] for banner in type.image_banners]
+
+    def test_banners_grouped_by_display_type(self):
+        """图片展示和标题展示的商品分开保存"""
+        self.create_types(2)
+        context = load_index_page_data()
+        for type in context['types']:
+            self.assertEqual([banner.index for banner in type.image_banners], [0, 1])
+            self.assertEqual([banner.index for banner in type.title_banners], [2])
+            self.assertTrue(all(banner.type_id == type.id for banner in type.image_banners))
+
+    @override_settings(CACHES=LOCMEM_CACHES)
+    def test_index_view_query_count(self):
+        """首页视图查询次数和商品种类的数目无关"""
+        self.create_types(10)
+        with self.assertNumQueries(4):
+            response = self.client.get('/')
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class IndexPageVersionTest(TestCase):
+    """首页缓存版本号测试"""
+
+    def test_bump_after_commit(self):
+        """首页数据修改后，事务提交时版本号才加1"""
+        cache.clear()
+        version = get_index_page_version()
+        callbacks = []
+        with mock.patch.object(signals.transaction, 'on_commit', side_effect=callbacks.append):
+            GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        self.assertEqual(get_index_page_version(), version)
+        for callback in callbacks:
+            callback()
+        self.assertEqual(get_index_page_version(), version + 1)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CursorPaginatorTest(TestCase):
+    """列表页游标分页测试"""
+
+    orderings = [('-id',), ('price', 'id'), ('-sales', '-id')]
+
+    def setUp(self):
+        cache.clear()
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='草莓')
+        # 价格和销量有重复，依靠id保证顺序稳定
+        for i in range(20):
+            GoodsSKU.objects.create(type=type, goods=goods, name='商品%d' % i, desc='简介', price=i % 4,
+                                    sales=i % 3, unite='500g', image='sku.jpg')
+        self.skus = GoodsSKU.objects.filter(type=type)
+
+    def paginator(self, ordering):
+        return CursorPaginator(self.skus, 3, ordering, count_key='test_count')
+
+    def ids(self, page):
+        return [sku.id for sku in page]
+
+    def test_walk_forward_and_backward(self):
+        """使用游标前后翻页的结果和OFFSET分页一致"""
+        for ordering in self.orderings:
+            expected = list(self.skus.order_by(*ordering).values_list('id', flat=True))
+            paginator = self.paginator(ordering)
+            page = paginator.page(1)
+            pages = [self.ids(page)]
+            while page.has_next():
+                page = paginator.page(page.next_page_number(), page.next_cursor)
+                pages.append(self.ids(page))
+            self.assertEqual(sum(pages, []), expected)
+            self.assertEqual(page.number, 7)
+            self.assertEqual(paginator.num_pages, 7)
+
+            while page.has_previous():
+                page = paginator.page(page.previous_page_number(), page.previous_cursor)
+                self.assertEqual(self.ids(page), pages[page.number - 1])
+            self.assertEqual(page.number, 1)
+
+    def test_jump_within_page_range(self):
+        """页码按钮从游标的位置跳过相差的页数"""
+        paginator = self.paginator(('price', 'id'))
+        page = paginator.page(3)
+        self.assertEqual(self.ids(paginator.page(5, page.next_cursor)), self.ids(paginator.page(5)))
+        self.assertEqual(self.ids(paginator.page(1, page.previous_cursor)), self.ids(paginator.page(1)))
+
+    def test_seek_does_not_count(self):
+        """总数缓存后，按照游标翻页只需要一次查询"""
+        paginator = self.paginator(('-sales', '-id'))
+        page = paginator.page(1)
+        with self.assertNumQueries(1):
+            self.ids(paginator.page(2, page.next_cursor))
+
+    def test_invalid_cursor(self):
+        """被篡改的游标使用OFFSET分页"""
+        paginator = self.paginator(('-id',))
+        page = paginator.page(2, 'bad-cursor')
+        self.assertEqual(self.ids(page), self.ids(paginator.page(2)))
+
+    def test_page_range(self):
+        """最多显示5个页码按钮"""
+        self.assertEqual(list(get_page_range(1, 3)), [1, 2, 3])
+        self.assertEqual(list(get_page_range(1, 8)), [1, 2, 3, 4, 5])
+        self.assertEqual(list(get_page_range(5, 8)), [3, 4, 5, 6, 7])
+        self.assertEqual(list(get_page_range(8, 8)), [4, 5, 6, 7, 8])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ListFragmentCacheTest(TestCase):
+    """列表页片段缓存测试"""
+
+    def setUp(self):
+        cache.clear()
+        self.goods = Goods.objects.create(name='草莓')
+        self.types = [GoodsType.objects.create(name='种类%d' % i, logo='fruit', image='type.jpg') for i in range(2)]
+        for type in self.types:
+            self.create_sku(type, '商品')
+
+    def create_sku(self, type, name):
+        return GoodsSKU.objects.create(type=type, goods=self.goods, name=name, desc='简介', price=10,
+                                       unite='500g', image='sku.jpg')
+
+    def get_list(self, type, sort='default'):
+        response = self.client.get('/list/%d/1' % type.id, {'sort': sort})
+        self.assertEqual(response.status_code, 200)
+        return response.content.decode()
+
+    def test_cached_page_does_not_query(self):
+        """片段缓存命中时不查询数据库"""
+        self.get_list(self.types[0])
+        with self.assertNumQueries(0):
+            self.get_list(self.types[0])
+
+    def test_version_bump_only_invalidates_its_type(self):
+        """种类的版本号加1后只有这个种类的列表页重新查询"""
+        for type in self.types:
+            self.get_list(type)
+            self.create_sku(type, '新商品')
+
+        bump_list_versions([self.types[0].id])
+        self.assertIn('新商品', self.get_list(self.types[0]))
+        self.assertNotIn('新商品', self.get_list(self.types[1]))
+
+    def test_sku_signal_bumps_old_and_new_type(self):
+        """商品换了种类时，原来的种类和新的种类的版本号都加1"""
+        sku = GoodsSKU.objects.filter(type=self.types[0]).first()
+        versions = [get_list_version(type.id) for type in self.types]
+        sku.type = self.types[1]
+        sku.save()
+        # 测试中事务不会提交，直接执行提交后的回调
+        with mock.patch.object(signals.transaction, 'on_commit', side_effect=lambda func: func()):
+            signals.sku_list_changed(GoodsSKU, sku)
+        self.assertEqual([get_list_version(type.id) for type in self.types], [version + 1 for version in versions])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SalesRankingTest(TestCase):
+    """redis销量排行测试，需要本地redis"""
+
+    def setUp(self):
+        self.conn = get_local_redis()
+        if self.conn is None:
+            self.skipTest('本地redis不可用')
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='草莓')
+        self.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='商品%d' % i, desc='简介', price=10,
+                                             sales=i * 10, unite='500g', image='sku.jpg') for i in range(7)]
+        self.type_id = type.id
+        self.clear_redis()
+
+    def tearDown(self):
+        self.clear_redis()
+
+    def clear_redis(self):
+        self.conn.delete(SKU_STOCK_PENDING_KEY, *[key % self.type_id for key in (
+            SKU_SALES_KEY, SKU_SALES_TMP_KEY, SKU_SALES_DELTA_KEY, SKU_SALES_REBUILDING_KEY, SKU_SALES_BUILT_KEY)])
+
+    def page_ids(self, number):
+        paginator = Paginator(HotSKUList(self.conn, self.type_id), 3)
+        return [sku.id for sku in paginator.page(number)]
+
+    def test_rebuilt_from_database_and_paged(self):
+        """排行不存在时从数据库生成，按销量从高到低分页，包含还没有写回数据库的销量"""
+        self.conn.hset(SKU_STOCK_PENDING_KEY, self.skus[0].id, 100)
+        ids = [sku.id for sku in self.skus]
+        expected = [ids[0]] + ids[:0:-1]
+        self.assertEqual(self.page_ids(1) + self.page_ids(2) + self.page_ids(3), expected)
+
+    def test_order_commit_increments(self):
+        """订单提交后累加的销量改变排序"""
+        self.assertEqual(rebuild_sales(self.conn, self.type_id), 7)
+        add_sales(self.conn, [(self.type_id, self.skus[1].id, 100)])
+        self.assertEqual(self.page_ids(1)[0], self.skus[1].id)
+        self.assertEqual(self.conn.zscore(SKU_SALES_KEY % self.type_id, SKU_SALES_MEMBER % self.skus[1].id), 110)
+
+    def test_missing_ranking_not_recreated_partially(self):
+        """排行被清空后累加销量不会生成只有一个商品的排行，下一次分页时完整地重新生成"""
+        rebuild_sales(self.conn, self.type_id)
+        self.conn.delete(SKU_SALES_KEY % self.type_id)
+        add_sales(self.conn, [(self.type_id, self.skus[1].id, 100)])
+        self.assertFalse(self.conn.exists(SKU_SALES_KEY % self.type_id))
+        self.assertEqual(len(HotSKUList(self.conn, self.type_id)), 7)
+
+        # 只有生成标记被淘汰时也会重新生成
+        self.conn.delete(SKU_SALES_BUILT_KEY % self.type_id)
+        self.conn.zrem(SKU_SALES_KEY % self.type_id, SKU_SALES_MEMBER % self.skus[0].id)
+        self.assertEqual(len(HotSKUList(self.conn, self.type_id)), 7)
+
+    def test_increments_during_rebuild_kept(self):
+        """重新生成期间累加的销量合并到新的排行中"""
+        rebuild_sales(self.conn, self.type_id)
+        hgetall = self.conn.hgetall
+
+        def sell_during_rebuild(key):
+            if key == SKU_STOCK_PENDING_KEY:
+                add_sales(self.conn, [(self.type_id, self.skus[1].id, 100)])
+            return hgetall(key)
+        with mock.patch.object(self.conn, 'hgetall', side_effect=sell_during_rebuild):
+            self.assertEqual(rebuild_sales(self.conn, self.type_id), 7)
+        self.assertEqual(self.conn.zscore(SKU_SALES_KEY % self.type_id, SKU_SALES_MEMBER % self.skus[1].id), 110)
+        self.assertFalse(self.conn.exists(SKU_SALES_DELTA_KEY % self.type_id, SKU_SALES_TMP_KEY % self.type_id))
+
+    def test_concurrent_rebuild_skipped(self):
+        """正在重新生成时其他请求不重复生成，没有排行时在数据库中按销量排序"""
+        hgetall = self.conn.hgetall
+        ids = [sku.id for sku in self.skus]
+        pages = []
+
+        def request_during_rebuild(key):
+            if key == SKU_STOCK_PENDING_KEY:
+                self.assertIsNone(rebuild_sales(self.conn, self.type_id))
+                pages.append(self.page_ids(1))
+            return hgetall(key)
+        with mock.patch.object(self.conn, 'hgetall', side_effect=request_during_rebuild):
+            self.assertEqual(rebuild_sales(self.conn, self.type_id), 7)
+        self.assertEqual(pages, [ids[:-4:-1]])
+        self.assertEqual(self.page_ids(1), ids[:-4:-1])
+        self.assertFalse(self.conn.exists(SKU_SALES_REBUILDING_KEY % self.type_id))
+
+    def test_lost_lock_not_published(self):
+        """锁过期后被其他进程获取时不替换排行"""
+        hgetall = self.conn.hgetall
+
+        def lock_expired(key):
+            if key == SKU_STOCK_PENDING_KEY:
+                self.conn.set(SKU_SALES_REBUILDING_KEY % self.type_id, 'other')
+            return hgetall(key)
+        with mock.patch.object(self.conn, 'hgetall', side_effect=lock_expired):
+            self.assertIsNone(rebuild_sales(self.conn, self.type_id))
+        self.assertFalse(self.conn.exists(SKU_SALES_KEY % self.type_id, SKU_SALES_BUILT_KEY % self.type_id))
+
+    def test_empty_type_not_rebuilt(self):
+        """没有商品的种类只生成一次，之后加入的商品直接进入排行"""
+        GoodsSKU.objects.filter(type_id=self.type_id).delete()
+        self.assertEqual(len(HotSKUList(self.conn, self.type_id)), 0)
+        with mock.patch.object(sales, 'rebuild_sales') as rebuild:
+            self.assertEqual(len(HotSKUList(self.conn, self.type_id)), 0)
+        self.assertFalse(rebuild.called)
+
+        add_sku(self.conn, self.type_id, self.skus[0].id, 5)
+        with mock.patch.object(sales, 'rebuild_sales') as rebuild:
+            self.assertEqual(len(HotSKUList(self.conn, self.type_id)), 1)
+        self.assertFalse(rebuild.called)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StockReserveTest(TestCase):
+    """redis库存镜像预扣、归还和写回测试，需要本地redis"""
+
+    keys = (SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY, SKU_STOCK_FLUSHING_KEY, SKU_STOCK_FLUSH_BATCH_KEY,
+            SKU_STOCK_FLUSH_LOCK)
+
+    def setUp(self):
+        self.conn = get_local_redis()
+        if self.conn is None:
+            self.skipTest('本地redis不可用')
+        self.conn.delete(*self.keys)
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='草莓')
+        self.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='商品%d' % i, desc='简介', price=10,
+                                             stock=stock, unite='500g', image='sku.jpg')
+                     for i, stock in enumerate([10, 5])]
+        self.ids = [sku.id for sku in self.skus]
+
+    def tearDown(self):
+        self.conn.delete(*self.keys)
+
+    def mirror(self, key=SKU_STOCK_KEY):
+        return [int(self.conn.hget(key, sku_id) or 0) for sku_id in self.ids]
+
+    def db_stocks(self):
+        return [GoodsSKU.objects.get(id=sku_id).stock for sku_id in self.ids]
+
+    def test_reserve_all_or_nothing(self):
+        """有一个商品库存不足时一个都不扣减"""
+        a, b = self.ids
+        self.assertEqual(reserve_stock(self.conn, {a: 3, b: 6}), (STOCK_NOT_ENOUGH, b))
+        self.assertEqual(self.mirror(), [10, 5])
+        self.assertEqual(self.mirror(SKU_STOCK_PENDING_KEY), [0, 0])
+
+        self.assertEqual(reserve_stock(self.conn, {a: 3, b: 5}), (STOCK_RESERVED, None))
+        self.assertEqual(self.mirror(), [7, 0])
+        self.assertEqual(self.mirror(SKU_STOCK_PENDING_KEY), [3, 5])
+        self.assertEqual(reserve_stock(self.conn, {b: 1}), (STOCK_NOT_ENOUGH, b))
+
+        release_stock(self.conn, {a: 3, b: 5})
+        self.assertEqual(self.mirror(), [10, 5])
+        self.assertEqual(self.mirror(SKU_STOCK_PENDING_KEY), [0, 0])
+
+    def test_flush_and_reconcile_after_crash(self):
+        """写回的事务提交后崩溃，对账时不会重复扣减数据库库存"""
+        a, b = self.ids
+        reserve_stock(self.conn, {a: 3, b: 2})
+        delete = self.conn.delete
+
+        def crash(*keys):
+            if SKU_STOCK_FLUSHING_KEY in keys:
+                raise ConnectionError('crashed')
+            return delete(*keys)
+        with mock.patch.object(self.conn, 'delete', side_effect=crash):
+            with self.assertRaises(ConnectionError):
+                flush_pending_stock(self.conn)
+        self.assertEqual(self.db_stocks(), [7, 3])
+        self.assertEqual(self.mirror(SKU_STOCK_FLUSHING_KEY), [3, 2])
+
+        out = StringIO()
+        with mock.patch('apps.goods.management.commands.reconcile_stock.get_redis_connection',
+                        return_value=self.conn):
+            call_command('reconcile_stock', stdout=out)
+        self.assertIn('发现0个商品不一致', out.getvalue())
+        self.assertEqual(self.db_stocks(), [7, 3])
+        self.assertEqual([sku.sales for sku in GoodsSKU.objects.filter(id__in=self.ids).order_by('id')], [3, 2])
+        self.assertFalse(self.conn.exists(SKU_STOCK_FLUSHING_KEY, SKU_STOCK_FLUSH_BATCH_KEY))
+
+        # 之后的预扣使用新的批次正常写回
+        reserve_stock(self.conn, {a: 1})
+        self.assertEqual(flush_pending_stock(self.conn), 1)
+        self.assertEqual(self.db_stocks(), [6, 3])
+        self.assertEqual(self.mirror(), [6, 3])
+
+    def test_flush_keeps_others_lock_and_prunes_batches(self):
+        """写回超过锁的过期时间时不删除其他进程的锁，写回后删除过期的批次"""
+        old = StockFlush.objects.create(batch_id='old')
+        StockFlush.objects.filter(id=old.id).update(create_time=timezone.now() - STOCK_FLUSH_KEEP - timedelta(hours=1))
+        recent = StockFlush.objects.create(batch_id='recent')
+        reserve_stock(self.conn, {self.ids[0]: 1})
+        atomic = transaction.atomic
+
+        def lock_expired(*args, **kwargs):
+            # 写回期间锁过期，被其他进程获取
+            self.conn.set(SKU_STOCK_FLUSH_LOCK, 'other')
+            return atomic(*args, **kwargs)
+        with mock.patch('apps.goods.stock.transaction.atomic', side_effect=lock_expired):
+            self.assertEqual(flush_pending_stock(self.conn), 1)
+        self.assertEqual(self.conn.get(SKU_STOCK_FLUSH_LOCK), b'other')
+        self.assertFalse(StockFlush.objects.filter(id=old.id).exists())
+        self.assertTrue(StockFlush.objects.filter(id=recent.id).exists())
+        self.assertEqual(StockFlush.objects.count(), 2)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CommentPageTest(TestCase):
+    """商品评论分页测试"""
+
+    def setUp(self):
+        cache.clear()
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='草莓')
+        self.sku = GoodsSKU.objects.create(type=type, goods=goods, name='草莓', desc='简介', price=10,
+                                           unite='500g', image='sku.jpg')
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'password')
+        self.addr = Address.objects.create(user=self.user, receiver='buyer', addr='addr', phone='13800000000')
+        self.num_orders = 0
+
+    def create_order_goods(self, comment):
+        self.num_orders += 1
+        order = OrderInfo.objects.create(order_id='%019d' % self.num_orders, user=self.user, addr=self.addr,
+                                         total_price=10, transit_price=10, order_status=4)
+        return OrderGoods.objects.create(order=order, sku=self.sku, count=1, price=10, comment=comment)
+
+    def test_pages_newest_first(self):
+        """评论按照时间倒序分页，没有评论的订单商品不显示"""
+        for i in range(COMMENT_PAGE_SIZE * 2 + 5):
+            self.create_order_goods('评论%d' % i)
+        self.create_order_goods('')
+
+        response = self.client.get('/goods/%d/comments' % self.sku.id, {'page': 3}).json()
+        self.assertEqual(response['num_pages'], 3)
+        self.assertEqual([comment['comment'] for comment in response['comments']],
+                         ['评论%d' % i for i in range(4, -1, -1)])
+        self.assertEqual(response['comments'][0]['username'], 'buyer')
+
+    def test_first_page_cached_until_comment(self):
+        """第一页和总数缓存，提交评论后清除"""
+        self.create_order_goods('好吃')
+        order_goods = self.create_order_goods('')
+        get_comments(self.sku.id)
+        with self.assertNumQueries(0):
+            comments, num_pages = get_comments(self.sku.id)
+        self.assertEqual([comment['comment'] for comment in comments], ['好吃'])
+
+        self.client.force_login(self.user)
+        self.client.post('/order/comment/%s' % order_goods.order_id,
+                         {'total_count': 1, 'sku_1': self.sku.id, 'content_1': '新鲜'})
+        comments, num_pages = get_comments(self.sku.id)
+        self.assertEqual([comment['comment'] for comment in comments], ['新鲜', '好吃'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DetailPageCacheTest(TestCase):
+    """未登录用户商品详情页整页缓存测试"""
+
+    def setUp(self):
+        cache.clear()
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        self.goods = Goods.objects.create(name='草莓', detail='详情')
+        self.sku = GoodsSKU.objects.create(type=type, goods=self.goods, name='草莓', desc='简介', price=10,
+                                           unite='500g', image='sku.jpg')
+        # 清除其他测试留下的进程内快照
+        invalidate_skus([self.sku.id])
+        self.url = '/goods/%d' % self.sku.id
+
+    def test_cached_page_and_not_modified(self):
+        """第二次访问不查询数据库，带有ETag的重复访问返回304"""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(DETAIL_PAGE_CSRF_PLACEHOLDER, response.content.decode())
+        self.assertIn('csrfmiddlewaretoken', response.content.decode())
+
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(DETAIL_PAGE_CSRF_PLACEHOLDER, response.content.decode())
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_image_and_spu_changes_invalidate(self):
+        """商品图片和商品SPU变化时重新生成"""
+        etag = self.client.get(self.url)['ETag']
+        with mock.patch.object(signals.transaction, 'on_commit', side_effect=lambda func: func()):
+            image = GoodsImage.objects.create(sku=self.sku, image='detail.jpg')
+            signals.image_detail_changed(GoodsImage, image)
+        response = self.client.get(self.url)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertIn('detail.jpg', response.content.decode())
+
+        self.goods.detail = '新的详情'
+        self.goods.save()
+        with mock.patch.object(signals.transaction, 'on_commit', side_effect=lambda func: func()):
+            signals.spu_detail_changed(Goods, self.goods)
+        self.assertIn('新的详情', self.client.get(self.url).content.decode())
+
+    def test_last_modified_follows_content(self):
+        """页面内容变化时Last-Modified变晚，之前的If-Modified-Since不再返回304，内容不变时保持不变"""
+        response = self.client.get(self.url)
+        last_modified = response['Last-Modified']
+
+        # 版本号变化但是内容不变
+        bump_list_versions([self.sku.type_id])
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # 同种类的新品只改变页面内容，不改变商品和商品SPU的修改时间
+        GoodsSKU.objects.create(type=self.sku.type, goods=self.goods, name='新品草莓', desc='简介', price=10,
+                                unite='500g', image='new.jpg')
+        bump_list_versions([self.sku.type_id])
+        response = self.client.get(self.url, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('新品草莓', response.content.decode())
+        self.assertGreater(parse_http_date(response['Last-Modified']), parse_http_date(last_modified))
+
+
+
+class SearchQueueTest(TestCase):
+    """全文索引队列测试"""
+
+    def setUp(self):
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        self.goods = Goods.objects.create(name='草莓', detail='详情')
+        self.skus = [GoodsSKU.objects.create(type=type, goods=self.goods, name='商品%d' % i, desc='简介', price=10,
+                                             unite='500g', image='sku.jpg') for i in range(2)]
+        self.processor = QueuedSignalProcessor(haystack_connections, haystack_router)
+        self.processor.teardown()
+
+    def saved_ids(self, instance):
+        """保存后在事务提交时放入队列的sku_id"""
+        instance.save()
+        with mock.patch.object(search_queue.transaction, 'on_commit', side_effect=lambda func: func()), \
+                mock.patch.object(search_queue, 'get_redis_connection'), \
+                mock.patch.object(search_queue, 'enqueue_skus') as enqueue_skus:
+            self.processor.handle_save(type(instance), instance)
+        return enqueue_skus.call_args[0][1] if enqueue_skus.called else []
+
+    def test_stock_and_sales_do_not_enqueue(self):
+        """只修改了库存和销量时不更新索引"""
+        sku = GoodsSKU.objects.get(id=self.skus[0].id)
+        sku.stock -= 1
+        sku.sales += 1
+        self.assertEqual(self.saved_ids(sku), [])
+
+    def test_indexed_fields_enqueue(self):
+        """修改了名称或者商品SPU时更新索引"""
+        sku = GoodsSKU.objects.get(id=self.skus[0].id)
+        sku.name = '新名称'
+        self.assertEqual(self.saved_ids(sku), [sku.id])
+        self.assertEqual(sorted(self.saved_ids(self.goods)), [sku.id for sku in self.skus])
+
+
+class SearchRebuildTest(TestCase):
+    """全文索引重建测试"""
+
+    def test_split_id_ranges(self):
+        """id区间分给多个进程，不重不漏"""
+        self.assertEqual(split_id_ranges(1, 10, 3), [(1, 5), (5, 9), (9, 11)])
+        self.assertEqual(split_id_ranges(5, 5, 4), [(5, 6)])
+        ids = set()
+        for start, end in split_id_ranges(3, 1000, 7):
+            ids.update(range(start, end))
+        self.assertEqual(ids, set(range(3, 1001)))
+
+    def test_changed_since(self):
+        """增量重建只取上次重建之后修改过的商品和商品SPU下的商品"""
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = [Goods.objects.create(name='商品%d' % i) for i in range(2)]
+        skus = [GoodsSKU.objects.create(type=type, goods=goods[i % 2], name='商品%d' % i, desc='简介', price=10,
+                                        unite='500g', image='sku.jpg') for i in range(4)]
+        since = timezone.now()
+        GoodsSKU.objects.filter(id__lt=skus[3].id).update(update_time=since - timedelta(hours=1))
+        GoodsSKU.objects.filter(id=skus[3].id).update(update_time=since)
+        Goods.objects.update(update_time=since - timedelta(hours=1))
+        Goods.objects.filter(id=goods[0].id).update(update_time=since)
+
+        changed = changed_since(GoodsSKU.objects.all(), since).order_by('id')
+        self.assertEqual([sku.id for sku in changed], [skus[0].id, skus[2].id, skus[3].id])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class FullRebuildTest(TestCase):
+    """全文索引全量重建测试，需要本地redis"""
+
+    keys = (search_rebuild.SEARCH_WATERMARK_KEY, search_queue.SEARCH_QUEUE_KEY, search_queue.SEARCH_PAUSED_KEY)
+
+    def setUp(self):
+        self.conn = get_local_redis()
+        if self.conn is None:
+            self.skipTest('本地redis不可用')
+        self.conn.delete(*self.keys)
+        cache.clear()
+
+    def tearDown(self):
+        self.conn.delete(*self.keys)
+
+    def search_connections(self, engine='haystack.backends.whoosh_backend.WhooshEngine'):
+        """临时目录中的索引"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        connections_info = {'default': {'ENGINE': engine, 'PATH': os.path.join(path, 'index')}}
+        # haystack的后端从settings中读取PATH
+        override = override_settings(HAYSTACK_CONNECTIONS=connections_info)
+        override.enable()
+        self.addCleanup(override.disable)
+        return ConnectionHandler(connections_info)
+
+    def rebuild(self, connections, workers):
+        """全量重建，多个进程在当前进程中依次执行，返回搜索apple的结果"""
+        with mock.patch.object(search_rebuild, 'connections', connections), \
+                mock.patch('haystack.connections', connections), \
+                mock.patch.object(search_rebuild.db.connections, 'close_all'), \
+                mock.patch.object(search_rebuild.multiprocessing, 'get_context') as get_context:
+            pool = get_context.return_value.Pool.return_value.__enter__.return_value
+            pool.map.side_effect = lambda func, tasks: list(map(func, tasks))
+            count = rebuild_all(self.conn, workers=workers, batch_size=3)
+        self.assertEqual(get_context.called, workers > 1 and hasattr(connections['default'].get_backend(),
+                                                                     'use_file_storage'))
+        results = connections['default'].get_backend().search('apple')['results']
+        return count, sorted(int(result.pk) for result in results)
+
+    def test_parallel_rebuild_same_as_serial(self):
+        """两个进程重建后合并的索引和一个进程重建的搜索结果相同，原来索引中的文档被替换"""
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='苹果', detail='detail')
+        skus = [GoodsSKU.objects.create(type=type, goods=goods, name='apple %d' % i, desc='简介', price=10,
+                                        unite='500g', image='sku.jpg') for i in range(7)]
+        serial = self.rebuild(self.search_connections(), 1)
+        self.assertEqual(serial, (7, [sku.id for sku in skus]))
+
+        connections = self.search_connections()
+        stale = GoodsSKU(id=skus[-1].id + 100, type=type, goods=goods, name='apple stale')
+        connections['default'].get_backend().update(search_rebuild.get_sku_index(), [stale])
+        self.assertEqual(self.rebuild(connections, 2), serial)
+        self.assertIsNotNone(search_rebuild.get_watermark(self.conn))
+
+    def test_ngram_rebuild_serial(self):
+        """二元分词索引不能合并whoosh目录，清空后在当前进程中写入"""
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='苹果', detail='detail')
+        skus = [GoodsSKU.objects.create(type=type, goods=goods, name='apple %d' % i, desc='简介', price=10,
+                                        unite='500g', image='sku.jpg') for i in range(5)]
+        connections = self.search_connections('utils.ngram_backend.NgramEngine')
+        stale = GoodsSKU(id=skus[-1].id + 100, type=type, goods=goods, name='apple stale')
+        connections['default'].get_backend().update(search_rebuild.get_sku_index(), [stale])
+        self.assertEqual(self.rebuild(connections, 2), (5, [sku.id for sku in skus]))
+
+    def test_queue_paused_during_rebuild(self):
+        """重建期间不取出队列，合并之后再更新队列中的商品"""
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='苹果', detail='detail')
+        sku = GoodsSKU.objects.create(type=type, goods=goods, name='apple', desc='简介', price=10,
+                                      unite='500g', image='sku.jpg')
+        search_queue.enqueue_skus(self.conn, [sku.id])
+        merge_parts = search_rebuild.merge_parts
+
+        def merge_while_queued(index, paths):
+            # 合并前处理队列时什么都不做
+            self.assertEqual(search_queue.apply_search_queue(self.conn), 0)
+            self.assertEqual(self.conn.scard(search_queue.SEARCH_QUEUE_KEY), 1)
+            merge_parts(index, paths)
+
+        with mock.patch.object(search_rebuild, 'merge_parts', side_effect=merge_while_queued):
+            self.assertEqual(self.rebuild(self.search_connections(), 1), (1, [sku.id]))
+        self.assertFalse(self.conn.exists(search_queue.SEARCH_QUEUE_KEY, search_queue.SEARCH_PAUSED_KEY))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchViewTest(TestCase):
+    """搜索结果缓存测试"""
+
+    def setUp(self):
+        cache.clear()
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='草莓')
+        self.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='草莓%d' % i, desc='简介', price=10,
+                                             unite='500g', image='sku.jpg') for i in range(3)]
+        invalidate_skus([sku.id for sku in self.skus])
+        self.result = SearchResult('goods', 'goodssku', self.skus[1].id, 1)
+
+    def search(self, q):
+        response = self.client.get('/search', {'q': q})
+        self.assertEqual(response.status_code, 200)
+        return [sku.id for sku in response.context['page']]
+
+    def test_cached_ids_and_version(self):
+        """同一个规范化后的搜索词只检索一次，索引更新后重新检索"""
+        queryset = mock.MagicMock()
+        queryset.count.return_value = 1
+        queryset.__getitem__.return_value = [self.result]
+        with mock.patch.object(search, 'search_queryset', return_value=queryset) as search_queryset:
+            self.assertEqual(self.search('草莓'), [self.skus[1].id])
+            self.assertEqual(self.search('  草莓 '), [self.skus[1].id])
+            self.assertEqual(search_queryset.call_count, 1)
+
+            bump_search_version()
+            self.search('草莓')
+            self.assertEqual(search_queryset.call_count, 2)
+
+    def test_bulk_hydration(self):
+        """一页的商品只查询一次数据库"""
+        queryset = mock.MagicMock()
+        queryset.count.return_value = 3
+        queryset.__getitem__.return_value = [SearchResult('goods', 'goodssku', sku.id, 1) for sku in self.skus]
+        with mock.patch.object(search, 'search_queryset', return_value=queryset):
+            # 首页缓存的种类、商品快照各一次，分面统计两次
+            with self.assertNumQueries(4):
+                self.assertEqual(self.search('草莓'), [sku.id for sku in self.skus])
+
+
+class SuggestTest(TestCase):
+    """输入提示前缀索引测试"""
+
+    def test_prefix_rank_and_update(self):
+        """按照前缀查找，销量高的在前，更新和删除后缓存的前缀失效"""
+        index = SuggestIndex().build([
+            (suggest.SKU, 1, '草莓 500g', 10),
+            (suggest.SKU, 2, '草莓 1kg', 30),
+            (suggest.SPU, 1, '草莓', 40),
+            (suggest.SKU, 3, '苹果', 100),
+        ])
+        self.assertEqual([item['name'] for item in index.suggest('草')], ['草莓', '草莓 1kg', '草莓 500g'])
+        self.assertEqual([item['name'] for item in index.suggest('草莓5')], ['草莓 500g'])
+        self.assertEqual(index.suggest('香'), [])
+
+        index.update(suggest.SKU, 1, '草莓 500g', 50)
+        index.update(suggest.SKU, 2, None, 0)
+        self.assertEqual([item['name'] for item in index.suggest('草')], ['草莓 500g', '草莓'])
+        self.assertEqual(index.suggest('草')[0], {'name': '草莓 500g', 'type': 'sku', 'id': 1})
+
+    def test_signal_updates_index(self):
+        """商品保存后更新输入提示，SPU的销量是商品销量的和"""
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='苹果')
+        with mock.patch.object(suggest, '_index', SuggestIndex().build(suggest.load_items())):
+            self.assertEqual(self.client.get('/search/suggest', {'q': '苹'}).json()['suggestions'],
+                             [{'name': '苹果', 'type': 'spu', 'id': goods.id}])
+
+            sku = GoodsSKU.objects.create(type=type, goods=goods, name='苹果 5kg', desc='简介', price=10,
+                                          unite='5kg', image='sku.jpg', sales=7)
+            # redis缓存时本进程直接更新，再通知其他进程
+            conn = mock.MagicMock()
+            with mock.patch.object(signals.transaction, 'on_commit', side_effect=lambda func: func()), \
+                    mock.patch.object(suggest, 'get_redis_connection', return_value=conn):
+                signals.suggest_changed(GoodsSKU, sku)
+            response = self.client.get('/search/suggest', {'q': '苹'})
+            self.assertEqual(sorted(item['name'] for item in response.json()['suggestions']), ['苹果', '苹果 5kg'])
+            self.assertEqual(suggest._index.sales[suggest._index.entries[(suggest.SPU, goods.id)]], 7)
+            conn.pipeline().publish.assert_any_call(suggest.SUGGEST_CHANNEL, 'sku:%d:%d' % (sku.id, os.getpid()))
+
+    def test_disconnect_rebuilds_in_background(self):
+        """订阅断开后重新订阅时标记索引过期，后台重建，请求中继续使用旧的索引"""
+        class StopListening(BaseException):
+            pass
+
+        index = SuggestIndex().build([(suggest.SKU, 1, '草莓', 10)])
+        conn = mock.MagicMock()
+        pubsub = mock.MagicMock()
+        conn.pubsub.side_effect = [redis.ConnectionError('down'), redis.ConnectionError('down'), pubsub]
+        pubsub.listen.side_effect = StopListening
+        with mock.patch.object(suggest, '_index', index), \
+                mock.patch.object(suggest, '_listener_pid', os.getpid()), \
+                mock.patch.object(suggest, 'get_redis_connection', return_value=conn), \
+                mock.patch.object(suggest.time, 'sleep') as sleep:
+            with self.assertRaises(StopListening):
+                suggest._listen()
+            self.assertEqual(sleep.call_count, 2)
+            self.assertEqual(index.built, 0)
+
+            with mock.patch.object(suggest.threading, 'Thread') as thread, \
+                    mock.patch.object(suggest, '_rebuilding', False):
+                self.assertIs(suggest.get_suggest_index(), index)
+            self.assertIs(thread.call_args[1]['target'], suggest._rebuild)
+
+    def test_pinyin_initials(self):
+        """可以用拼音首字母查找，英文和数字原样保留"""
+        self.assertEqual(suggest.pinyin_initials('草莓500g'), 'cm500g')
+        index = SuggestIndex().build([(suggest.SKU, 1, '草莓', 10), (suggest.SKU, 2, '葡萄', 20)])
+        self.assertEqual([item['name'] for item in index.suggest('cm')], ['草莓'])
+        self.assertEqual([item['name'] for item in index.suggest('C')], ['草莓'])
+        index.update(suggest.SKU, 1, '橙子', 10)
+        self.assertEqual(index.suggest('cm'), [])
+        self.assertEqual([item['name'] for item in index.suggest('cz')], ['橙子'])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SearchFacetTest(TestCase):
+    """搜索结果分面统计和筛选测试"""
+
+    def setUp(self):
+        cache.clear()
+        self.types = [GoodsType.objects.create(name='种类%d' % i, logo='fruit', image='type.jpg') for i in range(2)]
+        goods = Goods.objects.create(name='草莓')
+        self.skus = [GoodsSKU.objects.create(type=self.types[i % 2], goods=goods, name='草莓%d' % i, desc='简介',
+                                             price=price, unite='500g', image='sku.jpg')
+                     for i, price in enumerate([10, 30, 60, 200])]
+        invalidate_skus([sku.id for sku in self.skus])
+        # 模拟全文检索的结果，相关度从高到低
+        queryset = mock.MagicMock()
+        queryset.count.return_value = 3
+        queryset.__getitem__.return_value = [SearchResult('goods', 'goodssku', sku.id, 1) for sku in self.skus[:3]]
+        patcher = mock.patch.object(search, 'search_queryset', return_value=queryset)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_counts_and_filters(self):
+        """种类的计数带上价格筛选，价格区间的计数带上种类筛选"""
+        facets = count_facets(SearchResultList('草莓'))
+        self.assertEqual(facets, {'types': {self.types[0].id: 2, self.types[1].id: 1}, 'prices': [1, 1, 1, 0]})
+
+        results = SearchResultList('草莓', self.types[0].id, 2)
+        self.assertEqual([sku.id for sku in results[0:10]], [self.skus[2].id])
+        self.assertEqual(count_facets(results), {'types': {self.types[0].id: 1}, 'prices': [1, 0, 1, 0]})
+
+    def test_empty_query_and_view(self):
+        """搜索词为空时统计全部商品，提前计算后页面直接使用缓存"""
+        self.assertEqual(count_facets(SearchResultList(''))['prices'], [1, 1, 1, 1])
+
+        conn = mock.MagicMock()
+        conn.zrevrange.return_value = [b'\xe8\x8d\x89\xe8\x8e\x93']
+        self.assertEqual(precompute_facets(conn), 2)
+        with mock.patch.object(facets, 'count_facets', return_value={'types': {}, 'prices': [0] * 4}) as count:
+            response = self.client.get('/search', {'q': '草莓', 'type': self.types[1].id})
+            self.assertEqual([sku.id for sku in response.context['page']], [self.skus[1].id])
+            response = self.client.get('/search', {'q': '草莓'})
+            self.assertEqual(count.call_count, 1)
+        self.assertEqual([count for type, count in response.context['type_facets']], [2, 1])
+
+    def test_empty_query_counts_capped(self):
+        """空搜索词的计数和筛选结果一样不超过SEARCH_MAX_HITS"""
+        with mock.patch.object(search, 'SEARCH_MAX_HITS', 1), mock.patch.object(facets, 'SEARCH_MAX_HITS', 1):
+            facet_counts = count_facets(SearchResultList(''))
+            self.assertEqual(facet_counts['types'], {self.types[0].id: 1, self.types[1].id: 1})
+            self.assertEqual(len(SearchResultList('', self.types[0].id)), 1)
+
+
+class NgramBackendTest(TestCase):
+    """二元分词索引后端测试"""
+
+    def setUp(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, True)
+        self.backend = NgramSearchBackend('default', PATH=path)
+        self.index = haystack_connections['default'].get_unified_index().get_index(GoodsSKU)
+        goods_type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='水果', detail='<p>新鲜水果</p>')
+        self.skus = [GoodsSKU.objects.create(type=goods_type, goods=goods, name=name, desc='简介', price=10,
+                                             unite='500g', image='sku.jpg')
+                     for name in ['丹东草莓', '新疆草莓 草莓礼盒', '红富士苹果', 'Apple iPhone']]
+
+    def test_tokenize(self):
+        self.assertEqual(tokenize('草莓 Apple2'), ['草', '莓', '草莓', 'apple2'])
+        self.assertEqual(query_terms('丹东草莓 AND 草'), ['丹东', '东草', '草莓', '草'])
+
+    def test_query_terms_strip_not(self):
+        """NOT后面的词和整个括号分组都不参与查询"""
+        self.assertEqual(query_terms('NOT 丹东 草莓'), ['草莓'])
+        self.assertEqual(query_terms('草莓 NOT (丹东 AND 新疆)'), ['草莓'])
+        self.assertEqual(query_terms('NOT ((丹东 AND 新疆) OR 礼盒) AND 草莓'), ['草莓'])
+        # SearchQuerySet.exclude生成的查询
+        query = NgramSearchQuery()
+        query.add_filter(SQ(content='草莓'))
+        query.add_filter(~SQ(content='丹东 新疆'))
+        self.assertEqual(query_terms(query.build_query()), ['草莓'])
+
+    def test_search_and_remove(self):
+        """所有词都出现才算匹配，词频高的排在前面，删除后不再返回"""
+        self.backend.update(self.index, self.skus)
+        result = self.backend.search('草莓', models=[GoodsSKU])
+        self.assertEqual([int(hit.pk) for hit in result['results']], [self.skus[1].id, self.skus[0].id])
+        self.assertEqual(self.backend.search('新鲜 apple')['hits'], 1)
+        self.assertEqual(self.backend.search('*:*')['hits'], 4)
+
+        self.backend.remove(self.skus[1])
+        result = self.backend.search('草莓')
+        self.assertEqual([int(hit.pk) for hit in result['results']], [self.skus[0].id])
+        self.backend.clear([GoodsSKU])
+        self.assertEqual(self.backend.search('*:*')['hits'], 0)
+
+    def test_queue_removes_in_one_write(self):
+        """队列中删除的多个商品只保存一次快照"""
+        self.backend.update(self.index, self.skus)
+        deleted = [sku.id for sku in self.skus[:3]]
+        GoodsSKU.objects.filter(id__in=deleted).delete()
+        conn = mock.MagicMock()
+        conn.exists.return_value = False
+        conn.spop.side_effect = [[str(sku_id).encode() for sku_id in deleted], []]
+        connections = mock.MagicMock()
+        connections['default'].get_backend.return_value = self.backend
+        connections['default'].get_unified_index.return_value = haystack_connections['default'].get_unified_index()
+        with mock.patch('haystack.connections', connections), \
+                mock.patch.object(search_queue, 'bump_search_version'), \
+                mock.patch.object(self.backend, 'write', wraps=self.backend.write) as write:
+            self.assertEqual(search_queue.apply_search_queue(conn), 3)
+        self.assertEqual(write.call_count, 1)
+        self.assertEqual([int(hit.pk) for hit in self.backend.search('*:*')['results']], [self.skus[3].id])
+
+
+class RedisRoundTripTest(TestCase):
+    """响应头X-Redis-Round-Trips统计一个请求实际的redis请求次数，需要使用redis缓存"""
+
+    def setUp(self):
+        options = settings.CACHES['default'].get('OPTIONS', {})
+        if options.get('CONNECTION_POOL_CLASS') != 'utils.redis_counter.CountingConnectionPool':
+            self.skipTest('没有使用统计请求次数的redis连接池')
+        self.conn = get_redis_connection('default')
+        try:
+            self.conn.ping()
+        except redis.ConnectionError:
+            self.skipTest('redis不可用')
+        cache.clear()
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='草莓')
+        self.sku = GoodsSKU.objects.create(type=type, goods=goods, name='草莓', desc='简介', price=10,
+                                           unite='500g', image='sku.jpg')
+        self.user = User.objects.create_user('viewer', 'viewer@example.com', 'password')
+        self.addCleanup(cache.clear)
+
+    def round_trips(self, path):
+        sent = []
+        send = CountingConnectionMixin.send_packed_command
+        thread_id = threading.get_ident()
+
+        def record(connection, command, check_health=True):
+            # 不统计其他线程(比如商品快照缓存的订阅线程)的请求
+            if threading.get_ident() == thread_id:
+                sent.append(command)
+            return send(connection, command, check_health)
+        with mock.patch.object(CountingConnectionMixin, 'send_packed_command', record):
+            response = self.client.get(path)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(int(response['X-Redis-Round-Trips']), len(sent))
+        return len(sent)
+
+    def test_index_and_detail(self):
+        """缓存命中后的请求次数，包括session和django缓存的请求"""
+        detail = '/goods/%d' % self.sku.id
+        # 第一次访问生成缓存
+        self.client.get('/')
+        self.client.get(detail)
+        # 首页：版本号、首页数据
+        self.assertEqual(self.round_trips('/'), 2)
+        # 未登录的详情页：首页版本号、列表版本号、整页缓存
+        self.assertEqual(self.round_trips(detail), 3)
+
+        self.client.force_login(self.user)
+        self.client.get(detail)
+        # 登录后：session读取两次、保存一次，购物车和浏览历史的管道，首页版本号、种类、评论数目、评论
+        self.assertEqual(self.round_trips(detail), 8)
@@ -7,5 +7,8 @@ urlpatterns = [
     path('', IndexView.as_view(), name='index'),
     # re_path(r'^goods/(?P<goods_id>\d+)$', DetailView.as_view(), name='detail'),
     path('goods/<goods_id>', DetailView.as_view(), name='detail'),
+    path('goods/<goods_id>/comments', CommentListView.as_view(), name='comments'),
     path('list/<type_id>/<page>', ListView.as_view(), name='list'),
+    re_path(r'^search/?$', SearchView.as_view(), name='search'),  # 全文检索
+    path('search/suggest', SuggestView.as_view(), name='suggest'),  # 搜索框输入提示
 ]
\ No newline at end of file
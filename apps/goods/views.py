@@ -1,11 +1,29 @@
+import time
+import hashlib
 from django.shortcuts import render, redirect
 from django.urls import reverse
-from django.core.paginator import Paginator
 from django.core.cache import cache
+from django.core.paginator import Paginator
 from django.views import View
+from django.http import JsonResponse, HttpResponse
+from django.middleware.csrf import get_token
+from django.utils.cache import get_conditional_response, patch_vary_headers, patch_cache_control
+from django.utils.http import http_date
+from django.utils.timezone import localtime
+from django.utils.functional import SimpleLazyObject
 from django_redis import get_redis_connection
 from apps.goods.models import *
+from apps.goods.cache import get_index_page_data, get_index_page_version, get_goods_types, get_list_version, \
+    get_detail_page, set_detail_page, LIST_COUNT_KEY, LIST_FRAGMENT_TIMEOUT, DETAIL_PAGE_CSRF_PLACEHOLDER
+from apps.goods.loaders import load_index_page_data
+from apps.goods.sales import HotSKUList
+from apps.goods.comments import get_comments
+from apps.goods.sku_cache import get_sku_snapshot
+from apps.goods.search import SearchResultList, parse_filters, SEARCH_PAGE_SIZE, PRICE_RANGES
+from apps.goods.facets import get_facets, record_query
+from apps.goods.suggest import suggest
 from apps.order.models import *
+from utils.pagination import CursorPaginator, get_page_range
 
 class IndexView(View):
     """首页"""
@@ -16,180 +34,254 @@ class IndexView(View):
             如果直接访问域名的话，那么加载的是celery服务器中已经渲染好的html代码，不需要数据库重新 查询
             当管理员更新后台的时候，会自动celery重新生成静态html网页，不影响使用
         """
-        # 尝试从缓存中获取数据
-        context = cache.get('index_page_data')
-        if context is None:
-            print('设置主页缓存数据')
-            # 获取商品的种类信息
-            types = GoodsType.objects.all()
-
-            # 获取轮播图信息
-            banners = IndexGoodsBanner.objects.all().order_by('index')
-
-            # 获取促销信息
-            promotion_banners = IndexPromotionBanner.objects.all().order_by('index')
-
-            # 获取首页分类商品展示信息
-            for type in types:
-                image_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-                title_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-
-                type.image_banners = image_banners
-                type.title_banners = title_banners
-
-            # 上面查询出来的结果都一样，设置缓存
-            context = {
-                'types': types,
-                'goods_banners': banners,
-                'promotion_banners': promotion_banners,
-            }
-            cache.set('index_page_data', context, 3600)
+        # 从缓存中获取数据，缓存按版本号失效，失效时只有一个进程去重新查询数据库
+        context = get_index_page_data(load_index_page_data)
 
         # 获取首页购物车的数目
-        if request.user.is_authenticated:
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%s' % request.user.id
-            cart_count = conn.hlen(cart_key)
-        else:
-            cart_count = 0
+        cart_count = request.redis.cart_count(request.user)
 
-        context.update(cart_count=cart_count)
+        context.update(cart_count=cart_count.value)
 
         return render(request, 'index.html', context=context)
 
 
 
 class DetailView(View):
-    """商品详情界面"""
+    """
+    商品详情界面
+        未登录用户访问时整页缓存，带有ETag和Last-Modified，浏览器和爬虫重复访问时返回304
+        商品、商品SPU、商品图片和评论变化时清除缓存，商品种类、同种类商品变化时版本号变化，缓存失效
+    """
+
     def get(self, request, goods_id):
+        if not request.user.is_authenticated:
+            return self.get_anonymous(request, goods_id)
+
         # 根据商品goods_id，获取商品信息，如果查询不到则返回首页
         try:
-            sku = GoodsSKU.objects.get(id=goods_id)
-        except GoodsSKU.DoesNotExist as e:
+            sku = GoodsSKU.objects.select_related('type', 'goods').get(id=goods_id)
+        except (GoodsSKU.DoesNotExist, ValueError) as e:
             return redirect(reverse('goods:index'))
 
+        # 获取商品详情页中的购物车数目信息，登录用户向浏览历史中添加，一次redis请求发出
+        user = request.user
+        cart_count = request.redis.cart_count(user)
+        request.redis.add_history(user, goods_id)
+        request.redis.flush()
+
+        context = self.get_context(sku)
+        context['cart_count'] = cart_count.value
+        return render(request, 'detail.html', context)
+
+    def get_context(self, sku):
         # 获取商品的图片
-        goods_image = GoodsImage.objects.filter(sku=sku)
-        print(goods_image)
+        goods_image = list(GoodsImage.objects.filter(sku=sku))
 
         # 获取商品的分类信息
-        types = GoodsType.objects.all()
-        # 获取商品的评论信息
-        sku_order_comment = OrderGoods.objects.filter(sku=sku).exclude(comment='')
+        types = get_goods_types()
+        # 获取商品评论的第一页，其他页由评论接口分页加载
+        comments, comment_pages = get_comments(sku.id)
         # 根据查询到的商品sku对象获取商品信息按照创建时间进行倒序排序并且只显示最前面两个
         new_skus = GoodsSKU.objects.filter(type=sku.type).order_by('-create_time')[:2]
 
         # 获取同一spu下面的其他商品
-        same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods).exclude(id=goods_id)
-
-        # 获取用户购物车的商品数目
-        user = request.user  # 获取user对象
-        cart_count = 0  # 默认设置为0
-        # 获取商品详情页中的购物车数目信息
-        if user.is_authenticated:
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-            cart_count = conn.hlen(cart_key)  # hlen 返回哈希里所有字段的数量
-
-            # 向浏览历史中添加
-            conn = get_redis_connection('default')
-            history_key = 'history_%d' % user.id
-            # 移除列表中的goods_id如果已经存在, 大于0表示从左移除几个，等于0表示移除所有存在的元素
-            conn.lrem(history_key, 0, goods_id)  # 从列表中删除元素
-            # 左侧进行插入
-            conn.lpush(history_key, goods_id)
-            # 只保存用户最新浏览的5条数据
-            conn.ltrim(history_key, 0, 4)
-
-        print(sku.image.url)  # 图片的url
+        same_spu_skus = GoodsSKU.objects.filter(goods=sku.goods).exclude(id=sku.id)
 
-        context = {
+        return {
             'sku': sku,
             'good_image': goods_image,
-            'sku_order_comment': sku_order_comment,
+            'comments': comments,
+            'comment_pages': comment_pages,
             'types': types,
             'new_skus': new_skus,
-            'cart_count': cart_count,
             'same_spu_skus': same_spu_skus,
         }
 
-        return render(request, 'detail.html', context)
+    def get_anonymous(self, request, goods_id):
+        """
+        未登录用户访问，使用整页缓存
+            缓存的页面中csrf_token是占位符，返回时替换成当前访客的csrf_token
+            ETag是页面内容的摘要，Last-Modified是页面内容最后一次变化时生成的时间，
+            评论、商品种类、同种类新品等任何变化都会改变页面内容，重新生成但内容不变时保留原来的时间
+        """
+        # 商品快照中有商品的种类，不需要查询数据库就能得到缓存的版本号
+        sku = get_sku_snapshot(goods_id)
+        if sku is None:
+            return redirect(reverse('goods:index'))
+        version = '%s_%s' % (get_index_page_version(), get_list_version(sku.type_id))
+
+        cached = page = get_detail_page(sku.id)
+        if page is None or page['version'] != version:
+            try:
+                sku = GoodsSKU.objects.select_related('type', 'goods').get(id=sku.id)
+            except GoodsSKU.DoesNotExist as e:
+                return redirect(reverse('goods:index'))
+            context = self.get_context(sku)
+            context.update(cart_count=0, csrf_token=DETAIL_PAGE_CSRF_PLACEHOLDER)
+            content = render(request, 'detail.html', context).content
+
+            etag = '"%s"' % hashlib.md5(content).hexdigest()
+            if cached is not None and cached['etag'] == etag:
+                last_modified = cached['last_modified']
+            else:
+                # Last-Modified精确到秒，同一秒内变化两次也要比原来的晚
+                last_modified = int(time.time())
+                if cached is not None:
+                    last_modified = max(last_modified, cached['last_modified'] + 1)
+            page = {
+                'version': version,
+                'content': content,
+                'etag': etag,
+                'last_modified': last_modified,
+            }
+            set_detail_page(sku.id, page)
+
+        response = get_conditional_response(request, etag=page['etag'], last_modified=page['last_modified'])
+        if response is None:
+            content = page['content'].replace(DETAIL_PAGE_CSRF_PLACEHOLDER.encode(), get_token(request).encode())
+            response = HttpResponse(content)
+        response['ETag'] = page['etag']
+        response['Last-Modified'] = http_date(page['last_modified'])
+        # 登录用户看到的页面不同，浏览器每次都要重新验证
+        patch_vary_headers(response, ['Cookie'])
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+
+class CommentListView(View):
+    """商品评论分页接口，最新的评论在前"""
+
+    def get(self, request, goods_id):
+        try:
+            sku_id = int(goods_id)
+            page = int(request.GET.get('page', 1))
+        except ValueError:
+            return JsonResponse({'res': 0, 'errmsg': '参数错误'})
+
+        if page < 1:
+            return JsonResponse({'res': 0, 'errmsg': '参数错误'})
+
+        comments, num_pages = get_comments(sku_id, page)
+        for comment in comments:
+            comment['update_time'] = localtime(comment['update_time']).strftime('%Y-%m-%d %H:%M:%S')
+
+        return JsonResponse({'res': 1, 'comments': comments, 'page': page, 'num_pages': num_pages})
 
 
 class ListView(View):
     """列表页"""
     def get(self, request, type_id, page):
 
-        # 获取商品种类信息
+        # 获取全部商品分类信息和商品种类信息，从缓存中获取
+        types = get_goods_types()
         try:
-            type = GoodsType.objects.get(id=type_id)
-        except GoodsType.DoesNotExist as e:
+            type = next(type for type in types if str(type.id) == type_id)
+        except StopIteration:
             return redirect(reverse('goods:index'))
 
-        # 获取全部商品分类信息
-        types = GoodsType.objects.all()
-
         # 获取排序的方式,sort=default 默认id排序 price 价格排序 hot 商品销量
         sort = request.GET.get('sort')
         if sort == 'price':
-            skus = GoodsSKU.objects.filter(type=type).order_by('price')
+            ordering = ('price', 'id')
         elif sort == 'hot':
-            skus = GoodsSKU.objects.filter(type=type).order_by('-sales')
+            ordering = None
         else:
             sort = 'default'
-            skus = GoodsSKU.objects.filter(type=type).order_by('-id')
+            ordering = ('-id',)
 
-        # 对skus数据进行分页
-        paginator = Paginator(skus, 3)
-        # 获取第page页的内容
         try:
             page = int(page)
-        except Exception as e:
-            page = 1
-
-        # 判断用户传递过来的页数，是否小于总页数，大于总页数则设置第一页
-        if page > paginator.num_pages:
+        except ValueError:
             page = 1
 
-        # 获取第page页的page对象，废弃因为会加载所有的页码
-        skus_page = paginator.page(page)
+        if sort == 'hot':
+            # 按照redis中的销量排行分页，商品数据从快照缓存中获取
+            paginator = Paginator(HotSKUList(get_redis_connection('default'), type.id), 3)
+            skus_page = paginator.get_page(page)
+        else:
+            # 使用游标分页，最后按照id排序保证顺序稳定，商品总数是缓存的大概数目
+            # 商品列表和新品推荐在模板中按照(种类, 排序, 页码, 版本号)缓存，
+            # 使用SimpleLazyObject，片段缓存命中时不会查询数据库
+            skus = GoodsSKU.objects.filter(type=type)
+            paginator = CursorPaginator(skus, 3, ordering, count_key=LIST_COUNT_KEY % type.id)
+            skus_page = SimpleLazyObject(lambda: paginator.page(page, request.GET.get('cursor')))
 
         # 控制限制的页码，只显示最多5个按钮
-        # 如果总页数小于5，显示[1-页码]
-        # 如果当前页是前三页，显示[1,2,3,4,5]
-        # 如果当前页是后三页，显示[4,5,6,7,8] num_pages-4 到num_oages+1
-        # 显示当前页，显示当前页的前两页和后两页 [2,3,4,5,6]
-
-        num_pages = paginator.num_pages
-        if num_pages < 5:
-            pages = range(1, num_pages + 1)
-        elif num_pages <= 3:
-            pages = range(1, 6)
-        elif num_pages - page <= 2:
-            pages = range(num_pages-4, num_pages+1)
-        else:
-            pages = range(page-2, page+3)
+        pages = SimpleLazyObject(lambda: get_page_range(skus_page.number, paginator.num_pages))
 
-        # 通过page对象获取数据
         # 获取新品信息
         new_skus = GoodsSKU.objects.filter(type=type).order_by('-create_time')[:2]
 
-        # 获取首页购物车的数目
-        cart_count = 0
-        if request.user.is_authenticated:
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%s' % request.user.id
-            cart_count = conn.hlen(cart_key)
+        # 获取首页购物车的数目，不在缓存的片段中
+        cart_count = request.redis.cart_count(request.user)
 
         context = {
             "sort": sort,
             "type": type,
             "types": types,
-            "skus_page": skus_page, #会加载所有的页码
+            "page": page,
+            "skus_page": skus_page,
             "new_skus": new_skus,
-            "cart_count": cart_count,
+            "cart_count": cart_count.value,
             "pages": pages,
+            "list_version": get_list_version(type.id),
+            "list_cache_timeout": LIST_FRAGMENT_TIMEOUT,
         }
 
         return render(request, 'list.html', context)
 
+
+class SearchView(View):
+    """
+    全文检索结果页
+        搜索结果按照(搜索词, 页码)缓存sku_id列表，商品数据从快照缓存中批量获取
+        可以按照种类(type)和价格区间(price)筛选，同时显示每个种类和价格区间的结果数目
+    """
+
+    def get(self, request):
+        type_id, price = parse_filters(request.GET.get('type'), request.GET.get('price'))
+        results = SearchResultList(request.GET.get('q', ''), type_id, price)
+        paginator = Paginator(results, SEARCH_PAGE_SIZE)
+        page = paginator.get_page(request.GET.get('page'))
+
+        # 第一页记录搜索词的次数，常用搜索词的分面统计由定时任务提前计算
+        if page.number == 1:
+            try:
+                record_query(get_redis_connection('default'), results.query)
+            except NotImplementedError:
+                pass
+
+        # 获取商品分类和购物车的数目
+        types = get_goods_types()
+        cart_count = request.redis.cart_count(request.user)
+
+        # 分面统计，没有结果的种类和价格区间不显示
+        facets = get_facets(results)
+        type_facets = [(type, facets['types'][type.id]) for type in types if facets['types'].get(type.id)]
+        price_facets = []
+        for index, (low, high) in enumerate(PRICE_RANGES):
+            if facets['prices'][index]:
+                name = '%d元以上' % low if high is None else '%d-%d元' % (low, high)
+                price_facets.append((index, name, facets['prices'][index]))
+
+        context = {
+            'query': results.query,
+            'type_id': type_id,
+            'price': price,
+            'type_facets': type_facets,
+            'price_facets': price_facets,
+            'page': page,
+            'paginator': paginator,
+            'pages': get_page_range(page.number, paginator.num_pages),
+            'types': types,
+            'cart_count': cart_count.value,
+        }
+        return render(request, 'search/search.html', context)
+
+
+class SuggestView(View):
+    """搜索框的输入提示接口，使用进程内的前缀索引，不查询whoosh和数据库"""
+
+    def get(self, request):
+        suggestions = suggest(request.GET.get('q', ''))
+        return JsonResponse({'res': 1, 'suggestions': suggestions})
@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from apps.order.payment import create_alipay, get_alipay
+
+
+class Command(BaseCommand):
+    help = '支付宝接口对象的微基准：比较每次请求创建对象(读取、解析密钥)和使用进程内共享对象的耗时'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='模拟的请求次数')
+
+    def handle(self, *args, **options):
+        num = options['requests']
+        self.stdout.write('%-10s %14s %14s' % ('client', 'get(us)', 'get+sign(us)'))
+        for name, get in (('per-request', create_alipay), ('cached', get_alipay)):
+            self.bench(name, get, num)
+
+    def bench(self, name, get, num):
+        """分别统计只获取接口对象和获取后生成支付链接(OrderPayView的工作)的平均耗时"""
+        get()
+        start = time.perf_counter()
+        for i in range(num):
+            get()
+        get_cost = (time.perf_counter() - start) / num
+
+        start = time.perf_counter()
+        for i in range(num):
+            get().api_alipay_trade_page_pay(
+                out_trade_no='%019d' % i,
+                total_amount='20.00',
+                subject='天天生鲜%019d' % i,
+            )
+        pay_cost = (time.perf_counter() - start) / num
+
+        self.stdout.write('%-10s %14.1f %14.1f' % (name, get_cost * 10 ** 6, pay_cost * 10 ** 6))
@@ -0,0 +1,124 @@
+import time
+import threading
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+from django.test import RequestFactory
+from django.test.utils import setup_test_environment
+from django_redis import get_redis_connection
+from apps.goods.models import GoodsType, Goods, GoodsSKU
+from apps.goods.stock import SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY, flush_pending_stock
+from apps.user.models import User, Address
+from apps.cart.utils import get_cart_key
+from apps.order.views import ORDER_COMMIT_VIEWS
+
+# 压测数据使用的id从这里开始，避免和redis中真实用户的购物车、真实商品的库存镜像冲突
+BENCH_ID_BASE = 10 ** 9
+
+
+class Command(BaseCommand):
+    help = '订单提交压测：N个用户同时购买同一个热门商品，比较各种扣减库存方式的吞吐量、p99延迟和失败率'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--buyers', type=int, default=50, help='同时下单的用户数')
+        parser.add_argument('--orders', type=int, default=20, help='每个用户下单的次数')
+        parser.add_argument('--stock', type=int, default=100000, help='热门商品的库存')
+        parser.add_argument('--strategies', nargs='+', default=sorted(ORDER_COMMIT_VIEWS),
+                            choices=sorted(ORDER_COMMIT_VIEWS), help='参与压测的扣减库存方式')
+
+    def handle(self, *args, **options):
+        # 在单独创建的测试数据库中压测，结束后删除
+        setup_test_environment()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        conn = get_redis_connection('default')
+        try:
+            self.stdout.write('%-12s %10s %10s %10s %10s' % ('strategy', 'orders/s', 'p50(ms)', 'p99(ms)', 'abort'))
+            for strategy in options['strategies']:
+                self.bench(conn, strategy, options['buyers'], options['orders'], options['stock'])
+        finally:
+            self.clear_redis(conn, options['buyers'])
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def setup_data(self, conn, buyers, stock):
+        """创建热门商品和下单的用户，用户的购物车中都有1件热门商品"""
+        type = GoodsType.objects.create(name='压测', logo='bench', image='bench.jpg')
+        goods = Goods.objects.create(name='压测')
+        sku = GoodsSKU.objects.create(id=BENCH_ID_BASE, type=type, goods=goods, name='热门商品', desc='',
+                                      price=10, unite='500g', image='bench.jpg', stock=stock)
+        users = []
+        for i in range(buyers):
+            user = User.objects.create_user(id=BENCH_ID_BASE + i, username='bench_%d' % i, password='bench')
+            addr = Address.objects.create(user=user, receiver='bench', addr='bench', phone='13800000000')
+            users.append((user, addr))
+        conn.hdel(SKU_STOCK_KEY, sku.id)
+        conn.delete(SKU_STOCK_PENDING_KEY)
+        return sku, users
+
+    def clear_data(self):
+        Address.objects.all().delete()
+        User.objects.all().delete()
+        GoodsSKU.objects.all().delete()
+        Goods.objects.all().delete()
+        GoodsType.objects.all().delete()
+
+    def clear_redis(self, conn, buyers):
+        conn.hdel(SKU_STOCK_KEY, BENCH_ID_BASE)
+        conn.hdel(SKU_STOCK_PENDING_KEY, BENCH_ID_BASE)
+        conn.delete(*[get_cart_key(BENCH_ID_BASE + i) for i in range(buyers)])
+
+    def bench(self, conn, strategy, buyers, orders, stock):
+        sku, users = self.setup_data(conn, buyers, stock)
+        view = ORDER_COMMIT_VIEWS[strategy].as_view()
+        factory = RequestFactory()
+        latencies = []
+        aborts = []
+        lock = threading.Lock()
+        barrier = threading.Barrier(buyers + 1)
+
+        def buyer(user, addr):
+            my_latencies = []
+            my_aborts = 0
+            barrier.wait()
+            for i in range(orders):
+                conn.hset(get_cart_key(user.id), sku.id, 1)
+                request = factory.post('/order/commit/', {'addr_id': addr.id, 'pay_method': '3', 'sku_ids': str(sku.id)})
+                request.user = user
+                start = time.perf_counter()
+                response = view(request)
+                my_latencies.append(time.perf_counter() - start)
+                if b'"res": 5' not in response.content:
+                    my_aborts += 1
+            connections.close_all()
+            with lock:
+                latencies.extend(my_latencies)
+                aborts.append(my_aborts)
+
+        threads = [threading.Thread(target=buyer, args=user) for user in users]
+        for thread in threads:
+            thread.start()
+        barrier.wait()
+        start = time.perf_counter()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        if strategy == 'redis':
+            flush_pending_stock(conn)
+
+        latencies.sort()
+        total = len(latencies)
+        succeeded = total - sum(aborts)
+        self.stdout.write('%-12s %10.1f %10.2f %10.2f %9.2f%%' % (
+            strategy,
+            succeeded / elapsed,
+            latencies[total // 2] * 1000,
+            latencies[min(total - 1, int(total * 0.99))] * 1000,
+            100.0 * sum(aborts) / total,
+        ))
+
+        sku.refresh_from_db()
+        if sku.stock + sku.sales != stock or sku.sales != succeeded:
+            self.stderr.write('%s: 库存%d 销量%d 成功订单%d，数据不一致' % (strategy, sku.stock, sku.sales, succeeded))
+
+        self.clear_redis(conn, buyers)
+        self.clear_data()
@@ -0,0 +1,17 @@
+# Generated by Django 2.2.28 on 2026-10-18 17:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('order', '0002_auto_20190909_1055'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='ordergoods',
+            index=models.Index(fields=['sku', 'create_time'], name='df_order_goods_sku_time_idx'),
+        ),
+    ]
@@ -78,3 +78,5 @@ class OrderGoods(BaseModel):
         db_table = 'df_order_goods'
         verbose_name = '订单商品'
         verbose_name_plural = verbose_name
+        # 商品详情页按照时间倒序分页查询评论
+        indexes = [models.Index(fields=['sku', 'create_time'], name='df_order_goods_sku_time_idx')]
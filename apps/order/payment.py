@@ -0,0 +1,213 @@
+import os
+import time
+import threading
+from decimal import Decimal
+from django.conf import settings
+from alipay import AliPay
+from apps.order.models import OrderInfo
+
+'''
+支付宝支付结果的确认
+    支付宝异步通知(notify_url)和celery定时查询两种方式确认支付结果，都不占用web请求
+    订单检查接口只读取订单状态，最多等待ORDER_CHECK_TIMEOUT秒，页面隔几秒轮询一次
+    定时查询到交易关闭时记录支付失败，订单检查接口返回支付失败
+'''
+
+# 等待确认支付结果的订单，有序集合{order_id: 下一次查询的时间}
+ORDER_PAY_PENDING_KEY = 'order_pay_pending'
+# 已经查询的次数，{order_id: 次数}
+ORDER_PAY_ATTEMPTS_KEY = 'order_pay_attempts'
+# 支付成功或者失败时放入支付状态，唤醒正在等待的订单检查请求
+ORDER_PAID_KEY = 'order_paid_%s'
+# 交易关闭，支付失败的订单，重新发起支付时删除
+ORDER_PAY_FAILED_KEY = 'order_pay_failed_%s'
+ORDER_PAY_FAILED_TIMEOUT = 60 * 60 * 24
+
+# 第i次查询后等待PAY_CHECK_INTERVAL * 2^i秒再查询，最长PAY_CHECK_MAX_INTERVAL秒
+PAY_CHECK_INTERVAL = 5
+PAY_CHECK_MAX_INTERVAL = 5 * 60
+# 超过这个次数还没有支付，不再查询
+PAY_CHECK_MAX_ATTEMPTS = 20
+# 每次定时任务最多查询的订单数目
+PAY_CHECK_BATCH = 100
+
+# 查询到的支付状态
+PAY_SUCCESS = 'success'
+PAY_WAITING = 'waiting'
+PAY_FAILED = 'failed'
+
+
+def create_alipay():
+    """创建支付宝接口对象，每次都会读取并解析密钥文件，一般使用get_alipay"""
+    with open(settings.ALIPAY_PRIVATE_KEY_PATH) as f:
+        app_private_key_string = f.read()
+    with open(settings.ALIPAY_PUBLIC_KEY_PATH) as f:
+        alipay_public_key_string = f.read()
+
+    return AliPay(
+        appid=settings.ALIPAY_APPID,
+        app_notify_url=settings.ALIPAY_NOTIFY_URL,
+        app_private_key_string=app_private_key_string,
+        alipay_public_key_string=alipay_public_key_string,
+        sign_type="RSA2",
+        debug=settings.ALIPAY_DEBUG
+    )
+
+
+class AliPayProvider(object):
+    """
+    进程内共享的支付宝接口对象，线程安全
+        密钥只在第一次使用时读取和解析
+        每隔ALIPAY_KEY_CHECK_INTERVAL秒检查一次密钥文件的修改时间，更换密钥后自动重新加载
+    """
+
+    def __init__(self):
+        self.alipay = None
+        self.key_mtimes = None
+        self.checked = 0
+        self.lock = threading.Lock()
+
+    def get_key_mtimes(self):
+        return tuple(os.stat(path).st_mtime_ns
+                     for path in (settings.ALIPAY_PRIVATE_KEY_PATH, settings.ALIPAY_PUBLIC_KEY_PATH))
+
+    def get(self):
+        now = time.time()
+        if self.alipay is not None and now - self.checked < settings.ALIPAY_KEY_CHECK_INTERVAL:
+            return self.alipay
+        with self.lock:
+            if self.alipay is not None and now - self.checked < settings.ALIPAY_KEY_CHECK_INTERVAL:
+                return self.alipay
+            key_mtimes = self.get_key_mtimes()
+            if self.alipay is None or key_mtimes != self.key_mtimes:
+                self.alipay = create_alipay()
+                self.key_mtimes = key_mtimes
+            self.checked = now
+            return self.alipay
+
+    def reset(self):
+        with self.lock:
+            self.alipay = None
+            self.key_mtimes = None
+
+
+_provider = AliPayProvider()
+
+
+def get_alipay():
+    """获取进程内共享的支付宝接口对象"""
+    return _provider.get()
+
+
+def query_payment(alipay, order_id):
+    """
+    调用支付宝交易查询接口，返回(支付状态, 支付宝交易号, 支付金额)
+    response = {
+        "trade_no": "2017032121001004070200176844",
+        "code": "10000",
+        "out_trade_no": "out_trade_no15",
+        "msg": "Success",
+        "trade_status": "TRADE_SUCCESS",
+        "total_amount": "20.00",
+        ...
+    }
+    """
+    response = alipay.api_alipay_trade_query(out_trade_no=order_id)
+    code = response.get('code')
+    trade_status = response.get('trade_status')
+    if code == '10000' and trade_status in ('TRADE_SUCCESS', 'TRADE_FINISHED'):
+        return PAY_SUCCESS, response.get('trade_no'), Decimal(response.get('total_amount', '0'))
+    if code == '40004' or (code == '10000' and trade_status == 'WAIT_BUYER_PAY'):
+        # 交易还不存在(买家还没有扫码)或者等待买家付款
+        return PAY_WAITING, None, None
+    if code == '10000' and trade_status == 'TRADE_CLOSED':
+        return PAY_FAILED, None, None
+    # 支付宝接口出错，稍后重新查询
+    return PAY_WAITING, None, None
+
+
+def confirm_payment(conn, order_id, trade_no):
+    """
+    支付成功，更新订单状态为待评价，可以重复调用
+        只有待支付的订单会被更新，返回是否更新了订单
+    """
+    updated = OrderInfo.objects.filter(order_id=order_id, order_status=1).update(order_status=4, trade_no=trade_no)
+
+    pipe = conn.pipeline()
+    pipe.zrem(ORDER_PAY_PENDING_KEY, order_id)
+    pipe.hdel(ORDER_PAY_ATTEMPTS_KEY, order_id)
+    if updated:
+        # 唤醒等待的订单检查请求
+        pipe.lpush(ORDER_PAID_KEY % order_id, PAY_SUCCESS)
+        pipe.expire(ORDER_PAID_KEY % order_id, 60)
+    pipe.execute()
+    return bool(updated)
+
+
+def fail_payment(conn, order_id):
+    """交易关闭，记录支付失败并移出查询队列，唤醒等待的订单检查请求"""
+    pipe = conn.pipeline()
+    pipe.zrem(ORDER_PAY_PENDING_KEY, order_id)
+    pipe.hdel(ORDER_PAY_ATTEMPTS_KEY, order_id)
+    pipe.set(ORDER_PAY_FAILED_KEY % order_id, 1, ex=ORDER_PAY_FAILED_TIMEOUT)
+    pipe.lpush(ORDER_PAID_KEY % order_id, PAY_FAILED)
+    pipe.expire(ORDER_PAID_KEY % order_id, 60)
+    pipe.execute()
+
+
+def payment_failed(conn, order_id):
+    """订单的交易是否已经关闭"""
+    return bool(conn.exists(ORDER_PAY_FAILED_KEY % order_id))
+
+
+def schedule_payment_check(conn, order_id):
+    """用户发起支付，加入定时查询支付结果的队列"""
+    pipe = conn.pipeline()
+    pipe.zadd(ORDER_PAY_PENDING_KEY, {order_id: time.time() + PAY_CHECK_INTERVAL})
+    pipe.hdel(ORDER_PAY_ATTEMPTS_KEY, order_id)
+    pipe.delete(ORDER_PAY_FAILED_KEY % order_id)
+    pipe.execute()
+
+
+def check_pending_payments(conn, alipay):
+    """
+    查询到期的待支付订单的支付结果，celery定时任务调用，返回确认支付成功的订单数目
+        查询前先按照退避时间安排下一次查询，多个任务同时执行时同一个订单最多被重复查询一次
+        和异步通知一样验证支付金额，金额不对的订单不确认，按照退避时间重新查询
+    """
+    now = time.time()
+    order_ids = conn.zrangebyscore(ORDER_PAY_PENDING_KEY, '-inf', now, start=0, num=PAY_CHECK_BATCH)
+    confirmed = 0
+    for order_id in order_ids:
+        order_id = order_id.decode()
+        attempts = conn.hincrby(ORDER_PAY_ATTEMPTS_KEY, order_id, 1)
+        if attempts > PAY_CHECK_MAX_ATTEMPTS:
+            # 长时间没有支付，不再查询
+            conn.zrem(ORDER_PAY_PENDING_KEY, order_id)
+            conn.hdel(ORDER_PAY_ATTEMPTS_KEY, order_id)
+            continue
+        delay = min(PAY_CHECK_INTERVAL * 2 ** attempts, PAY_CHECK_MAX_INTERVAL)
+        conn.zadd(ORDER_PAY_PENDING_KEY, {order_id: now + delay})
+
+        try:
+            status, trade_no, total_amount = query_payment(alipay, order_id)
+        except Exception as e:
+            # 网络错误，按照退避时间重新查询
+            continue
+
+        if status == PAY_SUCCESS:
+            order = OrderInfo.objects.filter(order_id=order_id, pay_method=3).first()
+            if order is None or total_amount != order.total_price + order.transit_price:
+                continue
+            confirmed += confirm_payment(conn, order_id, trade_no)
+        elif status == PAY_FAILED:
+            fail_payment(conn, order_id)
+    return confirmed
+
+
+def wait_for_payment(conn, order_id, timeout):
+    """等待订单支付结果的通知，最多等待timeout秒，返回PAY_SUCCESS或者PAY_FAILED，超时返回None"""
+    result = conn.blpop(ORDER_PAID_KEY % order_id, timeout=timeout)
+    if result is None:
+        return None
+    return result[1].decode()
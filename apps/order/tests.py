@@ -1,3 +1,419 @@
-from django.test import TestCase
+import os
+import json
+import time
+import shutil
+import tempfile
+import multiprocessing
+from unittest import mock
+from django.conf import settings
+from django.db import DatabaseError, OperationalError
+from django.test import SimpleTestCase, TestCase, RequestFactory, override_settings
 
 # Create your tests here.
+from utils.snowflake import SnowflakeGenerator, ProcessSnowflake, parse_id, MAX_SEQUENCE, MAX_WORKER_ID, \
+    WORKER_LEASE_KEY, WORKER_COUNTER_KEY, WORKER_LEASE_TIMEOUT, WORKER_LEASE_RENEW
+from apps.cart.tests import get_local_redis
+from apps.cart.utils import get_cart_key
+from apps.goods.models import GoodsType, Goods, GoodsSKU
+from apps.goods.stock import SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY
+from apps.order.views import OrderCommitView, OrderCommitView1, OrderCommitRedisView
+from apps.user.models import User, Address
+from apps.order.models import OrderInfo, OrderGoods
+from apps.order.payment import AliPayProvider, check_pending_payments, schedule_payment_check, wait_for_payment, \
+    ORDER_PAY_PENDING_KEY, ORDER_PAY_ATTEMPTS_KEY, ORDER_PAID_KEY, ORDER_PAY_FAILED_KEY, PAY_CHECK_INTERVAL, PAY_SUCCESS
+
+
+def generate_ids(args):
+    """子进程中使用指定的机器id生成num个id"""
+    worker_id, num = args
+    generator = SnowflakeGenerator(worker_id)
+    return [generator.next_id() for i in range(num)]
+
+
+class SnowflakeTest(SimpleTestCase):
+    """订单id生成器测试"""
+
+    def test_ids_are_monotonic(self):
+        """同一个生成器生成的id单调递增，序列号用完时借用下一毫秒"""
+        generator = SnowflakeGenerator(1)
+        ids = [generator.next_id() for i in range((MAX_SEQUENCE + 1) * 3)]
+        self.assertEqual(ids, sorted(set(ids)))
+        self.assertTrue(all(parse_id(id)[1] == 1 for id in ids))
+
+    def test_no_duplicates_across_processes(self):
+        """8个进程各生成25万个id，没有重复"""
+        processes = 8
+        num = 250000
+        with multiprocessing.Pool(processes) as pool:
+            results = pool.map(generate_ids, [(worker_id, num) for worker_id in range(processes)])
+
+        ids = set()
+        for worker_ids in results:
+            self.assertEqual(worker_ids, sorted(worker_ids))
+            ids.update(worker_ids)
+        self.assertEqual(len(ids), processes * num)
+
+    def test_order_id_string_order(self):
+        """补齐位数后订单id字符串的顺序和数值的顺序一致"""
+        generator = SnowflakeGenerator(1023)
+        ids = [generator.next_id() for i in range(1000)]
+        order_ids = ['%019d' % id for id in ids]
+        self.assertEqual(order_ids, sorted(order_ids))
+        self.assertTrue(all(len(order_id) == 19 for order_id in order_ids))
+
+
+@override_settings(SNOWFLAKE_WORKER_ID=None)
+class SnowflakeLeaseTest(SimpleTestCase):
+    """自动分配机器id的租约测试，需要本地redis"""
+
+    def setUp(self):
+        self.conn = get_local_redis()
+        if self.conn is None:
+            self.skipTest('本地redis不可用')
+        self.clear_redis()
+        self.snowflake = ProcessSnowflake()
+        patcher = mock.patch.object(self.snowflake, 'get_connection', return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.clear_redis()
+
+    def clear_redis(self):
+        self.conn.delete(WORKER_COUNTER_KEY, *[WORKER_LEASE_KEY % worker_id for worker_id in range(MAX_WORKER_ID + 1)])
+
+    def test_renew_own_lease(self):
+        """租约属于当前进程时续期，机器id不变"""
+        first_id = self.snowflake.next_id()
+        worker_id = parse_id(first_id)[1]
+        key = WORKER_LEASE_KEY % worker_id
+        self.assertEqual(self.conn.get(key).decode(), self.snowflake.owner)
+
+        self.conn.expire(key, 5)
+        self.snowflake.renewed -= WORKER_LEASE_RENEW + 1
+        second_id = self.snowflake.next_id()
+        self.assertEqual(parse_id(second_id)[1], worker_id)
+        self.assertGreater(second_id, first_id)
+        self.assertGreater(self.conn.ttl(key), WORKER_LEASE_TIMEOUT - 10)
+
+    def test_expired_lease_taken_over(self):
+        """租约过期后被其他进程占用，重新分配机器id，不会和其他进程使用同一个机器id"""
+        first_id = self.snowflake.next_id()
+        worker_id = parse_id(first_id)[1]
+        key = WORKER_LEASE_KEY % worker_id
+        # 长时间没有生成id，租约过期，机器id被其他进程占用
+        self.conn.delete(key)
+        self.conn.set(key, 'other-host:1', ex=WORKER_LEASE_TIMEOUT)
+        self.snowflake.renewed -= WORKER_LEASE_RENEW + 1
+
+        second_id = self.snowflake.next_id()
+        new_worker_id = parse_id(second_id)[1]
+        self.assertNotEqual(new_worker_id, worker_id)
+        self.assertGreater(second_id, first_id)
+        self.assertEqual(self.conn.get(key), b'other-host:1')
+        self.assertEqual(self.conn.get(WORKER_LEASE_KEY % new_worker_id).decode(), self.snowflake.owner)
+
+
+@override_settings(SNOWFLAKE_WORKER_ID=1)
+class OrderCommitTestCase(TestCase):
+    """订单提交测试的公共部分，购物车中每个商品买count件"""
+
+    view_class = None
+    stocks = (10, 5)
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'password')
+        self.addr = Address.objects.create(user=self.user, receiver='buyer', addr='addr', phone='13800000000')
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='草莓')
+        self.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='商品%d' % i, desc='简介', price=10,
+                                             stock=stock, unite='500g', image='sku.jpg')
+                     for i, stock in enumerate(self.stocks)]
+        self.ids = [sku.id for sku in self.skus]
+        self.conn = self.get_connection()
+        self.conn.delete(get_cart_key(self.user.id))
+        patcher = mock.patch('apps.order.views.get_redis_connection', return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def get_connection(self):
+        return mock.MagicMock()
+
+    def commit(self, counts):
+        """把{sku_id: count}放入购物车并提交订单，返回应答的res"""
+        self.set_cart(counts)
+        request = RequestFactory().post('/order/commit/', {
+            'addr_id': self.addr.id, 'pay_method': '1', 'sku_ids': ','.join(str(sku_id) for sku_id in counts)})
+        request.user = self.user
+        return json.loads(self.view_class.as_view()(request).content)['res']
+
+    def set_cart(self, counts):
+        self.conn.hmget.side_effect = lambda key, sku_ids: [counts.get(sku_id) for sku_id in sku_ids]
+
+    def db_stocks(self):
+        return [GoodsSKU.objects.get(id=sku_id).stock for sku_id in self.ids]
+
+
+class OrderCommitPessimisticTest(OrderCommitTestCase):
+    """悲观锁的订单提交测试"""
+
+    view_class = OrderCommitView
+    stocks = (10, 5, 10, 10, 10)
+
+    def test_query_count_is_constant(self):
+        """语句数目和订单中的商品数目无关：地址、加锁查询商品、订单、订单商品、更新库存，加上保存点"""
+        with self.assertNumQueries(7):
+            self.assertEqual(self.commit({self.ids[0]: 1}), 5)
+        with self.assertNumQueries(7):
+            self.assertEqual(self.commit({sku_id: 1 for sku_id in self.ids}), 5)
+        self.assertEqual(self.db_stocks(), [8, 4, 9, 9, 9])
+        self.assertEqual(GoodsSKU.objects.get(id=self.ids[0]).sales, 2)
+
+    def test_not_enough(self):
+        """有一个商品库存不足时不创建订单，不扣减库存"""
+        self.assertEqual(self.commit({self.ids[0]: 3, self.ids[1]: 6}), 6)
+        self.assertEqual(OrderInfo.objects.count(), 0)
+        self.assertEqual(self.db_stocks(), list(self.stocks))
+
+
+class OrderCommitOptimisticTest(OrderCommitTestCase):
+    """乐观锁的订单提交测试"""
+
+    view_class = OrderCommitView1
+    stocks = (10, 5, 10, 10, 10)
+
+    def setUp(self):
+        super(OrderCommitOptimisticTest, self).setUp()
+        patcher = mock.patch('apps.order.views.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_query_count_is_constant(self):
+        """语句数目和订单中的商品数目无关：地址、查询商品、订单、订单商品、条件更新、更新后的库存，加上保存点"""
+        with self.assertNumQueries(8):
+            self.assertEqual(self.commit({self.ids[0]: 1}), 5)
+        with self.assertNumQueries(8):
+            self.assertEqual(self.commit({sku_id: 1 for sku_id in self.ids}), 5)
+        self.assertEqual(self.db_stocks(), [8, 4, 9, 9, 9])
+
+    def test_not_enough_rolls_back(self):
+        """有一个商品库存不足时回滚订单，其他商品的库存也不扣减"""
+        self.assertEqual(self.commit({self.ids[0]: 3, self.ids[1]: 6}), 6)
+        self.assertEqual(OrderInfo.objects.count(), 0)
+        self.assertEqual(OrderGoods.objects.count(), 0)
+        self.assertEqual(self.db_stocks(), list(self.stocks))
+
+    def test_retry_on_operational_error(self):
+        """死锁或锁等待超时时重试，重试成功后正常创建订单"""
+        create = OrderInfo.objects.create
+        errors = [OperationalError('deadlock'), OperationalError('lock wait timeout')]
+
+        def flaky_create(**kwargs):
+            if errors:
+                raise errors.pop(0)
+            return create(**kwargs)
+        with mock.patch.object(OrderInfo.objects, 'create', side_effect=flaky_create):
+            self.assertEqual(self.commit({self.ids[0]: 3, self.ids[1]: 5}), 5)
+        self.assertEqual(self.sleep.call_count, 2)
+        self.assertEqual(OrderInfo.objects.count(), 1)
+        self.assertEqual(self.db_stocks()[:2], [7, 0])
+
+    def test_give_up_after_max_retries(self):
+        """重试ORDER_COMMIT_MAX_RETRIES次后仍然失败，返回下单失败，不留下订单"""
+        with mock.patch.object(OrderInfo.objects, 'create', side_effect=OperationalError('deadlock')) as create:
+            self.assertEqual(self.commit({self.ids[0]: 3}), 7)
+        self.assertEqual(create.call_count, settings.ORDER_COMMIT_MAX_RETRIES + 1)
+        self.assertEqual(self.sleep.call_count, settings.ORDER_COMMIT_MAX_RETRIES)
+        self.assertEqual(OrderInfo.objects.count(), 0)
+        self.assertEqual(self.db_stocks(), list(self.stocks))
+
+
+class OrderCommitRedisTest(OrderCommitTestCase):
+    """redis预扣库存的订单提交测试，需要本地redis"""
+
+    view_class = OrderCommitRedisView
+
+    def get_connection(self):
+        conn = get_local_redis()
+        if conn is None:
+            self.skipTest('本地redis不可用')
+        conn.delete(SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY)
+        self.addCleanup(conn.delete, SKU_STOCK_KEY, SKU_STOCK_PENDING_KEY)
+        return conn
+
+    def set_cart(self, counts):
+        self.conn.hset(get_cart_key(self.user.id), mapping=counts)
+
+    def mirror(self, key=SKU_STOCK_KEY):
+        return [int(self.conn.hget(key, sku_id) or 0) for sku_id in self.ids]
+
+    def test_not_enough_reserves_nothing(self):
+        """一个商品库存不足时整个订单失败，其他商品也不预扣"""
+        a, b = self.ids
+        self.assertEqual(self.commit({a: 3, b: 6}), 6)
+        self.assertEqual(self.mirror(), [10, 5])
+        self.assertEqual(OrderInfo.objects.count(), 0)
+
+        self.assertEqual(self.commit({a: 3, b: 5}), 5)
+        self.assertEqual(self.mirror(), [7, 0])
+        self.assertEqual(self.mirror(SKU_STOCK_PENDING_KEY), [3, 5])
+        self.assertEqual(OrderGoods.objects.count(), 2)
+        # 数据库库存由flush_stock写回
+        self.assertEqual(self.db_stocks(), [10, 5])
+
+    def test_release_on_failure(self):
+        """订单写入数据库失败时归还预扣的库存"""
+        a, b = self.ids
+        with mock.patch.object(OrderGoods.objects, 'bulk_create', side_effect=DatabaseError):
+            self.assertEqual(self.commit({a: 3, b: 5}), 7)
+        self.assertEqual(self.mirror(), [10, 5])
+        self.assertEqual(self.mirror(SKU_STOCK_PENDING_KEY), [0, 0])
+        self.assertEqual(OrderInfo.objects.count(), 0)
+
+
+class AliPayProviderTest(SimpleTestCase):
+    """共享的支付宝接口对象测试"""
+
+    def setUp(self):
+        # 复制密钥文件，修改时间不影响项目中的文件
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.private_key = os.path.join(self.dir, 'app_private_key.pem')
+        self.public_key = os.path.join(self.dir, 'alipay_public_key.pem')
+        shutil.copy(settings.ALIPAY_PRIVATE_KEY_PATH, self.private_key)
+        shutil.copy(settings.ALIPAY_PUBLIC_KEY_PATH, self.public_key)
+
+    def test_reuses_client_and_reloads_changed_keys(self):
+        """密钥没有修改时返回同一个对象，修改后重新加载"""
+        provider = AliPayProvider()
+        with self.settings(ALIPAY_PRIVATE_KEY_PATH=self.private_key, ALIPAY_PUBLIC_KEY_PATH=self.public_key,
+                           ALIPAY_KEY_CHECK_INTERVAL=0):
+            alipay = provider.get()
+            self.assertIs(provider.get(), alipay)
+
+            stat = os.stat(self.public_key)
+            os.utime(self.public_key, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            self.assertIsNot(provider.get(), alipay)
+
+
+class FakeAliPay(object):
+    """本地的假支付宝接口，签名为good时验证通过，trades为{order_id: 交易查询接口的返回}"""
+
+    def __init__(self, trades=None):
+        self.trades = trades or {}
+        self.queries = []
+
+    def verify(self, data, signature):
+        return signature == 'good'
+
+    def api_alipay_trade_query(self, out_trade_no):
+        self.queries.append(out_trade_no)
+        return self.trades.get(out_trade_no, {'code': '40004', 'msg': 'Business Failed'})
+
+
+class PaymentTest(TestCase):
+    """支付结果确认测试，使用假的支付宝接口，需要本地redis"""
+
+    order_id = '0000000000000000001'
+
+    def setUp(self):
+        self.conn = get_local_redis()
+        if self.conn is None:
+            self.skipTest('本地redis不可用')
+        self.clear_redis()
+        self.user = User.objects.create_user('payer', 'payer@example.com', 'password')
+        addr = Address.objects.create(user=self.user, receiver='payer', addr='addr', phone='13800000000')
+        OrderInfo.objects.create(order_id=self.order_id, user=self.user, addr=addr, pay_method=3,
+                                 total_count=1, total_price='10.00', transit_price='10.00')
+        self.client.force_login(self.user)
+        patcher = mock.patch('apps.order.views.get_redis_connection', return_value=self.conn)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.clear_redis()
+
+    def clear_redis(self):
+        self.conn.delete(ORDER_PAY_PENDING_KEY, ORDER_PAY_ATTEMPTS_KEY, ORDER_PAID_KEY % self.order_id,
+                         ORDER_PAY_FAILED_KEY % self.order_id)
+
+    def order_status(self):
+        return OrderInfo.objects.get(order_id=self.order_id).order_status
+
+    def notify(self, signature='good', total_amount='20.00'):
+        data = {'out_trade_no': self.order_id, 'trade_no': 'T1', 'trade_status': 'TRADE_SUCCESS',
+                'total_amount': total_amount, 'sign': signature}
+        with mock.patch('apps.order.views.get_alipay', return_value=FakeAliPay()):
+            return self.client.post('/order/notify/', data).content
+
+    def test_notify_is_idempotent(self):
+        """重复的异步通知只更新一次订单，只唤醒一次检查请求"""
+        self.assertEqual(self.notify(), b'success')
+        self.assertEqual(self.notify(), b'success')
+        order = OrderInfo.objects.get(order_id=self.order_id)
+        self.assertEqual((order.order_status, order.trade_no), (4, 'T1'))
+        self.assertEqual(self.conn.llen(ORDER_PAID_KEY % self.order_id), 1)
+
+    def test_notify_rejects_bad_signature_and_amount(self):
+        """签名或金额不对的通知不会更新订单"""
+        self.assertEqual(self.notify(signature='bad'), b'failure')
+        self.assertEqual(self.notify(total_amount='0.01'), b'failure')
+        self.assertEqual(self.order_status(), 1)
+
+    def test_poller_backs_off_until_paid(self):
+        """定时查询没有支付时按照退避时间重新安排，支付后确认并移出队列"""
+        alipay = FakeAliPay()
+        schedule_payment_check(self.conn, self.order_id)
+        # 还没有到查询时间
+        self.assertEqual(check_pending_payments(self.conn, alipay), 0)
+        self.assertEqual(alipay.queries, [])
+
+        self.conn.zadd(ORDER_PAY_PENDING_KEY, {self.order_id: 0})
+        self.assertEqual(check_pending_payments(self.conn, alipay), 0)
+        self.assertEqual(alipay.queries, [self.order_id])
+        self.assertGreater(self.conn.zscore(ORDER_PAY_PENDING_KEY, self.order_id), time.time() + PAY_CHECK_INTERVAL)
+
+        alipay.trades[self.order_id] = {'code': '10000', 'trade_status': 'TRADE_SUCCESS', 'trade_no': 'T2',
+                                        'total_amount': '20.00'}
+        self.conn.zadd(ORDER_PAY_PENDING_KEY, {self.order_id: 0})
+        self.assertEqual(check_pending_payments(self.conn, alipay), 1)
+        self.assertEqual(self.order_status(), 4)
+        self.assertIsNone(self.conn.zscore(ORDER_PAY_PENDING_KEY, self.order_id))
+        self.assertEqual(wait_for_payment(self.conn, self.order_id, 1), PAY_SUCCESS)
+
+    def test_poller_rejects_wrong_amount(self):
+        """定时查询到的支付金额不对时不确认订单，和异步通知一样"""
+        alipay = FakeAliPay({self.order_id: {'code': '10000', 'trade_status': 'TRADE_SUCCESS', 'trade_no': 'T3',
+                                             'total_amount': '0.01'}})
+        self.conn.zadd(ORDER_PAY_PENDING_KEY, {self.order_id: 0})
+        self.assertEqual(check_pending_payments(self.conn, alipay), 0)
+        self.assertEqual(self.order_status(), 1)
+        self.assertEqual(alipay.queries, [self.order_id])
+
+    def test_closed_trade_fails_check(self):
+        """定时查询到交易关闭时，等待中和之后的检查请求都返回支付失败，重新发起支付后清除"""
+        alipay = FakeAliPay({self.order_id: {'code': '10000', 'trade_status': 'TRADE_CLOSED'}})
+        self.conn.zadd(ORDER_PAY_PENDING_KEY, {self.order_id: 0})
+        self.assertEqual(check_pending_payments(self.conn, alipay), 0)
+        self.assertIsNone(self.conn.zscore(ORDER_PAY_PENDING_KEY, self.order_id))
+
+        for i in range(2):
+            response = self.client.post('/order/check/', {'order_id': self.order_id})
+            self.assertEqual(response.json(), {'res': 4, 'errmsg': '支付失败'})
+        self.assertEqual(self.order_status(), 1)
+
+        schedule_payment_check(self.conn, self.order_id)
+        self.assertFalse(self.conn.exists(ORDER_PAY_FAILED_KEY % self.order_id))
+
+    def test_check_waits_with_timeout(self):
+        """没有支付时检查请求等待超时后返回等待支付，已经支付的订单立即返回"""
+        # 使用默认的等待时间，检查请求不会长时间占用web进程
+        start = time.time()
+        response = self.client.post('/order/check/', {'order_id': self.order_id})
+        self.assertEqual(response.json()['res'], 5)
+        self.assertLess(time.time() - start, 2)
+
+        self.notify()
+        response = self.client.post('/order/check/', {'order_id': self.order_id})
+        self.assertEqual(response.json()['res'], 3)
+
@@ -1,18 +1,52 @@
 from django.shortcuts import render, redirect, reverse
 from utils.Mixin import LoginRequiredMixin
+from utils.snowflake import generate_order_id
 from django.views import View
 from django_redis import get_redis_connection
 from apps.goods.models import *
 from apps.user.models import *
 from apps.order.models import *
-from django.db import transaction
-from django.http import JsonResponse
-from datetime import datetime
-from alipay import AliPay
+from apps.goods.sku_cache import get_sku_snapshots
+from apps.cart.utils import get_cart_key, get_cart_counts
+from apps.goods.stock import reserve_stock, release_stock, set_stock, STOCK_MISSING, STOCK_NOT_ENOUGH
+from apps.goods.sku_cache import invalidate_skus
+from apps.goods.sales import add_sales
+from apps.goods.comments import invalidate_comments
+from apps.goods.cache import invalidate_detail_pages
+from django.db import transaction, OperationalError
+from django.db.models import F, Q, Case, When
+from django.http import JsonResponse, HttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.csrf import csrf_exempt
+from apps.order.payment import get_alipay, confirm_payment, schedule_payment_check, wait_for_payment, payment_failed, \
+    PAY_SUCCESS, PAY_FAILED
+from decimal import Decimal
 import os
+import time
+import random
 from django.conf import settings
 
 
+def parse_sku_ids(sku_ids):
+    '''解析提交订单时逗号分隔的sku_id，返回去重后的id列表，有不合法的id时返回None'''
+    ids = []
+    for sku_id in sku_ids.split(','):
+        try:
+            sku_id = int(sku_id)
+        except ValueError:
+            return None
+        if sku_id not in ids:
+            ids.append(sku_id)
+    return ids
+
+
+def sku_stocks_changed(conn, stocks):
+    '''商品库存在数据库中被update修改，更新库存镜像并清除商品快照缓存，stocks为{sku_id: 新的库存}'''
+    for sku_id, stock in stocks.items():
+        set_stock(conn, sku_id, stock)
+    invalidate_skus(stocks.keys())
+
+
 '''订单页面'''
 class OrderPlaceView(LoginRequiredMixin, View):
     '''订单提交页面'''
@@ -25,24 +59,25 @@ class OrderPlaceView(LoginRequiredMixin, View):
         if not sku_ids:
             return redirect(reverse('cart:cart_info'))
 
+        # 从商品快照缓存中批量获取商品，一次HMGET取出所有商品的数量
         conn = get_redis_connection('default')
-        cart_key = 'cart_%s' % user.id
-        skus = []
+        skus = get_sku_snapshots(sku_ids)
+        cart_counts = get_cart_counts(conn, user.id, [sku.id for sku in skus])
+        # 跳过不在购物车中的商品
+        skus = [sku for sku in skus if sku.id in cart_counts]
         total_count = 0
         total_price = 0
-        for sku_id in sku_ids:
-            #  获取商品的信息和数量
-            sku = GoodsSKU.objects.get(id=sku_id)
-            count = conn.hget(cart_key, sku_id)
-            amount = sku.price * int(count)
+        for sku in skus:
+            #  获取商品的数量
+            count = cart_counts[sku.id]
+            amount = sku.price * count
 
             # 动态添加数量和小计
-            sku.count = int(count)
+            sku.count = count
             sku.amount = int(amount)
-            skus.append(sku)
 
             total_price += int(amount)
-            total_count += int(count)
+            total_count += count
 
         # 写死运费
         transit_price = int(10)
@@ -52,7 +87,8 @@ class OrderPlaceView(LoginRequiredMixin, View):
 
         # 获取用户的收件地址
         addrs = Address.objects.filter(user=user)
-        sku_ids = ''.join(sku_ids)
+        # 提交订单时使用逗号分隔的sku_id
+        sku_ids = ','.join(str(sku.id) for sku in skus)
 
         # 组织上下文
         context = {
@@ -70,9 +106,12 @@ class OrderPlaceView(LoginRequiredMixin, View):
 
 '''订单提交：悲观锁'''
 class OrderCommitView(View):
-    '''订单提交：悲观锁'''
+    '''
+    订单提交：悲观锁
+        一次查询按照id顺序锁住订单中所有的商品，两个订单包含相同的商品时加锁顺序一致，不会死锁
+        订单商品批量插入，库存和销量用一条update语句更新，不管订单有多少商品，执行的sql语句数目都是固定的
+    '''
 
-    @transaction.atomic
     def post(self, request):
 
         # 验证用户
@@ -95,72 +134,75 @@ class OrderCommitView(View):
         except Address.DoesNotExist as e:
             return JsonResponse({'res': 3, 'errmsg': '地址不存在'})
 
-        # 创建订单核心业务
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+        sku_ids = parse_sku_ids(sku_ids)
+        if not sku_ids:
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+
+        # 从redis中获取用户所要购买的商品的数量
+        conn = get_redis_connection('default')
+        cart_key = get_cart_key(user.id)
+        counts = get_cart_counts(conn, user.id, sku_ids)
+        if len(counts) != len(sku_ids):
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+
+        # 创建订单核心业务，生成全局唯一的订单id
+        order_id = generate_order_id()
 
         # 运费
         transit_price = 10
 
-        # 总数目和总金额
-        total_count = 0
-        total_price = 0
-
-        # 设置事务保存点
-        save_id = transaction.savepoint()
         try:
-            order = OrderInfo.objects.create(order_id=order_id,user=user,addr=addr,pay_method=pay_method,total_count=total_count,total_price=total_price,transit_price=transit_price)
-
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
-
-            for sku_id in sku_ids:
-                #  获取商品的信息
-                try:
-                    '''
-                        悲观锁在查询的时候就加锁。
-                        乐观锁不在查询的时候加锁，而是在判断更新库存的时候和之前查到的库存是不是相等，不相等的话说明期间别人把库存进行了修改。
-                    '''
-                    sku = GoodsSKU.objects.select_for_update().get(id=sku_id)
-                except:
+            with transaction.atomic():
+                '''
+                    悲观锁在查询的时候就加锁。
+                    乐观锁不在查询的时候加锁，而是在判断更新库存的时候和之前查到的库存是不是相等，不相等的话说明期间别人把库存进行了修改。
+                '''
+                skus = list(GoodsSKU.objects.select_for_update().filter(id__in=sku_ids).order_by('id'))
+                if len(skus) != len(sku_ids):
                     # 商品不存在
-                    transaction.savepoint_rollback(save_id)
                     return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
 
-                # 从redis中获取用户所要购买的商品的数量
-                count = conn.hget(cart_key, sku_id)
-
-                # 判断商品的库存
-                if int(count) > sku.stock:
-                    transaction.savepoint_rollback(save_id)
-                    return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
-
-                # 向order_goods 表中添加一条记录
-                OrderGoods.objects.create(order=order,sku=sku,count=count,price=sku.price)
-
-                # 更新商品的库存和销量
-                sku.stock -= int(count)
-                sku.sales += int(count)
-                sku.save()
-
-                # 累加计算订单商品的总数量和总价格
-                amount = sku.price * int(count)
-                total_count += int(count)
-                total_price += amount
-            
-            # 更新订单信息表中的商品的总数量和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
+                # 总数目和总金额
+                total_count = 0
+                total_price = 0
+                order_goods = []
+                for sku in skus:
+                    count = counts[sku.id]
+                    # 判断商品的库存
+                    if count > sku.stock:
+                        return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
+
+                    order_goods.append(OrderGoods(order_id=order_id, sku=sku, count=count, price=sku.price))
+                    # 累加计算订单商品的总数量和总价格
+                    total_count += count
+                    total_price += sku.price * count
+
+                OrderInfo.objects.create(order_id=order_id, user=user, addr=addr, pay_method=pay_method,
+                                         total_count=total_count, total_price=total_price,
+                                         transit_price=transit_price)
+
+                # 向order_goods 表中批量添加记录
+                OrderGoods.objects.bulk_create(order_goods)
+
+                # 一条语句更新所有商品的库存和销量
+                GoodsSKU.objects.filter(id__in=sku_ids).update(
+                    stock=Case(*[When(id=sku.id, then=F('stock') - counts[sku.id]) for sku in skus]),
+                    sales=Case(*[When(id=sku.id, then=F('sales') + counts[sku.id]) for sku in skus]),
+                )
+
+                # update不会发出post_save信号，提交后手动更新库存镜像和商品快照缓存
+                stocks = {sku.id: sku.stock - counts[sku.id] for sku in skus}
+                transaction.on_commit(lambda: sku_stocks_changed(conn, stocks))
+
+                # 提交后累加销量排行
+                sales = [(sku.type_id, sku.id, counts[sku.id]) for sku in skus]
+                transaction.on_commit(lambda: add_sales(conn, sales))
         except Exception as e:
-            transaction.savepoint_rollback(save_id)
             return JsonResponse({'res': 7, 'errmsg': '下单失败'})
-        
-        # 提交事务，否则不会提交
-        transaction.savepoint_commit(save_id)
-        
+
         # 清除用户购物车中对应的记录
         conn.hdel(cart_key, *sku_ids)
-        
+
         # 返回应答
         return JsonResponse({'res': 5, 'errmsg': '创建成功'})
 
@@ -169,11 +211,10 @@ class OrderCommitView(View):
 class OrderCommitView1(View):
     '''
     订单提交：乐观锁
-    需要在mysql的配置文件中添加mysql的事务隔离级别为read-commited只读提交的内容
-    防止读取不到另一个事务提交后的更新数据
+        查询商品时不加锁，更新库存时使用条件update ... where stock >= count，库存不足时更新不到数据
+        死锁、锁等待超时时整个事务重试，重试前按指数退避并加上随机抖动，最多重试ORDER_COMMIT_MAX_RETRIES次
     '''
 
-    @transaction.atomic
     def post(self, request):
 
         # 验证用户
@@ -196,8 +237,24 @@ class OrderCommitView1(View):
         except Address.DoesNotExist as e:
             return JsonResponse({'res': 3, 'errmsg': '地址不存在'})
 
-        # 创建订单核心业务
-        order_id = datetime.now().strftime('%Y%m%d%H%M%S') + str(user.id)
+        sku_ids = parse_sku_ids(sku_ids)
+        if not sku_ids:
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+
+        # 一次查询出所有商品，不加锁
+        skus = GoodsSKU.objects.in_bulk(sku_ids)
+        if len(skus) != len(sku_ids):
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+
+        # 从redis中获取用户所要购买的商品的数量
+        conn = get_redis_connection('default')
+        cart_key = get_cart_key(user.id)
+        counts = get_cart_counts(conn, user.id, sku_ids)
+        if len(counts) != len(sku_ids):
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+
+        # 创建订单核心业务，生成全局唯一的订单id
+        order_id = generate_order_id()
 
         # 运费
         transit_price = 10
@@ -205,84 +262,144 @@ class OrderCommitView1(View):
         # 总数目和总金额
         total_count = 0
         total_price = 0
+        for sku_id in sku_ids:
+            total_count += counts[sku_id]
+            total_price += skus[sku_id].price * counts[sku_id]
 
-        # 设置事务保存点
-        save_id = transaction.savepoint()
-        try:
-            order = OrderInfo.objects.create(order_id=order_id, user=user, addr=addr, pay_method=pay_method,
+        # 按照id顺序更新，只有库存足够的商品才会被更新
+        sku_ids = sorted(sku_ids)
+        condition = Q()
+        for sku_id in sku_ids:
+            condition |= Q(id=sku_id, stock__gte=counts[sku_id])
+
+        for i in range(settings.ORDER_COMMIT_MAX_RETRIES + 1):
+            try:
+                with transaction.atomic():
+                    OrderInfo.objects.create(order_id=order_id, user=user, addr=addr, pay_method=pay_method,
                                              total_count=total_count, total_price=total_price,
                                              transit_price=transit_price)
+                    OrderGoods.objects.bulk_create([
+                        OrderGoods(order_id=order_id, sku=skus[sku_id], count=counts[sku_id], price=skus[sku_id].price)
+                        for sku_id in sku_ids
+                    ])
+
+                    # 返回受影响的行数，小于商品数目表示有商品库存不足
+                    res = GoodsSKU.objects.filter(condition).update(
+                        stock=Case(*[When(id=sku_id, then=F('stock') - counts[sku_id]) for sku_id in sku_ids]),
+                        sales=Case(*[When(id=sku_id, then=F('sales') + counts[sku_id]) for sku_id in sku_ids]),
+                    )
+                    if res < len(sku_ids):
+                        transaction.set_rollback(True)
+                        return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
+
+                    # update不会发出post_save信号，提交后手动更新库存镜像和商品快照缓存
+                    stocks = dict(GoodsSKU.objects.filter(id__in=sku_ids).values_list('id', 'stock'))
+                    transaction.on_commit(lambda: sku_stocks_changed(conn, stocks))
+
+                    # 提交后累加销量排行
+                    sales = [(skus[sku_id].type_id, sku_id, counts[sku_id]) for sku_id in sku_ids]
+                    transaction.on_commit(lambda: add_sales(conn, sales))
+                break
+            except OperationalError as e:
+                # 死锁或者锁等待超时
+                if i == settings.ORDER_COMMIT_MAX_RETRIES:
+                    return JsonResponse({'res': 7, 'errmsg': '下单失败'})
+                time.sleep(random.uniform(0, settings.ORDER_COMMIT_RETRY_DELAY * 2 ** i))
+            except Exception as e:
+                return JsonResponse({'res': 7, 'errmsg': '下单失败'})
+
+        # 清除用户购物车中对应的记录
+        conn.hdel(cart_key, *sku_ids)
 
-            conn = get_redis_connection('default')
-            cart_key = 'cart_%d' % user.id
+        # 返回应答
+        return JsonResponse({'res': 5, 'errmsg': '创建成功'})
 
 
-            for sku_id in sku_ids:
-                #  获取商品的信息
-                for i in range(3):
-                    try:
-                        '''
-                            悲观锁在查询的时候就加锁。
-                            乐观锁不在查询的时候加锁，而是在判断更新库存的时候和之前查到的库存是不是相等，不相等的话说明期间别人把库存进行了修改。
-                        '''
-                        sku = GoodsSKU.objects.get(id=sku_id)
-                    except:
-                        # 商品不存在
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+'''订单提交：redis预扣库存'''
+class OrderCommitRedisView(View):
+    '''
+    订单提交：redis预扣库存
+        在redis库存镜像中用lua脚本一次预扣订单所有商品的库存，不锁数据库中的商品行
+        预扣的库存由celery定时任务flush_stock批量写回数据库
+    '''
 
-                    # 从redis中获取用户所要购买的商品的数量
-                    count = conn.hget(cart_key, sku_id)
+    def post(self, request):
 
-                    # 判断商品的库存
-                    if int(count) > sku.stock:
-                        transaction.savepoint_rollback(save_id)
-                        return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
+        # 验证用户
+        user = request.user
+        if not user.is_authenticated:
+            return JsonResponse({'res': 0, 'errmsg': '用户未登录'})
 
-                    print('user:%d stock:%d' % (user.id, sku.stock))
-                    import time
-                    time.sleep(10)
+        # 接收参数
+        addr_id = request.POST.get('addr_id')
+        pay_method = request.POST.get('pay_method')
+        sku_ids = request.POST.get('sku_ids')
+        if not all([addr_id, pay_method, sku_ids]):
+            return JsonResponse({'res': 1, 'errmsg': '参数不完整'})
 
-                    # 向order_goods 表中添加一条记录
-                    OrderGoods.objects.create(order=order, sku=sku, count=count, price=sku.price)
+        if pay_method not in OrderInfo.PAY_METHODS.keys():
+            return JsonResponse({'res': 2, 'errmsg': '非法支付方式'})
 
-                    # 更新商品的库存和销量
-                    orgin_stock = sku.stock
-                    new_stock = orgin_stock - int(count)
-                    new_sales = sku.sales + int(count)
+        try:
+            addr = Address.objects.get(id=addr_id)
+        except Address.DoesNotExist as e:
+            return JsonResponse({'res': 3, 'errmsg': '地址不存在'})
 
-                    # 返回受影响的行数，表示1更新成功，返回0表示更新失败
-                    res = GoodsSKU.objects.filter(id=sku_id, stock=orgin_stock).update(stock=new_stock, sales=new_sales)
+        sku_ids = parse_sku_ids(sku_ids)
+        if not sku_ids:
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
 
-                    if res == 0:
-                        if i == 2:
-                            # 尝试到第3次
-                            transaction.savepoint_rollback(save_id)
-                            return JsonResponse({'res': 7, 'errmsg': '下单失败'})
-                        else:
-                            continue
+        # 一次查询出所有商品，不加锁
+        skus = GoodsSKU.objects.in_bulk(sku_ids)
+        if len(skus) != len(sku_ids):
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
 
-                    # 向df_order_goods表中添加一条记录
-                    OrderGoods.objects.create(order=order,sku=sku,count=count,price=sku.price)
+        # 从redis中获取用户所要购买的商品的数量
+        conn = get_redis_connection('default')
+        cart_key = get_cart_key(user.id)
+        counts = get_cart_counts(conn, user.id, sku_ids)
+        if len(counts) != len(sku_ids):
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
 
-                    # 累加计算订单商品的总数量和总价格
-                    amount = sku.price * int(count)
-                    total_count += int(count)
-                    total_price += amount
+        # 预扣库存，所有商品的库存都足够才会扣减
+        status, sku_id = reserve_stock(conn, counts)
+        if status == STOCK_MISSING:
+            return JsonResponse({'res': 4, 'errmsg': '商品不存在'})
+        if status == STOCK_NOT_ENOUGH:
+            return JsonResponse({'res': 6, 'errmsg': '商品库存不足'})
+
+        # 创建订单核心业务，生成全局唯一的订单id
+        order_id = generate_order_id()
 
-                    break
+        # 运费
+        transit_price = 10
 
-            # 更新订单信息表中的商品的总数量和总价格
-            order.total_count = total_count
-            order.total_price = total_price
-            order.save()
+        # 总数目和总金额
+        total_count = 0
+        total_price = 0
+        order_goods = []
+        for sku_id in sku_ids:
+            sku = skus[sku_id]
+            count = counts[sku_id]
+            order_goods.append(OrderGoods(order_id=order_id, sku=sku, count=count, price=sku.price))
+            total_count += count
+            total_price += sku.price * count
+
+        try:
+            with transaction.atomic():
+                OrderInfo.objects.create(order_id=order_id, user=user, addr=addr, pay_method=pay_method,
+                                         total_count=total_count, total_price=total_price,
+                                         transit_price=transit_price)
+                OrderGoods.objects.bulk_create(order_goods)
+
+                # 提交后累加销量排行，数据库中的销量由flush_stock写回
+                sales = [(skus[sku_id].type_id, sku_id, counts[sku_id]) for sku_id in sku_ids]
+                transaction.on_commit(lambda: add_sales(conn, sales))
         except Exception as e:
-            transaction.savepoint_rollback(save_id)
+            # 订单创建失败，归还预扣的库存
+            release_stock(conn, counts)
             return JsonResponse({'res': 7, 'errmsg': '下单失败'})
 
-        # 提交事务，否则不会提交
-        transaction.savepoint_commit(save_id)
-
         # 清除用户购物车中对应的记录
         conn.hdel(cart_key, *sku_ids)
 
@@ -312,14 +429,7 @@ class OrderPayView(View):
             return JsonResponse({'res': 2, 'errmsg': '订单错误'})
 
         # 调用支付宝接口
-        alipay = AliPay(
-            appid="2016101400683195",
-            app_notify_url=None,
-            app_private_key_string=open('apps/order/app_private_key.pem').read(),
-            alipay_public_key_string=open('apps/order/alipay_public_key.pem').read(),
-            sign_type="RSA2",
-            debug=True
-        )
+        alipay = get_alipay()
 
         # 电脑网站支付 需要跳转到https://openapi.alipay.com/gateway.do? + order_string
         total_pay = order.total_price + order.transit_price
@@ -327,17 +437,27 @@ class OrderPayView(View):
             out_trade_no=order_id,
             total_amount=str(total_pay),
             subject='天天生鲜%s' % order_id,
-            return_url="https://example.com",
-            notify_url="https://example.com/notify"
+            return_url=settings.ALIPAY_RETURN_URL,
+            notify_url=settings.ALIPAY_NOTIFY_URL
         )
-        
+
+        # 加入定时查询支付结果的队列，收不到支付宝的异步通知时也能确认支付结果
+        schedule_payment_check(get_redis_connection('default'), order_id)
+
         # 返回应答，引导html页面跳转去接受支付的页面
-        pay_url = 'https://openapi.alipaydev.com/gateway.do?' + order_string
+        pay_url = settings.ALIPAY_GATEWAY + '?' + order_string
         return JsonResponse({'res': 3, 'pay_url':pay_url})
 
 
 '''检查订单'''
 class OrderCheckView(View):
+    '''
+    检查订单的支付结果
+        支付结果由支付宝异步通知和celery定时查询确认，这里只读取订单状态
+        还没有支付时最多等待ORDER_CHECK_TIMEOUT秒(很短，不会长时间占用web进程)，
+        超时返回等待支付，页面隔几秒后重新发起检查
+        定时查询到交易关闭时返回支付失败
+    '''
 
     def post(self, request):
         # 判断用户是否登录
@@ -352,68 +472,67 @@ class OrderCheckView(View):
             return JsonResponse({'res': 1, 'errmsg': '无效的订单id'})
 
         try:
-            order = OrderInfo.objects.get(order_id=order_id, user=user, pay_method=3, order_status=1)
+            order = OrderInfo.objects.get(order_id=order_id, user=user, pay_method=3)
         except OrderInfo.DoesNotExist as e:
             return JsonResponse({'res': 2, 'errmsg': '订单错误'})
 
-        # 调用支付宝接口
-        alipay = AliPay(
-            appid="2016101400683195",
-            app_notify_url=None,
-            app_private_key_string=open('apps/order/app_private_key.pem').read(),
-            alipay_public_key_string=open('apps/order/alipay_public_key.pem').read(),
-            sign_type="RSA2",
-            debug=True
-        )
+        if order.order_status != 1:
+            return JsonResponse({'res': 3, 'errmsg': '支付成功'})
+
+        # 等待支付结果的通知
+        conn = get_redis_connection('default')
+        status = wait_for_payment(conn, order_id, settings.ORDER_CHECK_TIMEOUT)
+        if status == PAY_SUCCESS:
+            return JsonResponse({'res': 3, 'errmsg': '支付成功'})
+        if status == PAY_FAILED:
+            return JsonResponse({'res': 4, 'errmsg': '支付失败'})
+
+        # 可能是其他请求收到了通知
+        if OrderInfo.objects.filter(order_id=order_id).exclude(order_status=1).exists():
+            return JsonResponse({'res': 3, 'errmsg': '支付成功'})
+        if payment_failed(conn, order_id):
+            return JsonResponse({'res': 4, 'errmsg': '支付失败'})
+
+        return JsonResponse({'res': 5, 'errmsg': '等待支付'})
+
+
+'''支付宝异步通知'''
+@method_decorator(csrf_exempt, name='dispatch')
+class OrderNotifyView(View):
+    '''
+    支付宝异步通知支付结果(notify_url)
+        验证签名和金额后更新订单状态，重复通知不会重复更新
+        处理成功返回success，否则支付宝会重新通知
+    '''
+
+    def post(self, request):
+        data = request.POST.dict()
+        signature = data.pop('sign', None)
+        if not signature:
+            return HttpResponse('failure')
+
+        alipay = get_alipay()
+        if not alipay.verify(data, signature):
+            return HttpResponse('failure')
+
+        if data.get('trade_status') not in ('TRADE_SUCCESS', 'TRADE_FINISHED'):
+            # 其他状态不需要处理
+            return HttpResponse('success')
+
+        order_id = data.get('out_trade_no')
+        try:
+            order = OrderInfo.objects.get(order_id=order_id, pay_method=3)
+        except OrderInfo.DoesNotExist as e:
+            return HttpResponse('failure')
+
+        # 验证支付金额
+        total_pay = order.total_price + order.transit_price
+        if Decimal(data.get('total_amount', '0')) != total_pay:
+            return HttpResponse('failure')
+
+        confirm_payment(get_redis_connection('default'), order_id, data.get('trade_no'))
+        return HttpResponse('success')
 
-        while True:
-            response = alipay.api_alipay_trade_query(order_id)
-            '''
-            response = {
-              "alipay_trade_query_response": {
-                "trade_no": "2017032121001004070200176844",
-                "code": "10000",
-                "invoice_amount": "20.00",
-                "open_id": "20880072506750308812798160715407",
-                "fund_bill_list": [
-                  {
-                    "amount": "20.00",
-                    "fund_channel": "ALIPAYACCOUNT"
-                  }
-                ],
-                "buyer_logon_id": "csq***@sandbox.com",
-                "send_pay_date": "2017-03-21 13:29:17",
-                "receipt_amount": "20.00",
-                "out_trade_no": "out_trade_no15",
-                "buyer_pay_amount": "20.00",
-                "buyer_user_id": "2088102169481075",
-                "msg": "Success",
-                "point_amount": "0.00",
-                "trade_status": "TRADE_SUCCESS",
-                "total_amount": "20.00"
-              }
-            '''
-            code = response.get('code')
-            if code == "10000" and response.get('trade_status') == "TRADE_SUCCESS":
-                # 支付成功
-                trade_no = response.get('trade_no')  # 获取支付宝交易号
-                order.trade_no = trade_no  
-                order.order_status = 4  #待评价
-                order.save()
-                return JsonResponse({'res': 3, 'errmsg': '支付成功'})
-
-            elif code == '40004' or (code == '10000' and response.get('trade_status') == 'WAIT_BUYER_PAY'):
-                # 等待买家付款
-                # 业务处理失败，可能一会就会成功
-                import time
-                time.sleep(5)
-                continue
-                
-            else:
-                # 支付出错
-                print(code)
-                return JsonResponse({'res': 4, 'errmsg': '支付失败'})
-                
 
 '''订单评论'''
 class OrderCommentView(View):
@@ -462,6 +581,7 @@ class OrderCommentView(View):
         total_count = int(total_count)
 
         # 循环获取订单中商品的评论内容
+        commented_skus = []
         for i in range(1, total_count+1):
             # 获取评论的商品id
             sku_id = request.POST.get("sku_%d" % i)
@@ -474,9 +594,20 @@ class OrderCommentView(View):
 
             order_goods.comment = content
             order_goods.save()
+            commented_skus.append(order_goods.sku_id)
 
         order.order_status = 5
         order.save()
+
+        # 清除商品评论第一页和评论总数的缓存，详情页缓存中也有评论
+        invalidate_comments(commented_skus)
+        invalidate_detail_pages(commented_skus)
         return redirect(reverse("user:order",  kwargs={"page": 1}))
 
 
+# 订单提交使用的库存扣减方式，在settings.ORDER_COMMIT_STRATEGY中选择
+ORDER_COMMIT_VIEWS = {
+    'pessimistic': OrderCommitView,
+    'optimistic': OrderCommitView1,
+    'redis': OrderCommitRedisView,
+}
@@ -1,3 +1,64 @@
-from django.test import TestCase
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
 # Create your tests here.
+from apps.goods.models import GoodsType, Goods, GoodsSKU
+from apps.goods.tests import LOCMEM_CACHES
+from apps.order.models import OrderInfo, OrderGoods
+from apps.user.models import User, Address
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UserOrderViewTest(TestCase):
+    """用户中心订单页面查询次数测试"""
+
+    def setUp(self):
+        self.user = User.objects.create_user('buyer', 'buyer@example.com', 'password')
+        self.addr = Address.objects.create(user=self.user, receiver='buyer', addr='addr', phone='13800000000')
+        type = GoodsType.objects.create(name='水果', logo='fruit', image='type.jpg')
+        goods = Goods.objects.create(name='草莓')
+        self.skus = [GoodsSKU.objects.create(type=type, goods=goods, name='商品%d' % i, desc='简介',
+                                             price=10, unite='500g', image='sku.jpg') for i in range(2)]
+        self.num_orders = 0
+        self.client.force_login(self.user)
+
+    def create_orders(self, num):
+        """创建num个订单，每个订单有两种商品"""
+        for i in range(num):
+            self.num_orders += 1
+            order = OrderInfo.objects.create(order_id='%019d' % self.num_orders, user=self.user, addr=self.addr,
+                                             total_count=5, total_price='50.00', transit_price='10.00')
+            for count, sku in enumerate(self.skus, 2):
+                OrderGoods.objects.create(order=order, sku=sku, count=count, price='10.00')
+
+    def get_order_page(self, page, cursor=''):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/user/order/%d' % page, {'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_query_count_is_constant(self):
+        """订单总数缓存后，查询次数和用户的订单数目无关"""
+        self.create_orders(1)
+        self.get_order_page(1)
+        response, num_queries = self.get_order_page(1)
+
+        self.create_orders(30)
+        response, more_queries = self.get_order_page(10)
+        self.assertEqual(more_queries, num_queries)
+
+        # 按照游标翻页
+        response, more_queries = self.get_order_page(11, response.context['order_page'].next_cursor)
+        self.assertEqual(more_queries, num_queries)
+        self.assertEqual(response.context['order_page'][0].order_id, '%019d' % 21)
+
+    def test_subtotals_computed_in_query(self):
+        """当前页订单的商品小计和状态名称"""
+        self.create_orders(3)
+        response, num_queries = self.get_order_page(2)
+        order = response.context['order_page'][0]
+        self.assertEqual(order.order_id, '%019d' % 2)
+        self.assertEqual(order.status_name, '待支付')
+        self.assertEqual(sorted((order_sku.count, order_sku.amount) for order_sku in order.order_skus),
+                         [(2, 20), (3, 30)])
@@ -2,7 +2,7 @@ import re
 from django.shortcuts import render, redirect
 from django.contrib.auth import *
 from django.http import HttpResponse
-from django.core.paginator import Paginator
+from django.db.models import F, Prefetch, DecimalField, ExpressionWrapper
 from django.urls import reverse
 from django.views import View
 from django_redis import get_redis_connection
@@ -11,9 +11,14 @@ from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 from celery_tasks.tasks import send_active_email
 from item01 import settings
 from apps.goods.models import GoodsSKU
+from apps.goods.sku_cache import get_sku_snapshots
 from apps.order.models import OrderInfo, OrderGoods
 from apps.user.models import User, Address
 from utils.Mixin import LoginRequiredMixin
+from utils.pagination import CursorPaginator, get_page_range
+
+# 用户订单的大概数目，只用于显示页码按钮
+ORDER_COUNT_KEY = 'order_count_%d'
 
 
 class RegisterView(View):
@@ -187,12 +192,8 @@ class UserInfoView(LoginRequiredMixin, View):
         # 获取用户最新浏览的5个商品的id
         sku_ids = conn.lrange(history_key, 0, 4)
 
-        # 根据sku_id查询商品的具体信息
-        goods_list = []
-        for sku_id in sku_ids:
-            goods = GoodsSKU.objects.get(id=sku_id)
-            goods_list.append(goods)
-        # goods_li = [GoodsSKU.objects.filter(id=id) for id in sku_ids]
+        # 根据sku_id从商品快照缓存中批量获取商品的具体信息，保持浏览的顺序
+        goods_list = get_sku_snapshots(sku_ids)
 
         # 组织上下文
         context = {
@@ -211,51 +212,22 @@ class UserOrderView(LoginRequiredMixin, View):
 
         user = request.user
 
-        # 数据库获取用户的订单信息
-        orders = OrderInfo.objects.filter(user=user).order_by('-create_time')
-
-        for order in orders:
-            order_skus = OrderGoods.objects.filter(order_id=order.order_id)
+        # 数据库获取用户的订单信息，分页在数据库中进行
+        # 只为当前页的订单预取订单商品，商品小计在查询中计算
+        order_skus = OrderGoods.objects.select_related('sku').annotate(
+            amount=ExpressionWrapper(F('count') * F('price'), output_field=DecimalField(max_digits=10, decimal_places=2)))
+        orders = OrderInfo.objects.filter(user=user).prefetch_related(
+            Prefetch('ordergoods_set', queryset=order_skus, to_attr='order_skus'))
 
-            for order_sku in order_skus:
-                # 计算小计
-                amount = order_sku.count * order_sku.price
-                order_sku.amount = amount
+        # 进行分页，按照游标定位，订单总数是缓存的大概数目
+        paginator = CursorPaginator(orders, 1, ('-create_time', '-order_id'), count_key=ORDER_COUNT_KEY % user.id)
+        order_page = paginator.page(page, request.GET.get('cursor'))
 
-            # 保存单个订单商品的信息
+        for order in order_page:
             order.status_name = OrderInfo.ORDER_STATUS[order.order_status]
-            order.order_skus = order_skus
-
-        # 进行分页
-        paginator = Paginator(orders, 1)
-
-        # 获取第page页的内容
-        try:
-            page = int(page)
-        except Exception as e:
-            page = 1
-
-        if page > paginator.num_pages:
-            page = 1
-
-        # 获取第page页的page对象，废弃因为会加载所有的页码
-        order_page = paginator.page(page)
 
         # 控制限制的页码，只显示最多5个按钮
-        # 如果总页数小于5，显示[1-页码]
-        # 如果当前页是前三页，显示[1,2,3,4,5]
-        # 如果当前页是后三页，显示[4,5,6,7,8] num_pages-4 到num_oages+1
-        # 显示当前页，显示当前页的前两页和后两页 [2,3,4,5,6]
-
-        num_pages = paginator.num_pages
-        if num_pages < 5:
-            pages = range(1, num_pages + 1)
-        elif num_pages <= 3:
-            pages = range(1, 6)
-        elif num_pages - page <= 2:
-            pages = range(num_pages-4, num_pages+1)
-        else:
-            pages = range(page-2, page+3)
+        pages = get_page_range(order_page.number, paginator.num_pages)
 
         context = {
             'order_page': order_page,
@@ -5,6 +5,7 @@ from django.template import loader
 
 import time
 import os
+import tempfile
 import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE','item01.settings')
@@ -13,6 +14,30 @@ django.setup()
 # 创建一个celery对象，并且明明name
 app = Celery("celery_tasks.tasks", broker="redis://127.0.0.1:6379/4")
 
+# 定时任务，需要启动celery beat
+app.conf.beat_schedule = {
+    # 把redis中预扣的库存写回数据库
+    'flush-stock': {
+        'task': 'celery_tasks.tasks.flush_stock',
+        'schedule': 5.0,
+    },
+    # 查询待支付订单的支付结果
+    'check-payments': {
+        'task': 'celery_tasks.tasks.check_payments',
+        'schedule': 5.0,
+    },
+    # 批量更新商品的全文索引
+    'update-search-index': {
+        'task': 'celery_tasks.tasks.update_search_index',
+        'schedule': 5.0,
+    },
+    # 提前计算空搜索词和常用搜索词的分面统计
+    'precompute-search-facets': {
+        'task': 'celery_tasks.tasks.precompute_search_facets',
+        'schedule': 5 * 60.0,
+    },
+}
+
 # 装饰函数使用app
 @app.task
 def send_active_email(email,username,token):
@@ -32,40 +57,80 @@ def send_active_email(email,username,token):
 
 
 # 类的导入卸载celery配置完成的下方
-from apps.goods.models import *
+from django.core.cache import cache
+from django_redis import get_redis_connection
+from apps.goods.loaders import load_index_page_data
+from apps.goods.stock import flush_pending_stock
+from apps.order.payment import get_alipay, check_pending_payments
+from apps.goods.search_queue import apply_search_queue
+from apps.goods.facets import precompute_facets
+
+# 防抖时间(秒)，这段时间内的多次修改只会重新生成一次静态首页
+STATIC_INDEX_DEBOUNCE = 5
+# 已经有生成静态首页的任务在等待执行的标记，任务丢失时标记过期后可以重新发出任务
+STATIC_INDEX_PENDING_KEY = 'static_index_pending'
+STATIC_INDEX_PENDING_TIMEOUT = 60
+
+
+def schedule_static_index_html():
+    """
+    发出重新生成静态首页的任务
+        已经有任务在等待执行时不再发出，批量修改数据只会重新生成一次
+    """
+    if cache.add(STATIC_INDEX_PENDING_KEY, 1, STATIC_INDEX_PENDING_TIMEOUT):
+        generate_static_index_html.apply_async(countdown=STATIC_INDEX_DEBOUNCE)
+
 
 @app.task
 def generate_static_index_html():
     '''产生首页静态化页面'''
 
-    # 获取商品的种类信息
-    types = GoodsType.objects.all()
+    # 先清除等待标记，生成期间的修改会重新发出任务
+    cache.delete(STATIC_INDEX_PENDING_KEY)
 
-    # 获取轮播图信息
-    banners = IndexGoodsBanner.objects.all().order_by('index')
+    # 获取首页展示的数据
+    context = load_index_page_data()
 
-    # 获取促销信息
-    promotion_banner = IndexPromotionBanner.objects.all().order_by('index')
+    # 产生静态页面
+    template = loader.get_template('static_index.html')
+    static_index_html = template.render(context).encode('gbk', 'ignore').decode('gbk')
 
-    # 获取首页分类商品展示信息
-    for type in types:
-        image_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
-        title_banners = IndexTypeGoodsBanner.objects.filter(type=type, display_type=1).order_by('index')
+    save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
 
-        type.image_banners = image_banners
-        type.title_banners = title_banners
+    # 先写入同一目录下的临时文件，再重命名覆盖，nginx不会读到写了一半的页面
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(save_path), prefix='.index.', suffix='.html')
+    try:
+        with os.fdopen(fd, 'w', encoding='gbk') as f:
+            f.write(static_index_html)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp创建的文件只有所有者可读
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, save_path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
 
-        context = {
-            'types': types,
-            'goods_banners': banners,
-            'promotion_banners': promotion_banner,
-        }
 
-        # 产生静态页面
-        template = loader.get_template('static_index.html')
-        static_index_html = template.render(context).encode('gbk', 'ignore').decode('gbk')
+@app.task
+def flush_stock():
+    '''把redis中预扣的库存批量写回数据库的库存和销量'''
+    flush_pending_stock(get_redis_connection('default'))
 
-        save_path = os.path.join(settings.BASE_DIR, 'static/index.html')
 
-        with open(save_path, 'w') as f:
-            f.write(static_index_html)
+@app.task
+def check_payments():
+    '''查询到期的待支付订单的支付结果，收不到支付宝异步通知时确认支付'''
+    check_pending_payments(get_redis_connection('default'), get_alipay())
+
+
+@app.task
+def update_search_index():
+    '''把队列中修改过的商品批量写入全文索引'''
+    apply_search_queue(get_redis_connection('default'))
+
+
+@app.task
+def precompute_search_facets():
+    '''提前计算搜索结果页常用的分面统计'''
+    precompute_facets(get_redis_connection('default'))
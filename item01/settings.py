@@ -49,6 +49,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # 放在最外层，session的读取和保存也计入响应头X-Redis-Round-Trips
+    'utils.redis_session.RedisSessionMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -105,12 +107,19 @@ CACHES = {
         "LOCATION":"redis://127.0.0.1:6379/5",
         "OPTIONS":{
             "CLIENT_CLASS":"django_redis.client.DefaultClient",
+            # 统计每个请求的redis请求次数，见utils.redis_counter
+            "CONNECTION_POOL_CLASS":"utils.redis_counter.CountingConnectionPool",
         }
     }
 }
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
 
+# 商品快照缓存设置，一级缓存是每个进程内的LRU缓存，二级缓存是redis
+SKU_CACHE_L1_SIZE = 1000  # 一级缓存最多保存的商品数目
+SKU_CACHE_L1_TIMEOUT = 60  # 一级缓存过期时间(秒)
+SKU_CACHE_L2_TIMEOUT = 60 * 60  # 二级缓存过期时间(秒)
+
 # session 设置(可以不写)
 SESSION_COOKIE_AGE = 60 * 60 * 12 # 12小时
 SESSION_SAVE_EVERY_REQUEST = True
@@ -151,6 +160,32 @@ USE_TZ = True
 
 LOGIN_URL = '/user/login/'
 
+# 订单提交扣减库存的方式
+# redis: 在redis库存镜像中预扣库存，celery beat定时执行flush_stock写回数据库
+# pessimistic: 数据库悲观锁，redis不可用或者需要回退时使用
+# optimistic: 数据库乐观锁，条件更新库存，死锁或锁等待超时时重试
+ORDER_COMMIT_STRATEGY = 'redis'
+# 乐观锁最多重试的次数，第i次重试前随机等待0到ORDER_COMMIT_RETRY_DELAY * 2^i秒
+ORDER_COMMIT_MAX_RETRIES = 3
+ORDER_COMMIT_RETRY_DELAY = 0.05
+
+# 订单id生成器的机器id(0-1023)，为None时每个进程从redis中自动分配
+SNOWFLAKE_WORKER_ID = None
+
+# 支付宝支付设置
+ALIPAY_APPID = "2016101400683195"
+ALIPAY_DEBUG = True  # 沙箱环境
+ALIPAY_GATEWAY = 'https://openapi.alipaydev.com/gateway.do'
+ALIPAY_PRIVATE_KEY_PATH = os.path.join(BASE_DIR, 'apps/order/app_private_key.pem')
+ALIPAY_PUBLIC_KEY_PATH = os.path.join(BASE_DIR, 'apps/order/alipay_public_key.pem')
+# 每隔多少秒检查一次密钥文件是否被修改，修改后重新加载
+ALIPAY_KEY_CHECK_INTERVAL = 5
+ALIPAY_RETURN_URL = "https://example.com"
+# 支付宝异步通知支付结果的地址，需要外网可以访问
+ALIPAY_NOTIFY_URL = "https://example.com/order/notify/"
+# 订单检查请求等待支付结果的最长时间(秒)，等待期间占用一个web进程，不能太长
+ORDER_CHECK_TIMEOUT = 1
+
 # Static files (CSS, JavaScript, Images)
 # https://docs.djangoproject.com/en/2.1/howto/static-files/
 
@@ -248,10 +283,14 @@ HAYSTACK_CONNECTIONS = {
         'ENGINE': 'haystack.backends.whoosh_cn_backend.WhooshEngine',
         # 索引文件路径
         'PATH': os.path.join(BASE_DIR, 'whoosh_index'),
+        # 也可以使用纯python的二元分词索引，建立索引和查询都更快，但不支持more_like_this，
+        # rebuild_search_index全量重建时不能多进程合并，清空后依次写入，见bench_search_backend
+        # 'ENGINE': 'utils.ngram_backend.NgramEngine',
+        # 'PATH': os.path.join(BASE_DIR, 'ngram_index'),
     }
 }
 
-# 当数据库表 添加、修改、删除数据时，自动生成索引
-HAYSTACK_SIGNAL_PROCESSOR = 'haystack.signals.RealtimeSignalProcessor'
+# 当商品添加、修改、删除时，把商品放入redis队列，由celery定时任务update_search_index批量更新索引
+HAYSTACK_SIGNAL_PROCESSOR = 'apps.goods.search_queue.QueuedSignalProcessor'
 
 APPEND_SLASH=False
\ No newline at end of file
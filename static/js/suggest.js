@@ -0,0 +1,58 @@
+// 搜索框输入提示，输入停止一段时间后请求/search/suggest，不依赖jquery
+(function () {
+    var input = document.querySelector('.search_con .input_text');
+    if (!input) {
+        return;
+    }
+    var list = document.createElement('ul');
+    list.className = 'search_suggest';
+    input.parentNode.appendChild(list);
+    input.setAttribute('autocomplete', 'off');
+
+    var timer = null;
+    var last = '';
+
+    function render(suggestions) {
+        list.innerHTML = '';
+        for (var i = 0; i < suggestions.length; i++) {
+            var item = document.createElement('li');
+            item.textContent = suggestions[i].name;
+            item.onmousedown = function () {
+                input.value = this.textContent;
+                input.form.submit();
+            };
+            list.appendChild(item);
+        }
+        list.style.display = suggestions.length ? 'block' : 'none';
+    }
+
+    function load() {
+        var q = input.value.replace(/^\s+|\s+$/g, '');
+        if (q === last) {
+            return;
+        }
+        last = q;
+        if (!q) {
+            render([]);
+            return;
+        }
+        var xhr = new XMLHttpRequest();
+        xhr.open('GET', '/search/suggest?q=' + encodeURIComponent(q));
+        xhr.onload = function () {
+            var data = JSON.parse(xhr.responseText);
+            // 只显示最后一次输入的结果
+            if (data.res === 1 && q === last) {
+                render(data.suggestions);
+            }
+        };
+        xhr.send();
+    }
+
+    input.oninput = function () {
+        clearTimeout(timer);
+        timer = setTimeout(load, 150);
+    };
+    input.onblur = function () {
+        list.style.display = 'none';
+    };
+})();
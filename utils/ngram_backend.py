@@ -0,0 +1,463 @@
+import os
+import re
+import math
+import mmap
+import time
+import fcntl
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter
+from django.utils.html import strip_tags
+from haystack import connections
+from haystack.backends import BaseEngine, BaseSearchBackend, BaseSearchQuery, log_query
+from haystack.models import SearchResult
+from haystack.utils import get_identifier
+
+'''
+纯python的二元分词倒排索引，可以替代whoosh作为haystack的后端
+    settings.HAYSTACK_CONNECTIONS中ENGINE为'utils.ngram_backend.NgramEngine'，PATH为索引目录
+    汉字按照单字和相邻两个字(二元)切分，英文和数字按照单词切分，不需要jieba词典
+    倒排表是array中的文档编号和词频，打分使用BM25，查询的所有词都出现的文档才算匹配
+    索引保存为一个快照文件，每个进程用mmap只读打开，多个进程共享操作系统的页缓存，快照替换后重新打开
+    写入时用文件锁保证只有一个进程在写，写完的快照先写入临时文件再替换，读取的进程不会看到写了一半的文件
+    删除的文档只在快照中标记，不重新编号，删除的比例超过NGRAM_COMPACT_RATIO时重写全部倒排表
+'''
+
+NGRAM_SNAPSHOT_NAME = 'ngram.idx'
+NGRAM_LOCK_NAME = 'ngram.lock'
+NGRAM_MAGIC = b'DFNGRAM1'
+# 读取的进程最多每隔这么多秒检查一次快照是否被替换
+NGRAM_RELOAD_INTERVAL = 1
+# 删除的文档超过这个比例时压缩快照
+NGRAM_COMPACT_RATIO = 0.2
+# BM25的参数
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# 文件头：魔数，词数，文档数(包括删除的)，有效文档数，倒排表总长度，有效文档的总长度，8个段的偏移
+HEADER = struct.Struct('<8sIIIQQ8Q')
+# 各段依次为：词的偏移(I)、词(utf-8)、倒排表的偏移(I)、文档编号(I)、词频(H)、文档长度(I)、文档id的偏移(I)、文档id
+SECTION_NAMES = ('term_offsets', 'terms', 'post_offsets', 'post_docs', 'post_tfs', 'doc_lens', 'id_offsets', 'ids')
+
+TOKEN_RE = re.compile('[\u4e00-\u9fff]+|[a-z0-9]+')
+# haystack生成的查询中NOT后面是一个词或者括号内的分组，如exclude生成的NOT (a AND b)
+NOT_RE = re.compile(r'\bNOT\s+(\(?)')
+OPERATOR_RE = re.compile(r'\b(?:AND|OR)\b')
+WORD_RE = re.compile(r'\S*')
+
+
+def is_cjk(run):
+    return run[0] >= '\u4e00'
+
+
+def tokenize(text):
+    """文档的分词，汉字的单字和二元，英文和数字的单词"""
+    tokens = []
+    for run in TOKEN_RE.findall(text.lower()):
+        if is_cjk(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def strip_operators(text):
+    """去掉查询中的AND、OR，以及NOT后面的词或者整个括号分组(可以嵌套)"""
+    kept = []
+    pos = 0
+    while True:
+        match = NOT_RE.search(text, pos)
+        if match is None:
+            break
+        kept.append(text[pos:match.start()])
+        if match.group(1):
+            depth = 0
+            for pos in range(match.start(1), len(text)):
+                depth += {'(': 1, ')': -1}.get(text[pos], 0)
+                if depth == 0:
+                    break
+            pos += 1
+        else:
+            pos = WORD_RE.match(text, match.end()).end()
+    kept.append(text[pos:])
+    return OPERATOR_RE.sub(' ', ' '.join(kept))
+
+
+def query_terms(text):
+    """查询的分词，汉字只用二元(单个汉字用单字)，去掉重复"""
+    terms = []
+    for run in TOKEN_RE.findall(strip_operators(text).lower()):
+        if is_cjk(run) and len(run) > 1:
+            terms.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            terms.append(run)
+    return list(dict.fromkeys(terms))
+
+
+def to_array(typecode, view):
+    """把快照中的一段复制成可修改的array"""
+    values = array(typecode)
+    values.frombytes(view.cast('B'))
+    return values
+
+
+class Snapshot(object):
+    """mmap只读打开的快照，所有数组都是直接指向文件内容的memoryview"""
+
+    def __init__(self, path):
+        stat = os.stat(path)
+        self.stamp = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with open(path, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.mmap)
+        magic, self.num_terms, self.num_docs, self.live_docs, num_postings, self.total_length, *offsets = \
+            HEADER.unpack_from(self.mmap)
+        if magic != NGRAM_MAGIC:
+            raise ValueError('%s不是二元分词索引的快照' % path)
+        ends = offsets[1:] + [len(self.mmap)]
+        sections = {name: view[start:end] for name, start, end in zip(SECTION_NAMES, offsets, ends)}
+        self.term_offsets = sections['term_offsets'].cast('I')[:self.num_terms + 1]
+        self.terms = sections['terms']
+        self.post_offsets = sections['post_offsets'].cast('I')[:self.num_terms + 1]
+        self.post_docs = sections['post_docs'].cast('I')[:num_postings]
+        self.post_tfs = sections['post_tfs'].cast('H')[:num_postings]
+        self.doc_lens = sections['doc_lens'].cast('I')[:self.num_docs]
+        self.id_offsets = sections['id_offsets'].cast('I')[:self.num_docs + 1]
+        self.ids = sections['ids']
+
+    def term(self, i):
+        return bytes(self.terms[self.term_offsets[i]:self.term_offsets[i + 1]])
+
+    def find_term(self, term):
+        """二分查找词的编号，不存在时返回-1"""
+        key = term.encode()
+        lo, hi = 0, self.num_terms
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.num_terms and self.term(lo) == key:
+            return lo
+        return -1
+
+    def postings(self, term):
+        """词的(文档编号, 词频)两个数组，按照文档编号排序"""
+        i = self.find_term(term)
+        if i < 0:
+            return None
+        start, end = self.post_offsets[i], self.post_offsets[i + 1]
+        return self.post_docs[start:end], self.post_tfs[start:end]
+
+    def doc_id(self, docnum):
+        """文档id，比如goods.goodssku.1，删除的文档为空字符串"""
+        return bytes(self.ids[self.id_offsets[docnum]:self.id_offsets[docnum + 1]]).decode()
+
+    def all_terms(self):
+        for i in range(self.num_terms):
+            yield self.term(i).decode(), i
+
+
+class MemoryIndex(object):
+    """写入时使用的可修改的索引，写入后保存为快照"""
+
+    def __init__(self):
+        self.ids = []
+        self.lens = array('I')
+        self.id_map = {}
+        self.postings = {}
+        self.deleted = 0
+        self.total_length = 0
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        index = cls()
+        for docnum in range(snapshot.num_docs):
+            doc_id = snapshot.doc_id(docnum)
+            index.ids.append(doc_id)
+            if doc_id:
+                index.id_map[doc_id] = docnum
+        index.lens = to_array('I', snapshot.doc_lens)
+        index.deleted = snapshot.num_docs - snapshot.live_docs
+        index.total_length = snapshot.total_length
+        for term, i in snapshot.all_terms():
+            start, end = snapshot.post_offsets[i], snapshot.post_offsets[i + 1]
+            docs = to_array('I', snapshot.post_docs[start:end])
+            index.postings[term] = (docs, to_array('H', snapshot.post_tfs[start:end]))
+        return index
+
+    def add(self, doc_id, tokens):
+        self.remove(doc_id)
+        docnum = len(self.ids)
+        self.ids.append(doc_id)
+        self.lens.append(len(tokens))
+        self.id_map[doc_id] = docnum
+        self.total_length += len(tokens)
+        for term, tf in Counter(tokens).items():
+            posting = self.postings.get(term)
+            if posting is None:
+                posting = self.postings[term] = (array('I'), array('H'))
+            posting[0].append(docnum)
+            posting[1].append(min(tf, 0xffff))
+
+    def clear(self):
+        self.__init__()
+
+    def remove(self, doc_id):
+        docnum = self.id_map.pop(doc_id, None)
+        if docnum is not None:
+            self.ids[docnum] = ''
+            self.total_length -= self.lens[docnum]
+            self.deleted += 1
+
+    def compact(self):
+        """去掉删除的文档，重新编号"""
+        remap = {}
+        ids = []
+        lens = array('I')
+        for docnum, doc_id in enumerate(self.ids):
+            if doc_id:
+                remap[docnum] = len(ids)
+                ids.append(doc_id)
+                lens.append(self.lens[docnum])
+        postings = {}
+        for term, (docs, tfs) in self.postings.items():
+            new_docs, new_tfs = array('I'), array('H')
+            for docnum, tf in zip(docs, tfs):
+                new = remap.get(docnum)
+                if new is not None:
+                    new_docs.append(new)
+                    new_tfs.append(tf)
+            if new_docs:
+                postings[term] = (new_docs, new_tfs)
+        self.ids = ids
+        self.lens = lens
+        self.id_map = {doc_id: docnum for docnum, doc_id in enumerate(ids)}
+        self.postings = postings
+        self.deleted = 0
+
+    def write(self, path):
+        """保存为快照，先写入临时文件再替换"""
+        if self.ids and self.deleted > len(self.ids) * NGRAM_COMPACT_RATIO:
+            self.compact()
+
+        terms = sorted(self.postings, key=str.encode)
+        term_offsets, term_blob = array('I', [0]), bytearray()
+        post_offsets, post_docs, post_tfs = array('I', [0]), array('I'), array('H')
+        for term in terms:
+            term_blob += term.encode()
+            term_offsets.append(len(term_blob))
+            docs, tfs = self.postings[term]
+            post_docs.extend(docs)
+            post_tfs.extend(tfs)
+            post_offsets.append(len(post_docs))
+        id_offsets, id_blob = array('I', [0]), bytearray()
+        for doc_id in self.ids:
+            id_blob += doc_id.encode()
+            id_offsets.append(len(id_blob))
+
+        sections = [term_offsets.tobytes(), bytes(term_blob), post_offsets.tobytes(), post_docs.tobytes(),
+                    post_tfs.tobytes(), self.lens.tobytes(), id_offsets.tobytes(), bytes(id_blob)]
+        offsets = []
+        position = HEADER.size
+        for section in sections:
+            # 每一段按照8字节对齐
+            position += -position % 8
+            offsets.append(position)
+            position += len(section)
+
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(HEADER.pack(NGRAM_MAGIC, len(terms), len(self.ids), len(self.id_map), len(post_docs),
+                                self.total_length, *offsets))
+            for offset, section in zip(offsets, sections):
+                f.write(b'\0' * (offset - f.tell()))
+                f.write(section)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+
+class NgramSearchBackend(BaseSearchBackend):
+    """
+    二元分词倒排索引的haystack后端
+        同一个进程中的后端对象共享打开的快照和写入用的索引
+    """
+    _readers = {}
+    _writers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, connection_alias, **connection_options):
+        super(NgramSearchBackend, self).__init__(connection_alias, **connection_options)
+        self.path = connection_options['PATH']
+        self.snapshot_path = os.path.join(self.path, NGRAM_SNAPSHOT_NAME)
+        self.lock_path = os.path.join(self.path, NGRAM_LOCK_NAME)
+
+    def stamp(self):
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def get_snapshot(self):
+        """本进程打开的快照，最多每隔NGRAM_RELOAD_INTERVAL秒检查一次文件是否被替换"""
+        now = time.time()
+        reader = self._readers.get(self.path)
+        if reader is not None and now - reader[1] < NGRAM_RELOAD_INTERVAL:
+            return reader[0]
+        with self._lock:
+            snapshot = reader[0] if reader else None
+            stamp = self.stamp()
+            if stamp is None:
+                snapshot = None
+            elif snapshot is None or snapshot.stamp != stamp:
+                snapshot = Snapshot(self.snapshot_path)
+            self._readers[self.path] = (snapshot, now)
+            return snapshot
+
+    def write(self, func):
+        """在文件锁内修改索引并保存快照，快照被其他进程替换过时重新读取"""
+        os.makedirs(self.path, exist_ok=True)
+        with self._lock, open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                writer = self._writers.get(self.path)
+                stamp = self.stamp()
+                if writer is None or writer[0] != stamp:
+                    index = MemoryIndex.from_snapshot(Snapshot(self.snapshot_path)) if stamp else MemoryIndex()
+                else:
+                    index = writer[1]
+                func(index)
+                index.write(self.snapshot_path)
+                self._writers[self.path] = (self.stamp(), index)
+                self._readers.pop(self.path, None)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def update(self, index, iterable, commit=True):
+        content_field = connections[self.connection_alias].get_unified_index().document_field
+        documents = []
+        for obj in iterable:
+            doc = index.full_prepare(obj)
+            documents.append((doc['id'], tokenize(strip_tags(doc.get(content_field) or ''))))
+        if not documents:
+            return
+
+        def add(memory_index):
+            for doc_id, tokens in documents:
+                memory_index.add(doc_id, tokens)
+        self.write(add)
+
+    def remove(self, obj_or_string, commit=True):
+        self.remove_many([obj_or_string])
+
+    def remove_many(self, objs_or_strings):
+        """删除多个文档，只保存一次快照"""
+        doc_ids = [get_identifier(obj_or_string) for obj_or_string in objs_or_strings]
+        if not doc_ids:
+            return
+
+        def remove(memory_index):
+            for doc_id in doc_ids:
+                memory_index.remove(doc_id)
+        self.write(remove)
+
+    def clear(self, models=None, commit=True):
+        if not models:
+            self.write(MemoryIndex.clear)
+            return
+        prefixes = tuple('%s.%s.' % (model._meta.app_label, model._meta.model_name) for model in models)
+
+        def clear_models(memory_index):
+            for doc_id in [doc_id for doc_id in memory_index.id_map if doc_id.startswith(prefixes)]:
+                memory_index.remove(doc_id)
+        self.write(clear_models)
+
+    def score(self, snapshot, terms):
+        """所有词都出现的文档的BM25得分，返回{文档编号: 得分}"""
+        postings = []
+        for term in terms:
+            posting = snapshot.postings(term)
+            if posting is None:
+                return {}
+            postings.append(posting)
+        # 从最短的倒排表开始，其他倒排表中二分查找
+        postings.sort(key=lambda posting: len(posting[0]))
+
+        live_docs = max(snapshot.live_docs, 1)
+        avg_length = snapshot.total_length / live_docs or 1
+        doc_lens = snapshot.doc_lens
+        scores = None
+        for docs, tfs in postings:
+            idf = math.log(1 + (live_docs - len(docs) + 0.5) / (len(docs) + 0.5))
+            matched = {}
+            if scores is None:
+                candidates = zip(docs, tfs)
+            else:
+                candidates = []
+                for docnum in scores:
+                    pos = bisect_left(docs, docnum)
+                    if pos < len(docs) and docs[pos] == docnum:
+                        candidates.append((docnum, tfs[pos]))
+            for docnum, tf in candidates:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lens[docnum] / avg_length)
+                matched[docnum] = (scores[docnum] if scores else 0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+            scores = matched
+            if not scores:
+                break
+        return scores or {}
+
+    @log_query
+    def search(self, query_string, start_offset=0, end_offset=None, models=None, result_class=None, **kwargs):
+        result_class = result_class or SearchResult
+        snapshot = self.get_snapshot()
+        if snapshot is None:
+            return {'results': [], 'hits': 0}
+
+        if query_string.strip() in ('*', '*:*'):
+            ranked = [(docnum, 0) for docnum in range(snapshot.num_docs)]
+        else:
+            terms = query_terms(query_string)
+            if not terms:
+                return {'results': [], 'hits': 0}
+            ranked = sorted(self.score(snapshot, terms).items(), key=lambda item: (-item[1], item[0]))
+
+        prefixes = None
+        if models:
+            prefixes = tuple('%s.%s.' % (model._meta.app_label, model._meta.model_name) for model in models)
+        hits = []
+        for docnum, score in ranked:
+            doc_id = snapshot.doc_id(docnum)
+            if doc_id and (prefixes is None or doc_id.startswith(prefixes)):
+                hits.append((doc_id, score))
+
+        results = []
+        for doc_id, score in hits[start_offset:end_offset]:
+            app_label, model_name, pk = doc_id.split('.', 2)
+            results.append(result_class(app_label, model_name, pk, score))
+        return {'results': results, 'hits': len(hits), 'facets': {}, 'spelling_suggestion': None}
+
+    def more_like_this(self, model_instance, additional_query_string=None, result_class=None, **kwargs):
+        raise NotImplementedError('二元分词索引不支持more_like_this')
+
+
+class NgramSearchQuery(BaseSearchQuery):
+    """只支持全文检索的查询，字段和过滤方式都忽略，查询词交给NgramSearchBackend分词"""
+
+    def matching_all_fragment(self):
+        return '*:*'
+
+    def build_query_fragment(self, field, filter_type, value):
+        if hasattr(value, 'prepare'):
+            value = value.prepare(self)
+        return str(value)
+
+
+class NgramEngine(BaseEngine):
+    backend = NgramSearchBackend
+    query = NgramSearchQuery
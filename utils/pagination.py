@@ -0,0 +1,185 @@
+import math
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.utils.functional import cached_property
+
+'''
+基于游标(keyset)的分页
+    按照排序字段的值定位下一页，WHERE (price, id) > (上一页最后一条的值) LIMIT n+1，
+    不使用OFFSET，也不需要每次COUNT(*)，页数越大也不会变慢
+    游标保存页码、定位的字段值和方向，签名后作为不透明的字符串放在链接中
+    没有游标时(比如直接输入的页码)使用OFFSET分页，和原来的页码链接兼容
+'''
+
+CURSOR_SALT = 'utils.pagination'
+# 总数缓存的时间，页码按钮只需要大概的页数
+COUNT_TIMEOUT = 60
+
+
+def get_page_range(number, num_pages, size=5):
+    """
+    控制限制的页码，最多显示size个按钮
+        总页数小于size时显示全部页码，否则显示当前页和前后各两页，靠近两端时显示两端的size页
+    """
+    if num_pages <= size:
+        return range(1, num_pages + 1)
+    start = min(max(number - size // 2, 1), num_pages - size + 1)
+    return range(start, start + size)
+
+
+class CursorPage(object):
+    """游标分页的一页，和django的Page一样可以在模板中使用"""
+
+    def __init__(self, object_list, number, has_next, has_previous, paginator):
+        self.object_list = object_list
+        self.number = number
+        self._has_next = has_next
+        self._has_previous = has_previous
+        self.paginator = paginator
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    @cached_property
+    def next_cursor(self):
+        """定位后面各页的游标，页码大于当前页的链接都可以使用"""
+        if not self.object_list:
+            return ''
+        return self.paginator.encode_cursor(self.number + 1, self.object_list[-1], True)
+
+    @cached_property
+    def previous_cursor(self):
+        """定位前面各页的游标，页码小于当前页的链接都可以使用"""
+        if not self.object_list:
+            return ''
+        return self.paginator.encode_cursor(self.number - 1, self.object_list[0], False)
+
+
+class CursorPaginator(object):
+    """
+    游标分页
+        ordering为排序字段，最后一个字段必须是唯一的(比如id)，保证排序稳定
+        count_key为缓存总数使用的key，为None时不显示总页数
+    """
+
+    def __init__(self, queryset, per_page, ordering, count_key=None, count_timeout=COUNT_TIMEOUT):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.ordering = list(ordering)
+        self.fields = [(field.lstrip('-'), field.startswith('-')) for field in self.ordering]
+        self.count_key = count_key
+        self.count_timeout = count_timeout
+        self.num_pages = 1
+
+    @property
+    def count(self):
+        """大概的总数，缓存count_timeout秒"""
+        if self.count_key is None:
+            return 0
+        count = cache.get(self.count_key)
+        if count is None:
+            count = self.queryset.count()
+            cache.set(self.count_key, count, self.count_timeout)
+        return count
+
+    def encode_cursor(self, number, obj, forward):
+        """
+        生成游标
+            forward为True时表示第number页从obj之后开始，否则表示第number页在obj之前结束
+        """
+        values = [str(getattr(obj, name)) for name, desc in self.fields]
+        return signing.dumps([number, values, forward], salt=CURSOR_SALT)
+
+    def decode_cursor(self, cursor):
+        """解析游标，返回(页码, 字段值, 方向)，游标无效时返回None"""
+        try:
+            number, values, forward = signing.loads(cursor, salt=CURSOR_SALT)
+            opts = self.queryset.model._meta
+            values = [opts.get_field(name).to_python(value) for (name, desc), value in zip(self.fields, values)]
+        except (signing.BadSignature, ValidationError, TypeError, ValueError):
+            return None
+        if len(values) != len(self.fields):
+            return None
+        return number, values, forward
+
+    def seek(self, values, forward):
+        """排序在values之后(forward为True)或之前的记录"""
+        condition = None
+        equal = {}
+        for (name, desc), value in zip(self.fields, values):
+            lookup = 'gt' if desc != forward else 'lt'
+            q = Q(**equal) & Q(**{'%s__%s' % (name, lookup): value})
+            condition = q if condition is None else condition | q
+            equal[name] = value
+        if forward:
+            return self.queryset.filter(condition).order_by(*self.ordering)
+        reverse = [name if desc else '-' + name for name, desc in self.fields]
+        return self.queryset.filter(condition).order_by(*reverse)
+
+    def page(self, number, cursor=None):
+        """
+        获取第number页
+            cursor是其他页的next_cursor或previous_cursor，从游标的位置向后或向前跳过相差的页数
+            没有游标、游标无效或者和页码的方向不一致时使用OFFSET分页
+        """
+        try:
+            number = max(int(number), 1)
+        except (TypeError, ValueError):
+            number = 1
+
+        state = self.decode_cursor(cursor) if cursor else None
+        if state is not None:
+            cursor_number, values, forward = state
+            skip = (number - cursor_number if forward else cursor_number - number) * self.per_page
+            if skip >= 0:
+                objects = list(self.seek(values, forward)[skip:skip + self.per_page + 1])
+                more = len(objects) > self.per_page
+                objects = objects[:self.per_page]
+                if forward and objects:
+                    return self.make_page(objects, number, more, number > 1)
+                if not forward and objects:
+                    objects.reverse()
+                    # 前面没有数据了，这一页就是第一页
+                    return self.make_page(objects, number if more else 1, True, more)
+
+        return self.offset_page(number)
+
+    def offset_page(self, number):
+        """使用OFFSET获取第number页，超出范围时返回第一页"""
+        offset = (number - 1) * self.per_page
+        objects = list(self.queryset.order_by(*self.ordering)[offset:offset + self.per_page + 1])
+        if not objects and number > 1:
+            return self.offset_page(1)
+        more = len(objects) > self.per_page
+        return self.make_page(objects[:self.per_page], number, more, number > 1)
+
+    def make_page(self, objects, number, has_next, has_previous):
+        page = CursorPage(objects, number, has_next, has_previous, self)
+        # 缓存的总数只是大概的，根据这一页的情况修正
+        num_pages = max(math.ceil(self.count / self.per_page), 1)
+        if has_next:
+            num_pages = max(num_pages, number + 1)
+        else:
+            num_pages = number
+        self.num_pages = num_pages
+        return page
@@ -0,0 +1,40 @@
+import threading
+from redis.connection import Connection, ConnectionPool
+
+'''
+统计每个线程向redis发出的请求次数
+    settings.CACHES中CONNECTION_POOL_CLASS为'utils.redis_counter.CountingConnectionPool'时，
+    django缓存、缓存session和get_redis_connection的所有命令都经过这个连接池
+    一条命令或者一个管道发送一次算一次请求
+'''
+
+_local = threading.local()
+
+
+def get_round_trips():
+    """当前线程从上次reset_round_trips以来的redis请求次数"""
+    return getattr(_local, 'round_trips', 0)
+
+
+def reset_round_trips():
+    _local.round_trips = 0
+
+
+class CountingConnectionMixin(object):
+
+    def send_packed_command(self, command, check_health=True):
+        _local.round_trips = getattr(_local, 'round_trips', 0) + 1
+        return super(CountingConnectionMixin, self).send_packed_command(command, check_health)
+
+
+class CountingConnectionPool(ConnectionPool):
+    """连接池使用的连接类(普通、unix socket、ssl连接)替换成统计请求次数的子类"""
+    _counting_classes = {}
+
+    def __init__(self, connection_class=Connection, **connection_kwargs):
+        counting_class = self._counting_classes.get(connection_class)
+        if counting_class is None:
+            counting_class = type('Counting' + connection_class.__name__,
+                                  (CountingConnectionMixin, connection_class), {})
+            self._counting_classes[connection_class] = counting_class
+        super(CountingConnectionPool, self).__init__(connection_class=counting_class, **connection_kwargs)
@@ -0,0 +1,106 @@
+import logging
+from django_redis import get_redis_connection
+from apps.cart.utils import get_cart_key
+from utils.redis_counter import get_round_trips, reset_round_trips
+
+logger = logging.getLogger(__name__)
+
+# 用户最近浏览的商品在redis中保存的条数
+HISTORY_SIZE = 5
+
+
+def get_history_key(user_id):
+    """用户浏览历史在redis中的key"""
+    return 'history_%d' % user_id
+
+
+class RedisResult(object):
+    """排队中的redis命令的结果，会话flush之后才有值，提前访问value会自动flush"""
+
+    def __init__(self, session=None, value=None):
+        self.session = session
+        self.done = session is None
+        self._value = value
+
+    def set(self, value):
+        self._value = value
+        self.done = True
+
+    @property
+    def value(self):
+        if not self.done:
+            self.session.flush()
+        return self._value
+
+
+class RedisSession(object):
+    """
+    单次请求使用的redis会话
+        命令先放入队列，flush时放在一个MULTI/EXEC管道中一次发出，只需要一次redis请求
+    """
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+        self._conn = None
+        self.commands = []
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = get_redis_connection(self.alias)
+        return self._conn
+
+    def queue(self, name, *args):
+        """命令放入队列，返回RedisResult"""
+        result = RedisResult(self)
+        self.commands.append((name, args, result))
+        return result
+
+    def execute(self, name, *args):
+        """不排队，直接执行命令"""
+        return getattr(self.conn, name)(*args)
+
+    def flush(self):
+        """把队列中的命令放在一个事务管道中发出"""
+        if not self.commands:
+            return
+        commands, self.commands = self.commands, []
+        pipe = self.conn.pipeline(transaction=True)
+        for name, args, result in commands:
+            getattr(pipe, name)(*args)
+        for (name, args, result), value in zip(commands, pipe.execute()):
+            result.set(value)
+
+    def cart_count(self, user):
+        """获取用户购物车中商品的条目数，未登录的用户为0"""
+        if not user.is_authenticated:
+            return RedisResult(value=0)
+        return self.queue('hlen', get_cart_key(user.id))
+
+    def add_history(self, user, sku_id):
+        """向用户浏览历史中添加商品，已经存在的先移除，只保存最新浏览的HISTORY_SIZE条"""
+        history_key = get_history_key(user.id)
+        self.queue('lrem', history_key, 0, sku_id)
+        self.queue('lpush', history_key, sku_id)
+        self.queue('ltrim', history_key, 0, HISTORY_SIZE - 1)
+
+
+class RedisSessionMiddleware(object):
+    """
+    给每个请求添加request.redis会话
+        响应返回前发出还在队列中的命令，并在响应头X-Redis-Round-Trips中记录本次请求的redis请求次数，
+        次数在连接池中统计(utils.redis_counter)，包括session、django缓存和其他直接使用redis连接的请求
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        reset_round_trips()
+        request.redis = RedisSession()
+        response = self.get_response(request)
+        request.redis.flush()
+        round_trips = get_round_trips()
+        response['X-Redis-Round-Trips'] = round_trips
+        logger.debug('%s redis round trips: %d', request.path, round_trips)
+        return response
@@ -0,0 +1,154 @@
+import os
+import time
+import socket
+import threading
+from django.conf import settings
+from django_redis import get_redis_connection
+
+'''
+snowflake风格的id生成器，64位id = 41位毫秒时间戳 + 10位机器id + 12位序列号
+    同一个机器id每毫秒最多生成4096个id，不需要访问数据库
+    生成的id单调递增，作为订单表的主键插入时总是追加在索引的末尾
+'''
+
+# 时间戳的起始时间 2019-01-01 00:00:00 UTC，毫秒
+EPOCH = 1546300800000
+
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = (1 << WORKER_ID_BITS) - 1
+MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+WORKER_ID_SHIFT = SEQUENCE_BITS
+TIMESTAMP_SHIFT = SEQUENCE_BITS + WORKER_ID_BITS
+
+# 自动分配机器id时，在redis中占用机器id的key，过期前需要续期
+WORKER_LEASE_KEY = 'snowflake_worker_%d'
+WORKER_COUNTER_KEY = 'snowflake_worker_counter'
+WORKER_LEASE_TIMEOUT = 60 * 60
+WORKER_LEASE_RENEW = 60 * 10
+
+# 续期机器id的租约，只有租约仍然属于当前进程时才续期，返回1，否则返回0
+# KEYS[1] 租约，ARGV[1] 当前进程 ARGV[2] 过期时间
+WORKER_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+class SnowflakeGenerator(object):
+    """指定机器id的id生成器，线程安全"""
+
+    def __init__(self, worker_id):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError('worker_id必须在0到%d之间' % MAX_WORKER_ID)
+        self.worker_id = worker_id
+        self.last_timestamp = -1
+        self.sequence = 0
+        self.lock = threading.Lock()
+
+    def next_id(self):
+        with self.lock:
+            timestamp = int(time.time() * 1000) - EPOCH
+            if timestamp <= self.last_timestamp:
+                # 同一毫秒内或者时钟回拨，继续使用上一次的时间戳，保证id递增
+                timestamp = self.last_timestamp
+                self.sequence = (self.sequence + 1) & MAX_SEQUENCE
+                if self.sequence == 0:
+                    # 这一毫秒的序列号用完了，借用下一毫秒
+                    timestamp += 1
+            else:
+                self.sequence = 0
+            self.last_timestamp = timestamp
+            return (timestamp << TIMESTAMP_SHIFT) | (self.worker_id << WORKER_ID_SHIFT) | self.sequence
+
+
+def parse_id(snowflake_id):
+    """解析id，返回(毫秒时间戳, 机器id, 序列号)"""
+    return (
+        (snowflake_id >> TIMESTAMP_SHIFT) + EPOCH,
+        (snowflake_id >> WORKER_ID_SHIFT) & MAX_WORKER_ID,
+        snowflake_id & MAX_SEQUENCE,
+    )
+
+
+def get_owner():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def acquire_worker_id(conn, owner):
+    """
+    从redis中为当前进程分配一个没有被其他进程占用的机器id
+        在redis中占用WORKER_LEASE_KEY，进程退出后租约过期，机器id可以被重新分配
+    """
+    start = conn.incr(WORKER_COUNTER_KEY)
+    for i in range(MAX_WORKER_ID + 1):
+        worker_id = (start + i) & MAX_WORKER_ID
+        if conn.set(WORKER_LEASE_KEY % worker_id, owner, nx=True, ex=WORKER_LEASE_TIMEOUT):
+            return worker_id
+    raise RuntimeError('没有可用的snowflake机器id')
+
+
+def renew_worker_id(conn, worker_id, owner):
+    """租约仍然属于owner时续期并返回True，已经过期或者被其他进程占用时返回False"""
+    script = conn.register_script(WORKER_RENEW_SCRIPT)
+    return script(keys=[WORKER_LEASE_KEY % worker_id], args=[owner, WORKER_LEASE_TIMEOUT], client=conn) == 1
+
+
+class ProcessSnowflake(object):
+    """
+    进程内共享的id生成器
+        settings.SNOWFLAKE_WORKER_ID为None时从redis中自动分配机器id，
+        距离上次续期超过WORKER_LEASE_RENEW时，生成id前先确认租约还属于当前进程并续期，
+        长时间没有生成id、租约已经过期或者被其他进程占用时重新分配机器id
+        fork出的子进程会重新分配机器id
+    """
+
+    def __init__(self):
+        self.pid = None
+        self.owner = None
+        self.generator = None
+        self.renewed = 0
+        self.lock = threading.Lock()
+
+    def get_generator(self):
+        pid = os.getpid()
+        worker_id = settings.SNOWFLAKE_WORKER_ID
+        with self.lock:
+            if self.pid != pid:
+                if worker_id is None:
+                    self.owner = get_owner()
+                    worker_id = acquire_worker_id(self.get_connection(), self.owner)
+                    self.renewed = time.time()
+                self.generator = SnowflakeGenerator(worker_id)
+                self.pid = pid
+            elif worker_id is None and time.time() - self.renewed > WORKER_LEASE_RENEW:
+                conn = self.get_connection()
+                if not renew_worker_id(conn, self.generator.worker_id, self.owner):
+                    last_timestamp = self.generator.last_timestamp
+                    self.generator = SnowflakeGenerator(acquire_worker_id(conn, self.owner))
+                    # 新的机器id从下一毫秒开始，生成的id仍然递增
+                    self.generator.last_timestamp = last_timestamp + 1
+                self.renewed = time.time()
+        return self.generator
+
+    def get_connection(self):
+        return get_redis_connection('default')
+
+    def next_id(self):
+        return self.get_generator().next_id()
+
+
+_snowflake = ProcessSnowflake()
+
+
+def generate_id():
+    """生成一个全局唯一、单调递增的整数id"""
+    return _snowflake.next_id()
+
+
+def generate_order_id():
+    """生成订单id，补齐到19位，字符串的顺序和数值的顺序一致"""
+    return '%019d' % generate_id()